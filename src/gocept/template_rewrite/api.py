@@ -0,0 +1,83 @@
+"""Rewrite templates which are not stored in files."""
+from gocept.template_rewrite.dtml import DTMLRegexRewriter
+from gocept.template_rewrite.pagetemplates import PTParseError
+from gocept.template_rewrite.pagetemplates import PTParserRewriter
+import argparse
+import collections
+import gocept.template_rewrite.engines
+import gocept.template_rewrite.main
+
+
+REWRITERS = {
+    'dtml': DTMLRegexRewriter,
+    'pt': PTParserRewriter,
+}
+
+
+Result = collections.namedtuple('Result', ['name', 'text', 'changed', 'error'])
+Result.__doc__ = """The rewrite of a template.
+
+`text` is the rewritten text and `changed` tells whether it differs from the
+template. If the template cannot be parsed, `text` is `None` and `error` is
+the `PTParseError`, whose `errors` list the parts which cannot be parsed.
+"""
+
+
+def rewrite_many(templates, jobs=1,
+                 engine=gocept.template_rewrite.engines.DEFAULT_ENGINE,
+                 fixers=None, exclude_fixers=(), cache_size=10000,
+                 cache_dir=None, collect_errors=False, stats=None):
+    """Rewrite the templates given as `(name, text, kind)` tuples.
+
+    `kind` is one of `REWRITERS`, the name is used in log messages like the
+    path of a file. Yields a `Result` per template in the order of
+    `templates`, which are consumed while the results are computed.
+
+    The other arguments correspond to the options of the script: the
+    templates are rewritten by `jobs` worker processes using `engine` and
+    the selected fixers; `cache_size` and `cache_dir` configure the caches.
+    A `PTParseError` is raised on the first template which cannot be parsed
+    unless `collect_errors` is true. The counters and timers of the
+    templates are added to the `Stats` given as `stats`.
+    """
+    # The defaults of the options which are not arguments.
+    defaults = gocept.template_rewrite.main.parser.parse_args([])
+    settings = argparse.Namespace(**dict(
+        vars(defaults), jobs=jobs, engine=engine,
+        fixers=None if fixers is None else list(fixers),
+        exclude_fixers=list(exclude_fixers), cache_size=cache_size,
+        cache_dir=cache_dir, collect_errors=collect_errors))
+    if fixers is not None or exclude_fixers:
+        # Raise `ValueError` on unknown fixers before starting the workers.
+        gocept.template_rewrite.engines.select_fixes(
+            engine, fixers, exclude_fixers)
+    handler = gocept.template_rewrite.main.FileHandler([], settings)
+    handler.setup_rewrite()
+    started = collections.deque()
+    tasks = _tasks(templates, started)
+    for name, rewrite, counters, error in handler.rewrite_texts(tasks):
+        text = started.popleft()
+        if stats is not None:
+            stats.add_file(name, counters)
+        if error is not None:
+            if not (collect_errors and isinstance(error, PTParseError)):
+                raise error
+            yield Result(name, None, False, error)
+        elif rewrite is None:
+            yield Result(name, text, False, None)
+        else:
+            yield Result(name, rewrite, True, None)
+
+
+def _tasks(templates, started):
+    """Yield the arguments of `FileHandler.rewrite_text` for `templates`.
+
+    The texts are appended to `started`.
+    """
+    for name, text, kind in templates:
+        try:
+            rewriter = REWRITERS[kind]
+        except KeyError:
+            raise ValueError('Unknown kind of template {!r}'.format(kind))
+        started.append(text)
+        yield name, rewriter, text, collections.Counter(files=1)
@@ -0,0 +1,288 @@
+"""Measure the speed of the rewrite on synthetic template corpora.
+
+The results are written as JSON, so they can be compared between runs. This
+is a tool for developing the package, run it using `tox -e benchmark`.
+"""
+from gocept.template_rewrite.dtml import DTMLRegexRewriter
+from gocept.template_rewrite.engines import ENGINES
+from gocept.template_rewrite.engines import load_engine
+from gocept.template_rewrite.main import FileHandler
+from gocept.template_rewrite.pagetemplates import PTParserRewriter
+from gocept.template_rewrite.pagetemplates import PTSpliceRewriter
+import argparse
+import gocept.template_rewrite.engines
+import gocept.template_rewrite.main
+import json
+import logging
+import pathlib
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+log = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the rewrite of synthetic template corpora.')
+parser.add_argument('--scale', type=int, default=10, metavar='N',
+                    help='Size factor of the generated corpora. (default: 10)')
+parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                    help='Take the best time of N runs. (default: 3)')
+parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                    help='Number of worker processes for the end to end'
+                    ' benchmarks. (default: 1)')
+parser.add_argument('-o', '--output', type=str, default='benchmark.json',
+                    metavar='FILE',
+                    help='Write the results as JSON to FILE.'
+                    ' (default: %(default)s)')
+
+
+# Python 2 expressions as they occur in templates, some needing a rewrite.
+EXPRESSIONS = [
+    "request.get('x')",
+    'here.absolute_url()',
+    "context.has_key('{name}')",
+    'len(items) > {num}',
+    'unicode(item.title)',
+    "item.get('{name}', None) or ''",
+    'dict(items.iteritems())',
+    "'%s/{name}' % here.absolute_url()",
+    'long({num}) + 1',
+    'not (a <> {num})',
+]
+
+NAMES = ['title', 'id', 'description', 'url', 'size', 'author', 'date']
+
+
+def _expression(rand):
+    return rand.choice(EXPRESSIONS).format(
+        name=rand.choice(NAMES), num=rand.randint(0, 20))
+
+
+def generate_zpt(rand, depth, width, python_ratio):
+    """Generate a page template with nested `tal:define`/`tal:attributes`.
+
+    `python_ratio` is the share of Python expressions among the TALES
+    expressions, the others are path and string expressions.
+    """
+    def tales():
+        if rand.random() < python_ratio:
+            return 'python: ' + _expression(rand)
+        return rand.choice(
+            ['item/title', 'string:${item/id}', 'request/form/x | nothing'])
+
+    def element(level):
+        indent = '  ' * level
+        if level == depth:
+            return '{}<span tal:content="{}">text</span>\n'.format(
+                indent, tales())
+        children = ''.join(element(level + 1) for i in range(width))
+        return (
+            '{indent}<div class="level-{level}"\n'
+            '{indent}     tal:define="a {t1}; b {t2}"\n'
+            '{indent}     tal:attributes="title {t3}; href {t4}">\n'
+            '{children}'
+            '{indent}  <!-- static content -->\n'
+            '{indent}  <p>Lorem ipsum &amp; dolor sit amet.</p>\n'
+            '{indent}</div>\n').format(
+                indent=indent, level=level, t1=tales(), t2=tales(),
+                t3=tales(), t4=tales(), children=children)
+
+    return '<html>\n<body>\n{}</body>\n</html>\n'.format(element(0))
+
+
+def generate_dtml(rand, blocks, python_ratio):
+    """Generate a DTML document with `dtml-let` blocks and expressions."""
+    parts = []
+    for i in range(blocks):
+        if rand.random() < python_ratio:
+            parts.append(
+                '<dtml-let a="{}"\n'
+                '          b="{}">\n'
+                'SELECT * FROM table_{} WHERE\n'
+                '  <dtml-if expr="{}">x = <dtml-var expr="{}"></dtml-if>\n'
+                '</dtml-let>\n'.format(
+                    _expression(rand), _expression(rand), i,
+                    _expression(rand), _expression(rand)))
+        else:
+            parts.append(
+                'SELECT * FROM table_{} WHERE id = <dtml-var id>\n'
+                '<dtml-var sql_delimiter>\n'.format(i))
+    return ''.join(parts)
+
+
+def generate_corpora(scale, seed=0):
+    """Return a dict mapping corpus names to lists of (name, text) tuples."""
+    rand = random.Random(seed)
+    return {
+        'zpt-nested': [
+            ('nested{}.pt'.format(i), generate_zpt(rand, 4, 3, 0.5))
+            for i in range(scale)],
+        'zpt-few-expressions': [
+            ('few{}.pt'.format(i), generate_zpt(rand, 3, 3, 0.02))
+            for i in range(scale)],
+        'dtml-let': [
+            ('let{}.dtml'.format(i), generate_dtml(rand, 200, 0.9))
+            for i in range(scale)],
+        'dtml-few-expressions': [
+            ('few{}.dtml'.format(i), generate_dtml(rand, 200, 0.05))
+            for i in range(scale)],
+    }
+
+
+# Python code whose startup time is measured in a new process, `{path}` is an
+# empty directory.
+STARTUP = {
+    'interpreter': 'pass',
+    'import': 'import gocept.template_rewrite.main',
+    'help': ('from gocept.template_rewrite.main import main\n'
+             'main(["--help"])'),
+    'empty-run': ('from gocept.template_rewrite.main import main\n'
+                  'main([{path!r}, "--jobs=1"])'),
+}
+
+
+def measure_startup(repeat=3):
+    """Return the best time of `repeat` runs of the `STARTUP` code."""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, code in sorted(STARTUP.items()):
+            times = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                subprocess.run(
+                    [sys.executable, '-c', code.format(path=tmp)],
+                    check=True, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL)
+                times.append(time.perf_counter() - start)
+            results[name] = min(times)
+    return results
+
+
+def _identity(input_string, *args, **kwargs):
+    return input_string
+
+
+def _measure(func, repeat):
+    """Return the best time of `repeat` calls and the peak memory."""
+    times = []
+    for i in range(repeat):
+        gocept.template_rewrite.engines.expression_cache.clear()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    gocept.template_rewrite.engines.expression_cache.clear()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def _result(name, corpus, files, expressions, seconds, peak):
+    size = sum(len(text.encode('utf-8')) for _, text in files)
+    return {
+        'name': name,
+        'corpus': corpus,
+        'files': len(files),
+        'expressions': expressions,
+        'bytes': size,
+        'seconds': seconds,
+        'files_per_second': len(files) / seconds,
+        'expressions_per_second': expressions / seconds,
+        'seconds_per_expression': seconds / expressions if expressions else 0,
+        'mb_per_second': size / seconds / 1e6,
+        'peak_memory': peak,
+    }
+
+
+def run(scale=10, repeat=3, jobs=1, corpora=None):
+    """Run all benchmarks and return their results as a list of dicts.
+
+    `corpora` are the ones returned by `generate_corpora(scale)` unless
+    given.
+    """
+    if corpora is None:
+        corpora = generate_corpora(scale)
+    engines = []
+    for engine_name in sorted(ENGINES):
+        try:
+            engines.append(load_engine(engine_name))
+        except ImportError as e:
+            log.warning('Skipping the %s engine: %s', engine_name, e)
+    results = []
+    for corpus, files in sorted(corpora.items()):
+        if corpus.startswith('zpt'):
+            rewriters = [PTParserRewriter, PTSpliceRewriter]
+        else:
+            rewriters = [DTMLRegexRewriter]
+        expressions = [
+            expr for name, text in files
+            for expr in rewriters[0](text, None, name).collect_expressions()]
+
+        for rewriter in rewriters:
+            def parse():
+                for name, text in files:
+                    rewriter(text, _identity, filename=name)()
+
+            results.append(_result(
+                rewriter.__name__, corpus, files, len(expressions),
+                *_measure(parse, repeat)))
+
+        for engine in engines:
+            def refactor():
+                for expr in expressions:
+                    engine(expr, None, None, None)
+
+            results.append(_result(
+                engine.__name__, corpus, files, len(expressions),
+                *_measure(refactor, repeat)))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, text in files:
+                pathlib.Path(tmp, name).write_text(text, encoding='utf-8')
+            settings = gocept.template_rewrite.main.parser.parse_args(
+                [tmp, '--keep-files', '--jobs={}'.format(jobs)])
+
+            def end_to_end():
+                FileHandler(settings.paths, settings)()
+
+            results.append(_result(
+                'FileHandler', corpus, files, len(expressions),
+                *_measure(end_to_end, repeat)))
+    return results
+
+
+def main(args=None):
+    """Act as an entry point."""
+    args = parser.parse_args(args)
+    # The rewrite logs each processed file.
+    logger = logging.getLogger('gocept.template_rewrite.main')
+    level = logger.level
+    logger.setLevel(logging.ERROR)
+    try:
+        results = run(args.scale, args.repeat, args.jobs)
+    finally:
+        logger.setLevel(level)
+    for result in results:
+        log.warning('%s on %s: %.1f files/s, peak memory %d bytes',
+                    result['name'], result['corpus'],
+                    result['files_per_second'], result['peak_memory'])
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'python': sys.version,
+            'scale': args.scale,
+            'jobs': args.jobs,
+            'startup': measure_startup(args.repeat),
+            'results': results,
+        }, f, indent=1, sort_keys=True)
+    log.warning('Wrote the results to %s', args.output)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
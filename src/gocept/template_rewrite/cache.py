@@ -0,0 +1,126 @@
+import collections
+import hashlib
+import pathlib
+
+
+# Returned by `ExpressionCache.get` for keys which are not cached.
+MISSING = object()
+
+
+class ExpressionCache(object):
+    """A bounded LRU cache mapping expressions to their rewrite.
+
+    A `maxsize` of 0 disables the cache.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Return the cached value for `key` or `MISSING`."""
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        self._shrink()
+
+    def resize(self, maxsize):
+        """Change the size, dropping the least recently used entries."""
+        self.maxsize = maxsize
+        self._shrink()
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _shrink(self):
+        while len(self._data) > max(self.maxsize, 0):
+            self._data.popitem(last=False)
+
+
+class PersistentCache(object):
+    """A cache of expression rewrites in a SQLite database in `directory`.
+
+    The entries are keyed by a hash of the expression and `fingerprint`, which
+    identifies the configuration the rewrite was created with. New entries are
+    only written on `flush`.
+    """
+
+    filename = 'expressions.sqlite'
+
+    def __init__(self, directory, fingerprint):
+        self.path = pathlib.Path(directory) / self.filename
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        self._pending = {}
+        self._db = None
+
+    @property
+    def db(self):
+        # Connect lazily, so a process pool can be forked before.
+        if self._db is None:
+            import sqlite3
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(self.path), timeout=60)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS rewrites'
+                ' (key TEXT PRIMARY KEY, result TEXT NOT NULL)')
+        return self._db
+
+    def _key(self, src):
+        data = '{}\0{}'.format(self.fingerprint, src)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, src):
+        """Return the stored rewrite of `src` or `MISSING`."""
+        key = self._key(src)
+        value = self._pending.get(key, MISSING)
+        if value is MISSING:
+            row = self.db.execute(
+                'SELECT result FROM rewrites WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                value = row[0]
+        if value is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, src, value):
+        self._pending[self._key(src)] = value
+
+    def flush(self):
+        """Write the new entries to the database."""
+        if not self._pending:
+            return
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO rewrites VALUES (?, ?)',
+                self._pending.items())
+        self._pending.clear()
+
+    def close(self):
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
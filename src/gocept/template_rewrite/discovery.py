@@ -0,0 +1,240 @@
+import logging
+import os
+import os.path
+import re
+
+
+log = logging.getLogger(__name__)
+
+# Directories of version control systems, tools and builds which do not
+# contain templates to rewrite.
+DEFAULT_EXCLUDES = [
+    '.git', '.hg', '.svn', '.tox', '__pycache__', 'node_modules', 'var',
+    'eggs', 'develop-eggs', '*.egg', '*.egg-info', 'build', 'dist',
+]
+
+# Number of threads listing directories in parallel.
+THREADS = 8
+
+
+def translate(pattern):
+    """Translate a glob pattern in `.gitignore` syntax to a regex.
+
+    `*` and `?` do not match `/`, `**` matches any number of directories.
+    Like in git, other consecutive asterisks are regular ones.
+    """
+    res = []
+    i, n = 0, len(pattern)
+    while i < n:
+        if pattern.startswith('**/', i) and (i == 0 or pattern[i - 1] == '/'):
+            res.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('/**', i) and i + 3 == n:
+            res.append('/.*')
+            i += 3
+            continue
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            while pattern.startswith('*', i):
+                i += 1
+            res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '\\' and i < n:
+            res.append(re.escape(pattern[i]))
+            i += 1
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                res.append('\\[')
+            else:
+                chars = pattern[i:end].replace('\\', '\\\\')
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                res.append('[{}]'.format(chars))
+                i = end + 1
+        else:
+            res.append(re.escape(c))
+    return ''.join(res)
+
+
+class Rule(object):
+    """A pattern of a `.gitignore` file or given on the command line.
+
+    It applies to the paths below the directory `base`, which is given
+    relative to the directory being searched and ends with `/` unless it is
+    empty.
+    """
+
+    def __init__(self, pattern, base=''):
+        self.base = base
+        self.negate = pattern.startswith('!')
+        if self.negate:
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        # Patterns without a slash match the name of a file at any depth.
+        self.anchored = '/' in pattern
+        self.pattern = translate(pattern.lstrip('/'))
+        self.regex = re.compile(self.pattern)
+
+    def matches(self, relpath, name, is_dir):
+        """Tell whether the rule matches the path relative to the search."""
+        if self.dir_only and not is_dir:
+            return False
+        if not self.anchored:
+            return self.regex.fullmatch(name) is not None
+        return self.regex.fullmatch(relpath[len(self.base):]) is not None
+
+
+def parse_gitignore(lines, base=''):
+    """Return the rules of the lines of a `.gitignore` file in `base`."""
+    rules = []
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.endswith('\\ '):
+            line = line.rstrip()
+        if not line or line.startswith('#'):
+            continue
+        # Escaped leading `#` and `!` are kept for `translate`.
+        rules.append(Rule(line, base))
+    return rules
+
+
+def combine(rules, is_dir):
+    """Return a regex matching the paths relative to the search which one of
+    `rules` matches, their `base` and negation are not taken into account.
+
+    `None` is returned if there are no such rules.
+    """
+    patterns = []
+    for rule in rules:
+        if rule.dir_only and not is_dir:
+            continue
+        if rule.anchored:
+            patterns.append(rule.pattern)
+        else:
+            patterns.append('(?:.*/)?' + rule.pattern)
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:{})'.format(p) for p in patterns))
+
+
+def is_ignored(rules, relpath, name, is_dir):
+    """Tell whether a path is ignored, the last matching rule decides."""
+    ignored = False
+    for rule in rules:
+        if rule.matches(relpath, name, is_dir):
+            ignored = not rule.negate
+    return ignored
+
+
+def _scan(directory, gitignore):
+    """List a directory.
+
+    Return the sorted names of the files and of the directories in it and
+    the lines of its `.gitignore` file if `gitignore` is true.
+    """
+    files = []
+    dirs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(entry.name)
+                # Like `os.walk`, do not follow symbolic links to
+                # directories.
+                elif not entry.is_symlink():
+                    dirs.append(entry.name)
+    except OSError:
+        log.warning('Cannot list %s', directory, exc_info=True)
+    lines = []
+    if gitignore and '.gitignore' in files:
+        path = os.path.join(directory, '.gitignore')
+        try:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                lines = f.readlines()
+        except OSError:
+            log.warning('Cannot read %s', path, exc_info=True)
+    return sorted(files), sorted(dirs), lines
+
+
+class FileFinder(object):
+    """Find the files in directory trees.
+
+    Files and directories matching one of the `exclude` patterns or ignored
+    by a `.gitignore` file within the searched directories are left out. If
+    `include` patterns are given, only files matching one of them are found.
+    The patterns use the syntax of `.gitignore` files relative to the
+    searched directories except for negation.
+
+    The directories are listed in parallel by a pool of `threads`, while the
+    files are yielded in a stable order: the files of a directory sorted by
+    name and then the ones in its subdirectories. `pruned` counts the
+    excluded and ignored files and directories.
+    """
+
+    def __init__(self, include=(), exclude=(), gitignore=True,
+                 threads=THREADS):
+        include = [Rule(pattern) for pattern in include]
+        exclude = [Rule(pattern) for pattern in exclude]
+        self.include = combine(include, False)
+        self.exclude_files = combine(exclude, False)
+        self.exclude_dirs = combine(exclude, True)
+        self.gitignore = gitignore
+        self.threads = threads
+        self.pruned = 0
+
+    def find(self, paths):
+        """Yield the paths of the files in `paths` as strings.
+
+        Paths which are not directories are yielded as they are.
+        """
+        import concurrent.futures
+        self.pruned = 0
+        with concurrent.futures.ThreadPoolExecutor(self.threads) as pool:
+            for path in paths:
+                path = str(path)
+                if os.path.isdir(path):
+                    future = pool.submit(_scan, path, self.gitignore)
+                    yield from self._walk(pool, path, '', future, [])
+                else:
+                    yield path
+
+    def _is_excluded(self, relpath, name, is_dir, rules):
+        exclude = self.exclude_dirs if is_dir else self.exclude_files
+        if (exclude is not None and exclude.fullmatch(relpath) is not None
+                or rules and is_ignored(rules, relpath, name, is_dir)):
+            self.pruned += 1
+            return True
+        return False
+
+    def _is_included(self, relpath):
+        return self.include is None or (
+            self.include.fullmatch(relpath) is not None)
+
+    def _walk(self, pool, directory, base, future, rules):
+        files, dirs, lines = future.result()
+        if lines:
+            rules = rules + parse_gitignore(lines, base)
+        # List the subdirectories while yielding the files.
+        subdirs = []
+        for name in dirs:
+            relpath = base + name
+            if not self._is_excluded(relpath, name, True, rules):
+                path = os.path.join(directory, name)
+                subdirs.append((path, relpath, pool.submit(
+                    _scan, path, self.gitignore)))
+        for name in files:
+            relpath = base + name
+            if (self._is_included(relpath)
+                    and not self._is_excluded(relpath, name, False, rules)):
+                yield os.path.join(directory, name)
+        for path, relpath, subdir in subdirs:
+            yield from self._walk(pool, path, relpath + '/', subdir, rules)
@@ -1,6 +1,15 @@
+from gocept.template_rewrite.pagetemplates import action_errors
+from gocept.template_rewrite.pagetemplates import parse_error
+import bisect
+import functools
+import io
+import logging
 import re
 
 
+log = logging.getLogger(__name__)
+
+
 dtml_regex = (
     # beginning
     r'(?P<before>'
@@ -60,39 +69,368 @@ dtml_let_expression_regex = (
 )
 
 
+dtml_pattern = re.compile(dtml_regex)
+dtml_let_pattern = re.compile(dtml_let_regex)
+dtml_let_expression_pattern = re.compile(dtml_let_expression_regex)
+
+# The start of a tag which might match `dtml_regex` or `dtml_let_regex`.
+# `dtml_let_regex` also matches `<dtml-let >` but does not change it.
+dtml_tag_start_regex = re.compile(r'<dtml-(?=\w+\s[^>"]*")')
+
+# A match of `dtml_let_regex` cannot extend beyond the first `>`, so another
+# tag starting before it might become part of it.
+dtml_nested_let_regex = re.compile(r'<dtml-let\s[^>]*<dtml-')
+
+
+# Each match of the regexes above starts like this, so it is a cheap way to
+# tell whether there is anything to rewrite at all.
+dtml_expression_tag_regex = re.compile(r'<dtml-\w+\s[^>"]*"')
+
+newline_regex = re.compile('\n')
+
+# Number of bytes of an encoded input copied at once.
+CHUNK_SIZE = 1 << 20
+
+
+def newline_offsets(text):
+    """Return the offsets of the line breaks in `text`, see `line_number`."""
+    return [match.start() for match in newline_regex.finditer(text)]
+
+
+def line_number(newlines, offset):
+    """Return the number of the line containing `offset` using the offsets of
+    the line breaks of the text."""
+    return bisect.bisect_left(newlines, offset) + 1
+
+
+def count_newlines(data, start, end):
+    """Count the line breaks between `start` and `end` in the bytes-like
+    object `data` copying at most `CHUNK_SIZE` bytes at once."""
+    count = 0
+    for pos in range(start, end, CHUNK_SIZE):
+        count += data[pos:min(pos + CHUNK_SIZE, end)].count(b'\n')
+    return count
+
+
+def write_chunks(output, data, start, end):
+    """Write the part between `start` and `end` of the bytes-like object
+    `data` to `output` in chunks of `CHUNK_SIZE` bytes."""
+    for pos in range(start, end, CHUNK_SIZE):
+        output.write(data[pos:min(pos + CHUNK_SIZE, end)])
+
+
 class DTMLRegexRewriter(object):
     """A Rewriter based on regex instead of DTML parser."""
 
     rewrite_action = None
 
-    def __init__(self, dtml_input, rewrite_action, *args, **kw):
+    def __init__(self, dtml_input, rewrite_action, filename='', *args, **kw):
         self.raw = dtml_input
         self.rewrite_action = rewrite_action
+        self.filename = filename
+        self.parse_errors = []
+        self._newlines = None
 
-    def _rewrite_expression(self, match_ob):
-        """Handle the match object to only expose the expression string."""
-        return ''.join([
-            match_ob.group('before'),
-            self.rewrite_action(match_ob.group('expr'),
-                                lineno=None, tag=None, filename=None),
-            match_ob.group('end'),
-        ])
+    @property
+    def newlines(self):
+        """The offsets of the line breaks in the input, computed on first
+        use."""
+        if self._newlines is None:
+            self._newlines = newline_offsets(self.raw)
+        return self._newlines
+
+    def _rewrite_expression(self, match_ob, offset=0, tag=None, newlines=None,
+                            line=0):
+        """Handle the match object to only expose the expression string.
+
+        `offset` is the one of the matched text in the text whose line breaks
+        are at `newlines`, by default the input. `line` is the number of
+        lines before this text. `tag` defaults to the match. Expressions
+        which cannot be parsed are kept and recorded in `parse_errors`.
+        """
+        before, expr, end = match_ob.group('before', 'expr', 'end')
+        if newlines is None:
+            newlines = self.newlines
+        lineno = line + line_number(newlines, offset + match_ob.start('expr'))
+        if tag is None:
+            tag = match_ob.group()
+        try:
+            expr = self.rewrite_action(
+                expr, lineno=lineno, tag=tag, filename=self.filename)
+        except action_errors() as e:
+            self.parse_errors.append(
+                {'lineno': lineno, 'tag': tag, 'error': str(e)})
+        return before + expr + end
 
-    def _rewrite_let(self, match_ob):
+    def _rewrite_let(self, match_ob, offset=0, newlines=None, line=0):
         """Handle the dtml-let matches, that are different than expressions."""
+        rewrite_expression = functools.partial(
+            self._rewrite_expression,
+            offset=offset + match_ob.start('expr'), tag=match_ob.group(),
+            newlines=newlines, line=line)
         return ''.join([
             match_ob.group('before'),
-            re.sub(dtml_let_expression_regex,
-                   self._rewrite_expression,
-                   match_ob.group('expr')
-                   ),
+            dtml_let_expression_pattern.sub(
+                rewrite_expression, match_ob.group('expr')),
             match_ob.group('end'),
         ])
 
-    def __call__(self):
-        """Return the rewrite of the parsed input."""
-        res = re.sub(dtml_regex, self._rewrite_expression, self.raw)
-        # let statements
-        res = re.sub(dtml_let_regex, self._rewrite_let, res)
+    @property
+    def needs_rewrite(self):
+        """Cheaply tell whether the input contains any expressions."""
+        return dtml_expression_tag_regex.search(self.raw) is not None
+
+    def collect_expressions(self):
+        """Return the Python expressions in the input."""
+        expressions = []
+
+        def collect(input_string, *args, **kwargs):
+            expressions.append(input_string)
+            return input_string
+
+        type(self)(self.raw, collect, filename=self.filename)()
+        return expressions
+
+    def __call__(self, output=None):
+        """Return the rewrite of the parsed input.
+
+        If the text stream `output` is given, the rewrite is written to it
+        instead. Raises `PTParseError` after logging the location of the
+        expressions which cannot be parsed.
+        """
+        if output is None:
+            output = io.StringIO()
+            self(output)
+            return output.getvalue()
+        self.parse_errors = []
+        if not self.needs_rewrite:
+            output.write(self.raw)
+            return
+        tags = self._find_tags()
+        if tags is None:
+            output.write(self._substitute())
+        else:
+            output.write(self._splice(tags))
+        self._report_errors()
+
+    def _report_errors(self):
+        """Log the `parse_errors` and raise `PTParseError` if there are any.
+        """
+        for err in self.parse_errors:
+            log.error(
+                'Parsing error in %s:%d \n\t%s',
+                self.filename,
+                err['lineno'],
+                err['tag'],
+                exc_info=False,
+            )
+        if self.parse_errors:
+            raise parse_error(self.filename, self.parse_errors)
+
+    def _splice(self, tags):
+        """Return the input with the rewrite of the matches in `tags`."""
+        raw = self.raw
+        parts = []
+        written = 0
+        for match in tags:
+            start, end = match.span()
+            parts.append(raw[written:start])
+            parts.append(self._rewrite_tag(match))
+            written = end
+        parts.append(raw[written:])
+        return ''.join(parts)
+
+    def _rewrite_tag(self, match, newlines=None, line=0):
+        """Return the rewrite of a match of `_find_tags`.
+
+        `newlines` and `line` describe the text the match was found in like
+        for `_rewrite_expression`.
+        """
+        if match.re is dtml_let_pattern:
+            return self._rewrite_let(match, newlines=newlines, line=line)
+        rewrite = self._rewrite_expression(match, newlines=newlines, line=line)
+        start = match.start()
+        if match.string.startswith('<dtml-let', start):
+            # The substitution of `dtml_let_regex` sees this rewrite.
+            let_match = dtml_let_pattern.match(rewrite)
+            if let_match is not None:
+                rewrite = (self._rewrite_let(
+                    let_match, offset=start, newlines=newlines, line=line) +
+                    rewrite[let_match.end():])
+        return rewrite
+
+    def _find_tags(self):
+        """Find the tags to rewrite in a single pass over the input.
+
+        Return the matches of `dtml_regex` or else `dtml_let_regex` at the
+        start of each tag, their rewrite gives the same result as
+        `_substitute`. Returns `None` if a tag starts within another one, as
+        then the substitution of `dtml_let_regex` might depend on the one of
+        `dtml_regex`.
+        """
+        raw = self.raw
+        if dtml_nested_let_regex.search(raw) is not None:
+            return None
+        tags = []
+        for start in dtml_tag_start_regex.finditer(raw):
+            pos = start.start()
+            match = (dtml_pattern.match(raw, pos) or
+                     dtml_let_pattern.match(raw, pos))
+            if match is None:
+                continue
+            if raw.find('<dtml-', pos + 1, match.end()) != -1:
+                return None
+            tags.append(match)
+        return tags
+
+    def _substitute(self):
+        """Rewrite the matches of `dtml_regex` and then the ones of
+        `dtml_let_regex` in the result."""
+        res = dtml_pattern.sub(self._rewrite_expression, self.raw)
+        rewrite_let = functools.partial(
+            self._rewrite_let, newlines=newline_offsets(res))
+        return dtml_let_pattern.sub(rewrite_let, res)
+
+
+class DTMLMappedRewriter(DTMLRegexRewriter):
+    """A rewriter for DTML in a bytes-like object, e.g. a memory mapped file.
+
+    Only the parts of the input which could be a tag to rewrite are decoded
+    and the rewrite is written encoded to a binary stream, so the memory
+    used does not grow with the size of the input. The result is the same as
+    the one of `DTMLRegexRewriter` for the decoded input, inputs with tags
+    inside other tags are decoded as a whole though.
+    """
+
+    def __init__(self, dtml_input, rewrite_action, filename='', *args,
+                 encoding='utf-8', **kw):
+        super().__init__(dtml_input, rewrite_action, filename, *args, **kw)
+        self.encoding = encoding
+
+    @property
+    def needs_rewrite(self):
+        """Cheaply tell whether the input contains any expressions."""
+        for pos, end in self._candidates():
+            if end is None:
+                # The regex does not need a `>` but a double quote.
+                end = self.raw.find(b'"', pos) + 1
+                if not end:
+                    return False
+            if dtml_expression_tag_regex.match(self._decode(pos, end)):
+                return True
+        return False
+
+    def collect_expressions(self):
+        """Return the Python expressions in the input."""
+        expressions = []
+
+        def collect(input_string, *args, **kwargs):
+            expressions.append(input_string)
+            return input_string
+
+        type(self)(self.raw, collect, filename=self.filename,
+                   encoding=self.encoding)(_Discard())
+        return expressions
+
+    def __call__(self, output=None):
+        """Return the encoded rewrite of the input.
+
+        If the binary stream `output` is given, the rewrite is written to it
+        instead. Raises `PTParseError` after logging the location of the
+        expressions which cannot be parsed.
+        """
+        if output is None:
+            output = io.BytesIO()
+            self(output)
+            return output.getvalue()
+        self.parse_errors = []
+        if any(tag is None for tag in self._tags()):
+            rewriter = DTMLRegexRewriter(
+                self._decode(0, len(self.raw)), self.rewrite_action,
+                filename=self.filename)
+            text_output = io.StringIO()
+            try:
+                rewriter(text_output)
+            finally:
+                output.write(text_output.getvalue().encode(self.encoding))
+                self.parse_errors = rewriter.parse_errors
+            return
+        written = 0
+        line = 0
+        for start, end, match in self._tags():
+            write_chunks(output, self.raw, written, start)
+            line += count_newlines(self.raw, written, start)
+            rewrite = self._rewrite_tag(
+                match, newlines=newline_offsets(match.string), line=line)
+            output.write(rewrite.encode(self.encoding))
+            line += count_newlines(self.raw, start, end)
+            written = end
+        write_chunks(output, self.raw, written, len(self.raw))
+        self._report_errors()
+
+    def _decode(self, start, end):
+        return self.raw[start:end].decode(self.encoding)
+
+    def _candidates(self):
+        """Yield the positions of the starts of DTML tags and the ends of the
+        parts of the input which tell whether they match.
+
+        The regexes cannot match beyond the first `>` after the start or
+        after the expression in double quotes. The end is `None` if there is
+        no `>` after the start.
+        """
+        raw = self.raw
+        pos = raw.find(b'<dtml-')
+        while pos != -1:
+            end = raw.find(b'>', pos)
+            if end == -1:
+                yield pos, None
+            else:
+                quote = raw.find(b'"', pos, end)
+                if quote != -1:
+                    quote = raw.find(b'"', quote + 1)
+                    if quote != -1:
+                        end = max(end, raw.find(b'>', quote + 1))
+                yield pos, end + 1
+            pos = raw.find(b'<dtml-', pos + 1)
+
+    def _tags(self):
+        """Yield the tags to rewrite like `_find_tags`.
+
+        They are tuples of their start and end in the input and the match in
+        the decoded part of the input starting with the tag. `None` is
+        yielded if a tag starts within another one.
+        """
+        raw = self.raw
+        for pos, end in self._candidates():
+            if end is None:
+                # Nothing matches without a `>`, but the tag might contain
+                # another one.
+                end = raw.find(b'<dtml-', pos + 1)
+                if end == -1:
+                    return
+                end += len(b'<dtml-')
+            text = self._decode(pos, end)
+            if dtml_nested_let_regex.match(text) is not None:
+                yield None
+                return
+            if dtml_tag_start_regex.match(text) is None:
+                continue
+            match = (dtml_pattern.match(text) or
+                     dtml_let_pattern.match(text))
+            if match is None:
+                continue
+            if text.find('<dtml-', 1, match.end()) != -1:
+                yield None
+                return
+            yield pos, pos + len(match.group().encode(self.encoding)), match
+
+
+class _Discard(io.RawIOBase):
+    """Binary stream forgetting what is written to it."""
+
+    def writable(self):
+        return True
 
-        return res
+    def write(self, data):
+        return len(data)
@@ -0,0 +1,92 @@
+"""Find out the encoding of templates."""
+import codecs
+import functools
+import re
+
+
+# Encoding of templates which do not declare one.
+DEFAULT_ENCODING = 'utf-8'
+
+# Number of bytes at the start of a template searched for a declaration.
+SNIFF_SIZE = 1024
+
+# Byte order marks, the mark is kept in the decoded text, so it is written
+# again.
+BOMS = [
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+]
+
+RE_XML_DECLARATION = re.compile(
+    rb'''<\?xml\s[^>]*?\bencoding\s*=\s*["']([\w.:-]+)["']''')
+# `<meta charset="...">` as well as `<meta http-equiv="Content-Type"
+# content="text/html; charset=...">`.
+RE_META_CHARSET = re.compile(
+    rb'''<meta\s[^>]*?\bcharset\s*=\s*["']?([\w.:-]+)''', re.IGNORECASE)
+
+RE_NON_ASCII = re.compile(rb'[^\x00-\x7f]')
+
+
+@functools.lru_cache()
+def is_known(encoding):
+    """Tell whether Python has a codec for `encoding`."""
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        return False
+    return True
+
+
+@functools.lru_cache()
+def is_ascii_compatible(encoding):
+    """Tell whether `encoding` encodes ASCII characters like ASCII."""
+    sample = '\t\n\r !"#&\'<=>?/azAZ09;:-_'
+    try:
+        return sample.encode(encoding) == sample.encode('ascii')
+    except UnicodeError:
+        return False
+
+
+def declared_encoding(data):
+    """Return the encoding declared at the start of the bytes-like object
+    `data` or `None`.
+
+    A byte order mark wins over an `<?xml encoding>` declaration and this one
+    over `<meta charset>`. Encodings unknown to Python are ignored.
+    """
+    head = bytes(data[:SNIFF_SIZE])
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding
+    for regex in (RE_XML_DECLARATION, RE_META_CHARSET):
+        match = regex.search(head)
+        if match is not None:
+            encoding = match.group(1).decode('ascii').lower()
+            # The declaration was found as ASCII, so other encodings are
+            # wrong.
+            if is_known(encoding) and is_ascii_compatible(encoding):
+                return encoding
+    return None
+
+
+def detect(data, default=DEFAULT_ENCODING):
+    """Return the encoding of the bytes-like object `data`.
+
+    It is the declared one or `default`.
+    """
+    return declared_encoding(data) or default
+
+
+def decode(data, default=DEFAULT_ENCODING):
+    """Decode the encoded template in the bytes-like object `data`.
+
+    Returns the text and the encoding, see `detect`. Pure ASCII data is
+    decoded as such if the encoding allows it, as this is the fastest way.
+    Raises `UnicodeDecodeError` if `data` cannot be decoded.
+    """
+    encoding = detect(data, default)
+    if (is_ascii_compatible(encoding)
+            and RE_NON_ASCII.search(data) is None):
+        return str(data, 'ascii'), encoding
+    return str(data, encoding), encoding
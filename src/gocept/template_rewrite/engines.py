@@ -0,0 +1,287 @@
+"""Engines rewriting single Python expressions.
+
+An engine is a callable with the signature of `rewrite_action` which returns
+the rewritten expression and raises `PTParseError` if the expression cannot
+be parsed. Its module can define `fingerprint()` to identify its
+implementation and `init_worker()` to set up a worker process.
+
+The fixers of an engine can be selected if its module defines
+`available_fixes()`, `default_fixes()`, `get_fixes()` and `use_fixes(names)`.
+`fix_triggers(name)` returns the tokens one of which a fixer needs to change
+an expression, see `RE_TRIGGER`, or `None` if they are not known.
+"""
+from gocept.template_rewrite.cache import MISSING
+from gocept.template_rewrite.cache import ExpressionCache
+from gocept.template_rewrite.cache import PersistentCache
+from gocept.template_rewrite.pagetemplates import PTParseError
+import ast
+import hashlib
+import importlib
+import re
+import sys
+
+
+ENGINES = {
+    'lib2to3': 'gocept.template_rewrite.lib2to3:rewrite_using_2to3',
+    'tokens': 'gocept.template_rewrite.tokenrewrite:rewrite_using_tokens',
+}
+DEFAULT_ENGINE = 'tokens'
+
+# The tokens which can be changed by a fixer: names, `<>` and backticks.
+# Strings with an `u` prefix or escape are reported as `string`, long and
+# octal numbers as `number`. Tokens in strings and comments are found, too.
+RE_TRIGGER = re.compile(
+    r'(?P<string>\b[uU][rR]?[\'"]|\\[uU])|'
+    r'(?P<number>\b\d\w*[lL]\b|\b0\d)|'
+    r'[^\W\d]\w*|<>|`')
+
+# The name of the engine in use and the engine itself, which is loaded on
+# first use, see `use_engine` and `get_engine`.
+engine_name = DEFAULT_ENGINE
+engine = None
+
+# The fixers selected by `use_fixes`, applied when the engine is loaded.
+selected_fixers = None
+excluded_fixers = ()
+
+# The triggers of the fixers in use, see `get_triggers`.
+triggers = MISSING
+
+# The names of the fixers changing an expression, see `fired_fixes`.
+_fired = {}
+
+# Templates repeat the same expressions a lot, so we remember the rewrites.
+expression_cache = ExpressionCache()
+
+# Optional cache shared across runs, see `open_persistent_cache`.
+persistent_cache = None
+
+
+def load_engine(name):
+    """Load an engine given by its name in `ENGINES` or as `module:callable`.
+    """
+    module, _, attr = ENGINES.get(name, name).partition(':')
+    if not attr:
+        raise ValueError('Unknown engine {!r}'.format(name))
+    return getattr(importlib.import_module(module), attr)
+
+
+def use_engine(name=DEFAULT_ENGINE):
+    """Rewrite the expressions using the engine called `name`.
+
+    The engine is loaded on first use.
+    """
+    global engine_name
+    if name == engine_name:
+        return
+    engine_name = name
+    _reset()
+
+
+def use_fixes(fixers=None, exclude_fixers=()):
+    """Select the fixers of the engine in use, see `select_fixes`."""
+    global selected_fixers, excluded_fixers
+    if fixers is not None:
+        fixers = list(fixers)
+    exclude_fixers = tuple(exclude_fixers)
+    if (fixers, exclude_fixers) == (selected_fixers, excluded_fixers):
+        return
+    selected_fixers, excluded_fixers = fixers, exclude_fixers
+    _reset()
+
+
+def _reset():
+    """Forget everything which depends on the engine and its fixers."""
+    global engine, triggers
+    engine = None
+    triggers = MISSING
+    _fired.clear()
+    expression_cache.clear()
+
+
+def get_engine():
+    """Return the engine in use, load it if necessary."""
+    global engine
+    if engine is None:
+        engine = load_engine(engine_name)
+        module = _engine_module(engine)
+        if hasattr(module, 'use_fixes'):
+            names = None
+            if selected_fixers is not None or excluded_fixers:
+                names = select_fixes(
+                    engine_name, selected_fixers, excluded_fixers)
+            module.use_fixes(names)
+    return engine
+
+
+def _engine_module(engine):
+    return sys.modules[engine.__module__]
+
+
+def select_fixes(name, fixers=None, exclude_fixers=()):
+    """Return the names of the fixers of the engine `name` to use.
+
+    `fixers` defaults to the default fixers of the engine, the ones in
+    `exclude_fixers` are left out. Returns `None` for engines which do not
+    support selecting fixers. Raises `ValueError` on unknown fixers.
+    """
+    module = _engine_module(load_engine(name))
+    if not hasattr(module, 'use_fixes'):
+        if fixers is not None or exclude_fixers:
+            raise ValueError(
+                'Engine {!r} does not support selecting fixers'.format(name))
+        return None
+    unknown = set(fixers or ()).union(exclude_fixers).difference(
+        module.available_fixes())
+    if unknown:
+        raise ValueError('Unknown fixers of engine {!r}: {}'.format(
+            name, ', '.join(sorted(unknown))))
+    if fixers is None:
+        fixers = module.default_fixes()
+    return [fixer for fixer in fixers if fixer not in exclude_fixers]
+
+
+def fingerprint(name=None, fixers=None, exclude_fixers=()):
+    """Identify the configuration which influences the rewrite result.
+
+    `name` defaults to the engine in use and its selected fixers, see
+    `select_fixes` for the other arguments.
+    """
+    if name is None:
+        name = engine_name
+        fixers, exclude_fixers = selected_fixers, excluded_fixers
+    data = [sys.version, name]
+    module = _engine_module(load_engine(name))
+    if hasattr(module, 'fingerprint'):
+        data.append(module.fingerprint())
+    data.extend(sorted(select_fixes(name, fixers, exclude_fixers) or ()))
+    return hashlib.sha256('\n'.join(data).encode('utf-8')).hexdigest()
+
+
+def get_triggers():
+    """Return the tokens one of which an expression needs to contain to be
+    changed by the fixers in use or `None` if they are not known."""
+    global triggers
+    if triggers is MISSING:
+        module = _engine_module(get_engine())
+        triggers = None
+        if hasattr(module, 'fix_triggers'):
+            fix_triggers = [module.fix_triggers(name)
+                            for name in module.get_fixes()]
+            if None not in fix_triggers:
+                triggers = set().union(*fix_triggers)
+    return triggers
+
+
+def scan_triggers(src):
+    """Return the tokens in `src` which might be triggers of a fixer."""
+    return {match.lastgroup or match.group()
+            for match in RE_TRIGGER.finditer(src)}
+
+
+def is_unaffected(src):
+    """Tell whether the fixers in use cannot change the expression `src`.
+
+    It contains none of their triggers and is valid Python 3.
+    """
+    triggers = get_triggers()
+    if triggers is None or not triggers.isdisjoint(scan_triggers(src)):
+        return False
+    try:
+        ast.parse(src)
+    except (SyntaxError, ValueError):
+        return False
+    return True
+
+
+def fired_fixes(src):
+    """Return the names of the fixers in use which change the expression `src`.
+
+    A fixer fires if leaving it out changes the rewrite. None fire for
+    engines which do not support selecting fixers.
+    """
+    consolidated_src = src.lstrip()
+    fired = _fired.get(consolidated_src)
+    if fired is None:
+        fired = _fired[consolidated_src] = _find_fired_fixes(consolidated_src)
+    return fired
+
+
+def _find_fired_fixes(src):
+    module = _engine_module(get_engine())
+    if not hasattr(module, 'use_fixes'):
+        return ()
+    fixes = list(module.get_fixes())
+    found = scan_triggers(src)
+    expected = _try_rewrite(src)
+    fired = []
+    try:
+        for name in fixes:
+            fix_triggers = module.fix_triggers(name)
+            if fix_triggers is not None and fix_triggers.isdisjoint(found):
+                continue
+            module.use_fixes([fix for fix in fixes if fix != name])
+            if _try_rewrite(src) != expected:
+                fired.append(name)
+    finally:
+        module.use_fixes(fixes)
+    return tuple(fired)
+
+
+def _try_rewrite(src):
+    """Return the rewrite of `src` or `None` if it cannot be parsed."""
+    try:
+        return engine(src, None, None, None)
+    except PTParseError:
+        return None
+
+
+def init_worker():
+    """Set up the engine in a worker process if it is already loaded."""
+    if engine is None:
+        return
+    module = _engine_module(engine)
+    if hasattr(module, 'init_worker'):
+        module.init_worker()
+
+
+def open_persistent_cache(directory):
+    """Use a `PersistentCache` in `directory`, `None` disables it."""
+    global persistent_cache
+    if persistent_cache is not None:
+        persistent_cache.close()
+    persistent_cache = None
+    if directory is not None:
+        persistent_cache = PersistentCache(directory, fingerprint())
+
+
+def flush_persistent_cache():
+    """Store the new rewrites in the persistent cache if there is one."""
+    if persistent_cache is not None:
+        persistent_cache.flush()
+
+
+def rewrite(src, lineno, tag, filename):
+    """Rewrite a python expression using the engine in use.
+
+    Expressions which the fixers in use cannot change are not passed to the
+    engine. The rewrites are cached in `expression_cache` and
+    `persistent_cache`.
+    """
+    consolidated_src = src.lstrip()
+    result = expression_cache.get(consolidated_src)
+    if result is MISSING:
+        if persistent_cache is not None:
+            result = persistent_cache.get(consolidated_src)
+        if result is MISSING:
+            if is_unaffected(consolidated_src):
+                result = consolidated_src
+            else:
+                result = get_engine()(
+                    consolidated_src, lineno, tag, filename)
+            if persistent_cache is not None:
+                persistent_cache.set(consolidated_src, result)
+        expression_cache.set(consolidated_src, result)
+    if result == consolidated_src:
+        return src  # include leading white space
+    return result
@@ -1,25 +1,141 @@
+from gocept.template_rewrite.pagetemplates import PTParseError
+import hashlib
+import importlib
 import lib2to3.pgen2.parse
+import lib2to3.pgen2.tokenize
 import lib2to3.refactor
 import logging
+import re
+import sys
 
 
 log = logging.getLogger(__name__)
 
-fixes = lib2to3.refactor.get_fixers_from_package('lib2to3.fixes')
-fixes = [f for f in fixes if not f.endswith('fix_next')]
+PACKAGE = 'lib2to3.fixes'
 
-tool = lib2to3.refactor.RefactoringTool(fixes)
+# Tokens which can be changed by fixers whose pattern does not name them, see
+# `fix_triggers`. `number` and `string` stand for literals of this type.
+EXTRA_TRIGGERS = {
+    'metaclass': {'class'},
+    'ne': {'<>'},
+    'numliterals': {'number'},
+    'repr': {'`'},
+    'unicode': {'string'},
+}
+
+RE_LITERAL = re.compile(r"'(\w+)'")
+
+# The names of the fixers to use, `None` means the default ones, see
+# `get_fixes`.
+fixes = None
+
+# The `RefactoringTool` created on first use, see `get_tool`.
+tool = None
+
+# The tools created for sets of fixers, see `get_tool`.
+_tools = {}
+
+
+def available_fixes():
+    """Return the names of all fixers in `lib2to3.fixes`."""
+    prefix = PACKAGE + '.fix_'
+    return [module[len(prefix):] for module in
+            lib2to3.refactor.get_fixers_from_package(PACKAGE)]
+
+
+def _fixer_class(name):
+    """Return the class of the fixer `name` the way lib2to3 looks it up."""
+    module = importlib.import_module('{}.fix_{}'.format(PACKAGE, name))
+    return getattr(module, 'Fix' + ''.join(
+        part.title() for part in name.split('_')))
+
+
+def default_fixes():
+    """Return all fixers which 2to3 uses by default except `fix_next`.
+
+    The fixers which 2to3 only runs if they are requested explicitly are
+    left out, too.
+    """
+    return [name for name in available_fixes()
+            if name != 'next' and not _fixer_class(name).explicit]
+
+
+def get_fixes():
+    """Return the names of the fixers in use."""
+    global fixes
+    if fixes is None:
+        fixes = default_fixes()
+    return fixes
+
+
+def use_fixes(names=None):
+    """Use the fixers in `names`, `None` restores the default ones.
+
+    The names are the ones of the modules in `lib2to3.fixes` without the
+    `fix_` prefix, e.g. `dict`.
+    """
+    global fixes, tool
+    fixes = None if names is None else list(names)
+    tool = None
+
+
+def fix_triggers(name):
+    """Return the tokens one of which the fixer `name` needs to change an
+    expression or `None` if they are not known.
+
+    They are the names in the pattern of the fixer, which some fixers only
+    build on creation.
+    """
+    fixer = _fixer_class(name)({}, [])
+    triggers = set(RE_LITERAL.findall(fixer.PATTERN or ''))
+    triggers.update(EXTRA_TRIGGERS.get(name, ()))
+    return triggers or None
+
+
+def make_tool():
+    """Create a `RefactoringTool` using the configured fixers."""
+    modules = ['{}.fix_{}'.format(PACKAGE, name) for name in get_fixes()]
+    return lib2to3.refactor.RefactoringTool(modules, explicit=True)
+
+
+def get_tool():
+    """Return the `RefactoringTool`, it is created on first use."""
+    global tool
+    if tool is None:
+        key = tuple(sorted(get_fixes()))
+        if key not in _tools:
+            _tools[key] = make_tool()
+        tool = _tools[key]
+    return tool
+
+
+def init_worker():
+    """Let a worker process create its own `RefactoringTool` on first use."""
+    global tool
+    tool = None
+    _tools.clear()
+
+
+def fingerprint():
+    """Identify the version of lib2to3."""
+    data = '\n'.join([sys.version] + available_fixes())
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
 
 
 def rewrite_using_2to3(src, lineno, tag, filename):
     """Rewrite a python expression using 2to3.
 
-    All fixers except `fix_next` are used. This one would change `iter.next()`
-    to next(iter)`. In Zope are some objects which implement a proper `.next()`
-    without being and iterator.
+    The fixers in use are applied, by default all except `fix_next`. This one
+    would change `iter.next()` to next(iter)`. In Zope are some objects which
+    implement a proper `.next()` without being and iterator.
     """
     consolidated_src = src.lstrip()
-    tree = tool.refactor_string(consolidated_src + '\n', "<stdin>")
+    try:
+        tree = get_tool().refactor_string(consolidated_src + '\n', "<stdin>")
+    except (lib2to3.pgen2.parse.ParseError,
+            lib2to3.pgen2.tokenize.TokenError) as e:
+        raise PTParseError(
+            'Cannot parse {!r}: {}'.format(consolidated_src, e))
     result = str(tree)[:-1]
     if result == consolidated_src:
         return src  # include leading white space
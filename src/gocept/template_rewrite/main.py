@@ -1,124 +1,1193 @@
+from gocept.template_rewrite.discovery import DEFAULT_EXCLUDES
+from gocept.template_rewrite.discovery import FileFinder
+from gocept.template_rewrite.dtml import DTMLMappedRewriter
 from gocept.template_rewrite.dtml import DTMLRegexRewriter
-from gocept.template_rewrite.lib2to3 import rewrite_using_2to3
+from gocept.template_rewrite.dtml import write_chunks
+from gocept.template_rewrite.encoding import DEFAULT_ENCODING
+from gocept.template_rewrite.manifest import Manifest
 from gocept.template_rewrite.pagetemplates import PTParseError
 from gocept.template_rewrite.pagetemplates import PTParserRewriter
+from gocept.template_rewrite.pagetemplates import PTSpliceRewriter
+from gocept.template_rewrite.pagetemplates import parse_error
+from gocept.template_rewrite.stats import Stats
 import argparse
+import collections
+import contextlib
+import functools
+import gocept.template_rewrite.encoding
+import gocept.template_rewrite.engines
+import importlib
+import io
+import json
 import logging
 import os
 import os.path
 import pathlib
-import pdb  # noqa
+import queue
+import sys
+import threading
+import time
 
 
 log = logging.getLogger(__name__)
 
 
+def _names(value):
+    """Split a comma separated list of names."""
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+# Number of expressions rewritten in one call of a worker on `--batch`.
+BATCH_CHUNK_SIZE = 100
+
+# Number of files which can wait between two stages on `--pipeline`.
+PIPELINE_DEPTH = 16
+
+# The content of a file which could not be read on `--pipeline`.
+_UNREADABLE = object()
+
+# The columns of the error report, see `write_error_report`.
+ERROR_REPORT_FIELDS = ['file', 'line', 'tag', 'error']
+
+
 parser = argparse.ArgumentParser(
     description='Rewrite Python expressions in DTML and ZPT template files.')
-parser.add_argument('paths', type=str, nargs='+', metavar='path',
+parser.add_argument('paths', type=str, nargs='*', metavar='path',
                     help='paths of files which should be rewritten or '
                     'directories containing such files')
 parser.add_argument('--keep-files', action='store_true',
                     help='keep the original files, create *.out files instead')
+parser.add_argument('--check', action='store_true',
+                    help='Do not write any files, only report the files which'
+                    ' would be rewritten and exit with status 1 if there are'
+                    ' any.')
+parser.add_argument('--diff', action='store_true',
+                    help='Do not write any files, print a unified diff of the'
+                    ' changes to stdout instead.')
 parser.add_argument('--collect-errors', action='store_true',
                     help='If encountering an error, continue to collect all'
                     ' errors, print them out and only exit at the end')
+parser.add_argument('--quarantine', action='store_true',
+                    help='Keep the expressions and start tags which cannot'
+                    ' be parsed as they are, still rewrite the rest of the'
+                    ' files and replace them. Implies `--collect-errors`.'
+                    ' Files with errors are not recorded by `--incremental`,'
+                    ' so the next run only rewrites these again.')
+parser.add_argument('--error-report', type=str, default=None,
+                    metavar='FILE',
+                    help='Write the file, line, tag and message of each'
+                    ' parsing error to FILE at the end of the run, as CSV'
+                    ' if FILE ends with `.csv`, otherwise as JSON.')
 parser.add_argument('--force', choices=['pt', 'dtml'], default=None,
                     help='Treat all files as PageTemplate (pt) resp.'
                     'DocumentTemplate (dtml).')
+parser.add_argument('--splice', action='store_true',
+                    help='Copy the parts of page templates which do not'
+                    ' change instead of generating them from the parsed'
+                    ' template, which is faster for templates consisting'
+                    ' mostly of text.')
+parser.add_argument('--include', action='append', default=[],
+                    metavar='GLOB',
+                    help='Only rewrite the files in the given directories'
+                    ' matching GLOB in .gitignore syntax. Can be given'
+                    ' multiple times.')
+parser.add_argument('--exclude', action='append', default=[],
+                    metavar='GLOB',
+                    help='Skip the files and directories matching GLOB in'
+                    ' .gitignore syntax. Can be given multiple times.')
+parser.add_argument('--exclude-default', action='store_true',
+                    help='Skip the directories of version control systems,'
+                    ' tools and builds: {}.'.format(
+                        ', '.join(DEFAULT_EXCLUDES)))
+parser.add_argument('--respect-gitignore', action='store_true',
+                    help='Skip the files and directories ignored by'
+                    ' .gitignore files within the given directories.')
+parser.add_argument('--encoding', type=str, default=DEFAULT_ENCODING,
+                    metavar='ENCODING',
+                    help='Encoding of the files which do not declare one using'
+                    ' a byte order mark, `<?xml encoding>` or `<meta'
+                    ' charset>`. The files are written in their encoding.'
+                    ' (default: %(default)s)')
+parser.add_argument('--mmap', action='store_true',
+                    help='Memory map DTML files and only decode the tags'
+                    ' which might contain expressions instead of reading the'
+                    ' whole files, which keeps the memory used low for very'
+                    ' large files. Does not apply on `--diff` and'
+                    ' `--pipeline`.')
+parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                    help='Number of worker processes used for rewriting the'
+                    ' files, 1 rewrites them in the main process. The'
+                    ' `FileHandler` is passed to the workers, so it has to'
+                    ' be picklable. (default: 1)')
+parser.add_argument('--engine', type=str,
+                    default=gocept.template_rewrite.engines.DEFAULT_ENGINE,
+                    metavar='ENGINE',
+                    help='Engine rewriting the Python expressions: {} or'
+                    ' MODULE:CALLABLE. (default: %(default)s)'.format(
+                        ' or '.join(
+                            sorted(gocept.template_rewrite.engines.ENGINES))))
+parser.add_argument('--fixers', type=_names, default=None, metavar='NAMES',
+                    help='Comma separated names of the fixers of the engine'
+                    ' to use instead of the default ones.')
+parser.add_argument('--exclude-fixers', type=_names, default=[],
+                    metavar='NAMES',
+                    help='Comma separated names of fixers not to use.')
+parser.add_argument('--profile-fixers', action='store_true',
+                    help='Count the expressions changed by each fixer and'
+                    ' print the numbers to stderr. This slows down the'
+                    ' rewrite as each expression is rewritten once more per'
+                    ' fixer which might change it.')
+parser.add_argument('--cache-size', type=int, default=10000, metavar='N',
+                    help='Number of rewritten expressions kept in memory per'
+                    ' process, 0 disables the cache. (default: 10000)')
+parser.add_argument('--cache-dir', type=str, default=None, metavar='DIR',
+                    help='Store rewritten expressions in a database in DIR'
+                    ' to reuse them in later runs.')
+parser.add_argument('--incremental', action='store_true',
+                    help='Skip files which did not change since they were'
+                    ' rewritten by a previous run with the same settings.'
+                    ' Requires `--cache-dir` to store the manifest.')
+parser.add_argument('--batch', action='store_true',
+                    help='Rewrite each distinct expression only once: collect'
+                    ' the expressions of all files first, rewrite them and'
+                    ' write the files afterwards.')
+parser.add_argument('--pipeline', action='store_true',
+                    help='Read and write the files in threads while the'
+                    ' files read before are rewritten, which helps on slow'
+                    ' file systems. At most {} files are held in memory by'
+                    ' each stage.'.format(PIPELINE_DEPTH))
+parser.add_argument('--stats', action='store_true',
+                    help='Print counters and timers of the run to stderr.')
+parser.add_argument('--stats-json', type=str, default=None, metavar='FILE',
+                    help='Write counters and timers of the run in total and'
+                    ' per file as JSON to FILE.')
+parser.add_argument('--stats-hook', action='append', default=[],
+                    metavar='MODULE:CALLABLE',
+                    help='Call CALLABLE(path, counters) for each processed'
+                    ' file and CALLABLE(None, totals) at the end of the run.'
+                    ' Can be given multiple times.')
 parser.add_argument('-D', '--debug', action='store_true',
-                    help='enter debugger on errors')
+                    help='enter debugger on errors (implies `--jobs=1`)')
+
+
+# The `FileHandler` and log collector of a worker process, see `_init_worker`.
+_worker_handler = None
+_worker_log = None
+
+
+class _LogCollector(logging.Handler):
+    """Keep the log records of a worker to replay them in the main process."""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # Make the record picklable the same way `QueueHandler` does.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+    def pop_records(self):
+        records, self.records = self.records, []
+        return records
+
+
+def unified_diff(path, text, rewrite):
+    """Return the unified diff of `text` read from `path` and its rewrite."""
+    import difflib
+    lines = []
+    for line in difflib.unified_diff(
+            text.splitlines(True), rewrite.splitlines(True),
+            str(path), str(path)):
+        lines.append(line)
+        if not line.endswith('\n'):
+            lines.append('\n\\ No newline at end of file\n')
+    return ''.join(lines)
+
+
+class _OutputFile(io.TextIOBase):
+    """Write the rewrite of `text` to the file `path` unless they are equal.
+
+    The file is only created when the rewrite starts to differ from `text`,
+    `path` is `None` to write nothing at all. It is written using `encoding`.
+    If `keep` is true, a changed rewrite is kept in memory instead, see
+    `getvalue`. Call `finish` at the end.
+    """
+
+    def __init__(self, path, text, keep=False, encoding=DEFAULT_ENCODING):
+        self.path = path
+        self.text = text
+        self.keep = keep
+        self._encoding = encoding
+        self.pos = 0
+        self.changed = False
+        self.file = None
+
+    @property
+    def encoding(self):
+        return self._encoding
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if not self.changed:
+            if self.text.startswith(data, self.pos):
+                self.pos += len(data)
+                return len(data)
+            self._diverge()
+        if self.file is not None:
+            self.file.write(data)
+        return len(data)
+
+    def _diverge(self):
+        self.changed = True
+        if self.keep:
+            self.file = io.StringIO()
+        elif self.path is not None:
+            self.file = self.path.open(
+                'w', encoding=self.encoding, newline='')
+        if self.file is not None:
+            self.file.write(self.text[:self.pos])
+
+    def getvalue(self):
+        """Return the rewrite if `keep` is true."""
+        if not self.changed:
+            return self.text
+        return self.file.getvalue()
+
+    def finish(self):
+        """Close the file, return whether the rewrite differs from `text`."""
+        if not self.changed and self.pos != len(self.text):
+            self._diverge()
+        if self.file is not None and not self.keep:
+            self.file.close()
+        return self.changed
+
+    def discard(self):
+        """Remove the file after an error."""
+        if self.file is not None and not self.keep:
+            self.file.close()
+            self.path.unlink()
+
+
+class _MappedOutputFile(_OutputFile):
+    """Write the encoded rewrite of the memory mapped file `text`.
+
+    See `_OutputFile`, the rewrite cannot be kept in memory.
+    """
+
+    def write(self, data):
+        if not self.changed:
+            end = self.pos + len(data)
+            if self.text.find(data, self.pos, end) == self.pos:
+                self.pos = end
+                return len(data)
+            self._diverge()
+        if self.file is not None:
+            self.file.write(data)
+        return len(data)
+
+    def _diverge(self):
+        self.changed = True
+        if self.path is not None:
+            self.file = self.path.open('wb')
+            write_chunks(self.file, self.text, 0, self.pos)
+
+
+@contextlib.contextmanager
+def _mapped(path):
+    """Memory map the file `path` for reading.
+
+    `None` is used instead of empty files as they cannot be mapped.
+    """
+    import mmap
+    with path.open('rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield None
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def _decode_error(path, error):
+    """Report that the file `path` cannot be decoded as a parse error."""
+    log.error('Cannot decode %s using %s: %s', path, error.encoding, error)
+    raise parse_error(str(path), [{
+        'lineno': None,
+        'tag': None,
+        'error': 'Cannot decode using {}: {}'.format(error.encoding, error),
+    }])
+
+
+def _quarantined(error, result):
+    """Attach the `result` of the rewrite of a file whose parsing errors were
+    quarantined to the `PTParseError` raised for them."""
+    error.result = result
+    return error
+
+
+def write_error_report(path, errors):
+    """Write the rows of the error report to the file `path`.
+
+    They are written as CSV if `path` ends with `.csv`, otherwise as JSON.
+    """
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        if path.endswith('.csv'):
+            import csv
+            writer = csv.DictWriter(f, ERROR_REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(errors)
+        else:
+            json.dump(errors, f, indent=1)
+
+
+def _init_worker(handler):
+    """Set up a worker process of the pool."""
+    global _worker_handler, _worker_log
+    _worker_handler = handler
+    _worker_log = _LogCollector()
+    # Records are replayed by the main process, so drop handlers which might
+    # have been inherited from it.
+    logging.getLogger().handlers = [_worker_log]
+    # The statistics are passed to the main process after each call, which
+    # calls the hooks.
+    handler.stats = Stats()
+    handler.setup_rewrite()
+    gocept.template_rewrite.engines.init_worker()
+
+
+def _call_in_worker(task):
+    """Call a method of the `FileHandler` in a worker process.
+
+    Returns the result, the raised exception, the log records and the
+    statistics.
+    """
+    method, args = task
+    result = error = None
+    try:
+        result = getattr(_worker_handler, method)(*args)
+    except Exception as e:
+        error = e
+    stats, _worker_handler.stats = _worker_handler.stats, Stats()
+    return result, error, _worker_log.pop_records(), stats
+
+
+def _record(iterable, started):
+    """Yield the items of `iterable` appending them to `started`."""
+    for item in iterable:
+        started.append(item)
+        yield item
+
+
+def load_hook(name):
+    """Load a callable given as `module:callable`."""
+    module, _, attr = name.partition(':')
+    return getattr(importlib.import_module(module), attr)
 
 
 class FileHandler(object):
     """Handle the rewrite of batches of files."""
 
     def __init__(self, paths, settings):
-        self.dtml_files = []
-        self.zpt_files = []
         self.output_files = []
         self.paths = paths
+        exclude = list(settings.exclude)
+        if settings.exclude_default:
+            exclude.extend(DEFAULT_EXCLUDES)
+        self.finder = FileFinder(
+            settings.include, exclude, gitignore=settings.respect_gitignore)
         self.keep_files = settings.keep_files
-        self.collect_errors = settings.collect_errors
+        self.check = settings.check
+        self.diff = settings.diff
+        # Nothing is written on `--check` and `--diff`.
+        self.dry_run = self.check or self.diff
+        self.quarantine = settings.quarantine
+        self.collect_errors = settings.collect_errors or self.quarantine
+        self.error_report = settings.error_report
         self.force_type = settings.force
+        self.encoding = settings.encoding
+        self.mmap = settings.mmap
+        self.pt_rewriter = (
+            PTSpliceRewriter if settings.splice else PTParserRewriter)
+        # The debugger can only be used in the main process.
+        self.jobs = 1 if settings.debug else max(settings.jobs, 1)
+        self.engine = settings.engine
+        self.fixers = settings.fixers
+        self.exclude_fixers = settings.exclude_fixers
+        self.profile_fixers = settings.profile_fixers
+        self.cache_size = settings.cache_size
+        self.cache_dir = settings.cache_dir
+        self.batch = settings.batch
+        self.pipeline = settings.pipeline
+        # Rewrites of all expressions of a batch, see `process_batch`.
+        self.batch_rewrites = None
+        self.manifest = None
+        if settings.incremental:
+            self.manifest = Manifest(
+                pathlib.Path(self.cache_dir, 'manifest.json'),
+                self.rewrite_settings())
+        # (path, rewriter) of the files in `output_files`
+        self.rewritten_files = []
+        self.stats = Stats()
+        for hook in settings.stats_hook:
+            self.stats.add_hook(load_hook(hook))
+        self.show_stats = settings.stats
+        self.stats_json = settings.stats_json
         self.errors = False
+        # The rows of the error report, see `_check_error`.
+        self.parse_errors = []
 
     def __call__(self):
-        for path in self.paths:
-            self.collect_files(pathlib.Path(path))
-        self.process_files()
-        if self.errors:
-            log.error('Encountered errors, skipping file replacement.')
-            return
-        if not self.keep_files:
-            self.replace_files()
+        with self.stats.timer('total'):
+            self.setup_rewrite()
+            self.process_files()
+            totals = self.stats.totals
+            log.warning(
+                'Processed %d files, %d of them without expressions.',
+                totals['files'], totals['skipped'])
+            if self.errors and not self.quarantine:
+                log.error('Encountered errors, skipping file replacement.')
+            elif self.dry_run:
+                log.warning(
+                    '%d files would be rewritten.', totals['files_changed'])
+            else:
+                if not self.keep_files:
+                    with self.stats.timer('replace'):
+                        self.replace_files()
+                if self.manifest is not None:
+                    self.update_manifest()
+            if self.error_report is not None:
+                write_error_report(self.error_report, self.parse_errors)
+        self.report_stats()
 
     def rewrite_action(self, input_string, *args, **kwargs):
-        """Use `rewrite_using_2to3` as default action.
+        """Use the engine selected by `--engine` as default action.
 
         Can be overwritten in subclass.
         """
-        return rewrite_using_2to3(input_string, *args, **kwargs)
+        return gocept.template_rewrite.engines.rewrite(
+            input_string, *args, **kwargs)
 
-    def collect_files(self, path):
-        if path.is_dir():
-            for root, dirs, files in os.walk(str(path)):
-                for file_ in files:
-                    self._classify_file(pathlib.Path(root, file_))
-        else:
-            self._classify_file(path)
+    def setup_rewrite(self):
+        """Configure `rewrite_action` in the current process.
+
+        Can be extended in subclass.
+        """
+        gocept.template_rewrite.engines.use_engine(self.engine)
+        gocept.template_rewrite.engines.use_fixes(
+            self.fixers, self.exclude_fixers)
+        gocept.template_rewrite.engines.expression_cache.resize(
+            self.cache_size)
+        gocept.template_rewrite.engines.open_persistent_cache(self.cache_dir)
+
+    def rewrite_settings(self):
+        """Describe the configuration which influences the rewrite result.
+
+        Can be extended in subclass.
+        """
+        # Importing `pkg_resources` is slow, so only do it when needed.
+        import pkg_resources
+        return {
+            'version': pkg_resources.get_distribution(
+                'gocept.template_rewrite').version,
+            'fingerprint': gocept.template_rewrite.engines.fingerprint(
+                self.engine, self.fixers, self.exclude_fixers),
+            'keep_files': self.keep_files,
+            'encoding': self.encoding,
+        }
+
+    def find_files(self):
+        """Yield the files to rewrite and their rewriters.
+
+        The files are found while they are rewritten, the time spent finding
+        them is the `collect` timer.
+        """
+        paths = self.stats.timed(self.finder.find(self.paths), 'collect')
+        for path in paths:
+            rewriter = self._classify_file(path)
+            if rewriter is not None:
+                yield pathlib.Path(path), rewriter
+        if self.finder.pruned:
+            log.warning(
+                'Skipped %d excluded or ignored files and directories.',
+                self.finder.pruned)
 
     def _classify_file(self, path):
+        """Return the rewriter for the file `path` or `None`."""
         if self.force_type == 'dtml':
-            self.dtml_files.append(path)
-        elif self.force_type == 'pt':
-            self.zpt_files.append(path)
-        elif path.suffix in ('.dtml', '.sql'):
-            self.dtml_files.append(path)
-        elif path.suffix in ('.pt', '.xpt', '.html'):
-            self.zpt_files.append(path)
-
-    def _process_file(self, path, rewriter):
-        """Process one file."""
+            return DTMLRegexRewriter
+        if self.force_type == 'pt':
+            return self.pt_rewriter
+        suffix = os.path.splitext(path)[1]
+        if suffix in ('.dtml', '.sql'):
+            return DTMLRegexRewriter
+        if suffix in ('.pt', '.xpt', '.html'):
+            return self.pt_rewriter
+        return None
+
+    def rewrite_file(self, path, rewriter):
+        """Rewrite one file into a `*.out` file next to it.
+
+        Return the path of the output file, `path` itself if there is nothing
+        to replace as the rewrite equals the file or on `--check`, or `None`
+        if the file could not be read. A `PTParseError` is raised if the file
+        could not be parsed. On `--diff` the unified diff of the changes is
+        returned instead of a path, it is empty if there are none.
+        """
         log.warning('Processing %s', path)
+        counters = collections.Counter()
+        cache = gocept.template_rewrite.engines.expression_cache
+        hits, misses = cache.hits, cache.misses
         try:
-            rw = rewriter(
-                path.read_text(), self.rewrite_action, filename=str(path))
-        except UnicodeDecodeError:  # pragma: no cover
-            log.error('Error', exc_info=True)
-        else:
+            return self._rewrite_file(path, rewriter, counters)
+        finally:
+            counters['cache_hits'] += cache.hits - hits
+            counters['cache_misses'] += cache.misses - misses
+            self.stats.add_file(path, counters)
+
+    def _rewrite_file(self, path, rewriter, counters):
+        with contextlib.ExitStack() as stack:
+            output_class = _OutputFile
+            with self.stats.timer('read', counters):
+                data = None
+                if self._maps(rewriter):
+                    data = stack.enter_context(_mapped(path))
+                if data is not None:
+                    encoding = gocept.template_rewrite.encoding.detect(
+                        data, self.encoding)
+                    # The tags can only be found in the bytes if the
+                    # encoding is compatible with ASCII.
+                    if not gocept.template_rewrite.encoding.\
+                            is_ascii_compatible(encoding):
+                        data = None
+                if data is None:
+                    text, encoding = self._read(path, counters)
+                else:
+                    text = data
+                    rewriter = functools.partial(
+                        DTMLMappedRewriter, encoding=encoding)
+                    output_class = _MappedOutputFile
             try:
-                result = rw()
-            except PTParseError:
-                self.errors = True
-                if self.collect_errors:
-                    return
+                return self._write_rewrite(
+                    path, rewriter, text, counters, output_class, encoding)
+            except UnicodeDecodeError as e:
+                _decode_error(path, e)
+
+    def _read(self, path, counters):
+        """Return the text of the file `path` and its encoding."""
+        try:
+            return gocept.template_rewrite.encoding.decode(
+                path.read_bytes(), self.encoding)
+        except UnicodeDecodeError as e:
+            counters['files'] += 1
+            _decode_error(path, e)
+
+    def _maps(self, rewriter):
+        """Tell whether to memory map the files of `rewriter`."""
+        return self.mmap and rewriter is DTMLRegexRewriter and not self.diff
+
+    def _write_rewrite(self, path, rewriter, text, counters, output_class,
+                       encoding):
+        """Write the rewrite of `text` read from `path` like `rewrite_file`.
+
+        `output_class` is the one of the output file, which is written using
+        `encoding` like the file.
+        """
+        rw = rewriter(text, self._file_action(counters), filename=str(path))
+        counters['files'] += 1
+        counters['bytes_read'] += path.stat().st_size
+        if not rw.needs_rewrite:
+            counters['skipped'] += 1
+        # Write to a temporary file first, so there is no partial output
+        # file if the rewrite fails.
+        file_out = pathlib.Path(str(path) + '.out')
+        file_tmp = pathlib.Path(str(file_out) + '.tmp')
+        output = output_class(
+            None if self.dry_run else file_tmp, text, keep=self.diff,
+            encoding=encoding)
+        error = None
+        try:
+            with self.stats.timer('parse', counters):
+                error = self._rewrite(rw, output)
+                changed = output.finish()
+        except BaseException:
+            output.discard()
+            raise
+        finally:
+            # The time spent in `action` is measured separately.
+            counters['time.parse'] -= counters['time.rewrite']
+            gocept.template_rewrite.engines.flush_persistent_cache()
+        result = self._finish_write(
+            path, text, output, changed, file_tmp, file_out, counters)
+        if error is not None:
+            raise _quarantined(error, result)
+        return result
+
+    def _finish_write(self, path, text, output, changed, file_tmp, file_out,
+                      counters):
+        """Move the rewrite written to `file_tmp` to `file_out` and return
+        the result of `rewrite_file`."""
+        if not changed:
+            return '' if self.diff else path
+        counters['files_changed'] += 1
+        if self.dry_run:
+            log.warning('Would rewrite %s', path)
+            if self.diff:
+                return unified_diff(path, text, output.getvalue())
+            return path
+        with self.stats.timer('write', counters):
+            file_tmp.replace(file_out)
+        counters['bytes_written'] += file_out.stat().st_size
+        return file_out
+
+    def _rewrite(self, rw, output):
+        """Write the rewrite of the rewriter `rw` to `output`.
+
+        On `--quarantine` the `PTParseError` for the parts which cannot be
+        parsed is returned instead of being raised, they are kept as they are
+        in the rewrite.
+        """
+        try:
+            rw(output)
+        except PTParseError as e:
+            if not self.quarantine:
                 raise
+            return e
+        return None
+
+    def rewrite_text(self, path, rewriter, text, counters):
+        """Rewrite `text` read from the file `path` on `--pipeline`.
+
+        Return the rewrite and `counters` which were updated, the file is
+        written by the main process. The rewrite is `None` if it equals
+        `text` or on `--check`. On `--diff` the unified diff of the changes
+        is returned instead.
+        """
+        log.warning('Processing %s', path)
+        cache = gocept.template_rewrite.engines.expression_cache
+        hits, misses = cache.hits, cache.misses
+        rw = rewriter(text, self._file_action(counters), filename=str(path))
+        if not rw.needs_rewrite:
+            counters['skipped'] += 1
+        output = io.StringIO()
+        try:
+            with self.stats.timer('parse', counters):
+                error = self._rewrite(rw, output)
+        finally:
+            counters['time.parse'] -= counters['time.rewrite']
+            counters['cache_hits'] += cache.hits - hits
+            counters['cache_misses'] += cache.misses - misses
+            gocept.template_rewrite.engines.flush_persistent_cache()
+        result = self._finish_text(path, text, output.getvalue(), counters)
+        if error is not None:
+            raise _quarantined(error, result)
+        return result
+
+    def _finish_text(self, path, text, rewrite, counters):
+        """Return the result of `rewrite_text` for the `rewrite` of `text`.
+        """
+        if rewrite == text:
+            return ('' if self.diff else None), counters
+        counters['files_changed'] += 1
+        if self.dry_run:
+            log.warning('Would rewrite %s', path)
+            if self.diff:
+                return unified_diff(path, text, rewrite), counters
+            return None, counters
+        return rewrite, counters
+
+    def _file_action(self, counters):
+        """Return the instrumented action to rewrite the expressions of a
+        file."""
+        action = self.rewrite_action
+        if self.batch_rewrites is not None:
+            action = self._batch_action
+        return self._instrument(action, counters)
+
+    def _instrument(self, action, counters):
+        """Wrap `action` to count and time the rewritten expressions."""
+        def instrumented(input_string, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = action(input_string, *args, **kwargs)
+            finally:
+                counters['time.rewrite'] += time.perf_counter() - start
+            counters['expressions'] += 1
+            if result != input_string:
+                counters['expressions_changed'] += 1
+            if self.profile_fixers:
+                fired = gocept.template_rewrite.engines.fired_fixes(
+                    input_string)
+                for name in fired:
+                    counters['fixer.' + name] += 1
+            return result
+        return instrumented
+
+    def _map(self, method, tasks):
+        """Call `method` with each of the argument tuples in `tasks`.
+
+        Yields tuples of the result and the raised exception in the order of
+        `tasks`. If `self.jobs` is greater than one, the calls are done in a
+        pool of worker processes. Their log records are replayed, so logging
+        is the same as in a serial run. Tasks which are not a list, like the
+        files while they are found, are consumed by the current thread, see
+        `_submit`.
+        """
+        if not self._use_pool(tasks):
+            for args in tasks:
+                try:
+                    yield getattr(self, method)(*args), None
+                except Exception as e:
+                    yield None, e
+            return
+        with self._make_pool() as pool:
+            if isinstance(tasks, list):
+                chunksize = max(1, len(tasks) // (self.jobs * 4))
+                results = pool.imap(
+                    _call_in_worker, ((method, args) for args in tasks),
+                    chunksize)
+            else:
+                results = self._submit(pool, method, tasks)
+            for result, error, records, stats in results:
+                for record in records:
+                    logging.getLogger(record.name).handle(record)
+                self.stats.merge(stats)
+                yield result, error
+
+    def _submit(self, pool, method, tasks):
+        """Call `method` with the argument tuples in `tasks` in `pool`.
+
+        Yields the results of `_call_in_worker` in the order of `tasks`. The
+        tasks are consumed in the current thread, at most `PIPELINE_DEPTH`
+        of them ahead of the results.
+        """
+        pending = collections.deque()
+        for args in tasks:
+            pending.append(pool.apply_async(
+                _call_in_worker, ((method, args),)))
+            if len(pending) >= PIPELINE_DEPTH:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def _make_pool(self):
+        """Return a pool of `self.jobs` worker processes."""
+        # Importing `multiprocessing` is slow, so only do it when needed.
+        import multiprocessing
+        return multiprocessing.Pool(
+            self.jobs, initializer=_init_worker, initargs=(self,))
+
+    def _use_pool(self, tasks):
+        """Tell whether to use worker processes for `tasks`.
+
+        The number of tasks is only known if they are a list.
+        """
+        if self.jobs == 1:
+            return False
+        return not isinstance(tasks, list) or len(tasks) > 1
+
+    def _pipeline(self, tasks):
+        """Rewrite the files of `tasks` while reading and writing others.
+
+        A thread reads the files and another one writes the rewrites to
+        `*.out` files, while they are rewritten like in `_map`. The stages
+        are connected by queues of `PIPELINE_DEPTH` files, so a stage waits
+        if the next one falls behind. Yields the path of the output file and
+        the raised exception in the order of `tasks`, on `--diff` the diff
+        instead of the path like `rewrite_file`. The written files are passed
+        back, so only the current thread updates `self.stats` and calls the
+        hooks.
+        """
+        pool = None
+        if self._use_pool(tasks):
+            # Start the workers before the threads, so they do not inherit
+            # locks held by them.
+            pool = self._make_pool()
+        read_queue = queue.Queue(PIPELINE_DEPTH)
+        write_queue = queue.Queue(PIPELINE_DEPTH)
+        written = queue.Queue()
+        stop = threading.Event()
+        write_errors = []
+        # The encodings of the files read in the order of `read_queue`.
+        encodings = collections.deque()
+        reader = threading.Thread(
+            target=self._read_files,
+            args=(tasks, read_queue, stop, encodings), daemon=True)
+        writer = threading.Thread(
+            target=self._write_files,
+            args=(write_queue, written, write_errors), daemon=True)
+        reader.start()
+        writer.start()
+        try:
+            for path, text, counters, error in self._rewrite_texts(
+                    iter(read_queue.get, None), pool):
+                self._add_written(written)
+                encoding = encodings.popleft()
+                quarantined = getattr(error, 'result', None)
+                if quarantined is not None:
+                    text, counters = quarantined
+                elif text is _UNREADABLE or error is not None:
+                    self.stats.add_file(path, counters)
+                    yield None, error
+                    continue
+                if text is None or self.diff:
+                    self.stats.add_file(path, counters)
+                    result = text if self.diff else path
+                else:
+                    write_queue.put((path, text, encoding, counters))
+                    result = pathlib.Path(str(path) + '.out')
+                if error is None:
+                    yield result, None
+                else:
+                    yield None, _quarantined(error, result)
+        finally:
+            stop.set()
+            while reader.is_alive():
+                try:
+                    read_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            write_queue.put(None)
+            writer.join()
+            self._add_written(written)
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        if write_errors:
+            raise write_errors[0]
+
+    def _read_files(self, tasks, read_queue, stop, encodings):
+        """Put the content of the files of `tasks` into `read_queue` and
+        their encodings into `encodings`.
+
+        The content is `_UNREADABLE` if the file could not be read, the error
+        is passed along.
+        """
+        for path, rewriter in tasks:
+            if stop.is_set():
+                return
+            counters = collections.Counter()
+            text, encoding, error = _UNREADABLE, None, None
+            try:
+                with self.stats.timer('read', counters):
+                    text, encoding = self._read(path, counters)
+                counters['files'] += 1
+                counters['bytes_read'] += path.stat().st_size
+            except Exception as e:
+                error = e
+            encodings.append(encoding)
+            read_queue.put((path, rewriter, text, counters, error))
+        read_queue.put(None)
+
+    def rewrite_texts(self, tasks):
+        """Rewrite the texts given as argument tuples of `rewrite_text`.
+
+        Yields the path, the rewrite, the counters and the raised exception
+        in the order of `tasks`, which are consumed while the texts are
+        rewritten. If `self.jobs` is greater than one, the texts are
+        rewritten in a pool of worker processes, at most `PIPELINE_DEPTH` at
+        once.
+        """
+        pool = None
+        if self._use_pool(tasks):
+            pool = self._make_pool()
+        try:
+            yield from self._rewrite_texts(
+                ((path, rewriter, text, counters, None)
+                 for path, rewriter, text, counters in tasks), pool)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def _rewrite_texts(self, items, pool):
+        """Rewrite the contents of `items` read by `_read_files` using the
+        worker processes of `pool` if there is one.
+
+        Yields the path, the rewrite, the counters and the raised exception
+        in the order of `items`.
+        """
+        pending = collections.deque()
+        for path, rewriter, text, counters, error in items:
+            if text is _UNREADABLE:
+                pending.append((path, counters, text, error))
+            elif pool is None:
+                try:
+                    text, counters = self.rewrite_text(
+                        path, rewriter, text, counters)
+                except Exception as e:
+                    text, error = None, e
+                pending.append((path, counters, text, error))
+            else:
+                pending.append((path, counters, None, None, pool.apply_async(
+                    _call_in_worker,
+                    (('rewrite_text', (path, rewriter, text, counters)),))))
+            while len(pending) > (0 if pool is None else PIPELINE_DEPTH):
+                yield self._finish_rewrite(*pending.popleft())
+        while pending:
+            yield self._finish_rewrite(*pending.popleft())
 
+    def _finish_rewrite(self, path, counters, result, error,
+                        async_result=None):
+        """Wait for the rewrite of a file if it is done by a worker, which
+        returns `async_result`."""
+        if async_result is not None:
+            result, error, records, stats = async_result.get()
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+            self.stats.merge(stats)
+            if result is not None:
+                result, counters = result
+        return path, result, counters, error
+
+    def _add_written(self, written):
+        """Store the counters of the files in `written` by `_write_files`."""
+        while True:
+            try:
+                path, counters = written.get_nowait()
+            except queue.Empty:
+                return
+            self.stats.add_file(path, counters)
+
+    def _write_files(self, write_queue, written, write_errors):
+        """Write the rewrites in `write_queue` to `*.out` files and put the
+        paths and counters of the files into `written`.
+
+        Stops writing on the first error, which is stored in `write_errors`.
+        """
+        for path, text, encoding, counters in iter(write_queue.get, None):
+            if write_errors:
+                continue
             file_out = pathlib.Path(str(path) + '.out')
-            file_out.write_text(result, encoding='utf-8')
-            self.output_files.append(file_out)
+            file_tmp = pathlib.Path(str(file_out) + '.tmp')
+            try:
+                with self.stats.timer('write', counters):
+                    with file_tmp.open(
+                            'w', encoding=encoding, newline='') as output:
+                        output.write(text)
+                    file_tmp.replace(file_out)
+                counters['bytes_written'] += file_out.stat().st_size
+            except Exception as e:
+                write_errors.append(e)
+            written.put((path, counters))
+
+    def _check_error(self, error):
+        """Raise `error` unless it is a parse error to be collected.
+
+        Returns whether there was an error. The locations of parse errors are
+        added to the rows of the error report.
+        """
+        if error is None:
+            return False
+        if isinstance(error, PTParseError):
+            self.errors = True
+            for err in error.errors or [
+                    {'lineno': error.lineno, 'tag': None,
+                     'error': str(error)}]:
+                self.parse_errors.append({
+                    'file': error.filename,
+                    'line': err['lineno'],
+                    'tag': err['tag'],
+                    'error': err['error'],
+                })
+            if self.collect_errors:
+                return True
+        raise error
 
     def process_files(self):
-        """Process all collected files."""
-        for file_ in self.dtml_files:
-            self._process_file(file_, DTMLRegexRewriter)
-        for file_ in self.zpt_files:
-            self._process_file(file_, PTParserRewriter)
+        """Process the files while they are found.
+
+        On `--batch` all files are found before as they are read twice.
+        """
+        tasks = self.find_files()
+        if self.manifest is not None:
+            tasks = ((file_, rewriter) for file_, rewriter in tasks
+                     if not self._is_unchanged(file_, rewriter))
+        if self.batch or not any(map(os.path.isdir, self.paths)):
+            tasks = list(tasks)
+        if self.batch:
+            self.process_batch(tasks)
+        if isinstance(tasks, list):
+            started = collections.deque(tasks)
+        else:
+            # The tasks are consumed while the results are computed, remember
+            # them until their result is there.
+            started = collections.deque()
+            tasks = _record(tasks, started)
+        if self.pipeline:
+            results = self._pipeline(tasks)
+        else:
+            results = self._map('rewrite_file', tasks)
+        # Close the results on an error, so the workers and threads stop.
+        with contextlib.closing(results):
+            for file_out, error in results:
+                file_, rewriter = started.popleft()
+                if self._check_error(error):
+                    # On `--quarantine` the rest of the file was rewritten.
+                    file_out = getattr(error, 'result', None)
+                if file_out is None:
+                    continue
+                if self.diff:
+                    # Print the diffs in the order of the files while they
+                    # are rewritten.
+                    sys.stdout.write(file_out)
+                    sys.stdout.flush()
+                    file_out = file_
+                if file_out != file_:
+                    self.output_files.append(file_out)
+                if error is None:
+                    self.rewritten_files.append((file_, rewriter))
+
+    def collect_expressions(self, path, rewriter):
+        """Return the set of the expressions in one file."""
+        with contextlib.ExitStack() as stack:
+            try:
+                data = None
+                if self._maps(rewriter):
+                    data = stack.enter_context(_mapped(path))
+                if data is not None:
+                    encoding = gocept.template_rewrite.encoding.detect(
+                        data, self.encoding)
+                    if gocept.template_rewrite.encoding.is_ascii_compatible(
+                            encoding):
+                        return set(DTMLMappedRewriter(
+                            data, None, filename=str(path),
+                            encoding=encoding).collect_expressions())
+                text, encoding = gocept.template_rewrite.encoding.decode(
+                    path.read_bytes(), self.encoding)
+                rw = rewriter(text, None, filename=str(path))
+                return set(rw.collect_expressions())
+            except UnicodeDecodeError:
+                # It gets reported on rewrite.
+                return set()
+
+    def rewrite_expressions(self, expressions):
+        """Return a dict mapping the expressions to their rewrite.
+
+        Expressions which cannot be rewritten are left out, they are rewritten
+        again with their location later on to report the error.
+        """
+        rewrites = {}
+        for src in expressions:
+            try:
+                rewrites[src] = self.rewrite_action(
+                    src, lineno=None, tag=None, filename=None)
+            except Exception:
+                pass
+        return rewrites
+
+    def _batch_action(self, input_string, *args, **kwargs):
+        try:
+            return self.batch_rewrites[input_string]
+        except KeyError:
+            return self.rewrite_action(input_string, *args, **kwargs)
+
+    def process_batch(self, tasks):
+        """Rewrite all the expressions in the files of `tasks` at once.
+
+        The rewrites are stored in `batch_rewrites`.
+        """
+        expressions = set()
+        with self.stats.timer('batch_collect'):
+            results = self._map('collect_expressions', tasks)
+            for file_expressions, error in results:
+                self._check_error(error)
+                expressions.update(file_expressions)
+        log.warning('Rewriting %d distinct expressions.', len(expressions))
+        self.stats.counters['batch_expressions'] += len(expressions)
+        expressions = sorted(expressions)
+        chunks = [(expressions[i:i + BATCH_CHUNK_SIZE],)
+                  for i in range(0, len(expressions), BATCH_CHUNK_SIZE)]
+        self.batch_rewrites = {}
+        with self.stats.timer('batch_rewrite'):
+            for rewrites, error in self._map('rewrite_expressions', chunks):
+                self._check_error(error)
+                self.batch_rewrites.update(rewrites)
+
+    def report_stats(self):
+        """Pass the statistics to the hooks, print and dump them."""
+        self.stats.finish()
+        if self.show_stats:
+            print(self.stats.report(), file=sys.stderr)
+        if self.profile_fixers:
+            print(self.fixer_report(), file=sys.stderr)
+        if self.stats_json is not None:
+            self.stats.dump(self.stats_json)
+
+    def fixer_report(self):
+        """Return the number of expressions changed by each fixer in use."""
+        totals = self.stats.totals
+        fixers = gocept.template_rewrite.engines.select_fixes(
+            self.engine, self.fixers, self.exclude_fixers) or []
+        counts = sorted(
+            ((totals['fixer.' + name], name) for name in fixers),
+            key=lambda item: (-item[0], item[1]))
+        width = max([len(name) for name in fixers] + [0])
+        lines = ['Expressions changed by each fixer:']
+        for count, name in counts:
+            lines.append('{:<{}}  {:>12}'.format(name, width, count))
+        return '\n'.join(lines)
+
+    def _is_unchanged(self, path, rewriter):
+        if self.manifest.is_unchanged(path, rewriter.__name__):
+            log.info('Skipping unchanged %s', path)
+            return True
+        return False
 
     def replace_files(self):
-        for path in self.output_files:
-            path.rename(path.parent / path.stem)
+        if not self.pipeline:
+            for path in self.output_files:
+                self._replace_file(path)
+            return
+        # Renaming waits for the file system, so do it in threads.
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(PIPELINE_DEPTH) as pool:
+            list(pool.map(self._replace_file, self.output_files))
+
+    def _replace_file(self, path):
+        path.rename(path.parent / path.stem)
+
+    def update_manifest(self):
+        """Store the state of the rewritten files in the manifest."""
+        for path, rewriter in self.rewritten_files:
+            self.manifest.update(path, rewriter.__name__)
+        self.manifest.save()
 
 
 def main(args=None):
     """Act as an entry point."""
     args = parser.parse_args(args)
+    # The paths are optional for the defaults used by `api.rewrite_many`.
+    if not args.paths:
+        parser.error('the following arguments are required: path')
+    if args.incremental and args.cache_dir is None:
+        parser.error('`--incremental` requires `--cache-dir`')
+    if not gocept.template_rewrite.encoding.is_known(args.encoding):
+        parser.error('Unknown encoding {!r}'.format(args.encoding))
+    try:
+        gocept.template_rewrite.engines.load_engine(args.engine)
+    except (ImportError, AttributeError, ValueError) as e:
+        parser.error('Cannot load engine {!r}: {}'.format(args.engine, e))
+    if args.fixers is not None or args.exclude_fixers:
+        try:
+            gocept.template_rewrite.engines.select_fixes(
+                args.engine, args.fixers, args.exclude_fixers)
+        except ValueError as e:
+            parser.error(str(e))
     fh = FileHandler(args.paths, args)
     try:
         fh()
     except Exception:  # pragma: no cover
         if args.debug:
+            import pdb
             pdb.post_mortem()
         raise
+    if args.check and fh.stats.totals['files_changed']:
+        return 1
     return 1 if fh.errors else 0
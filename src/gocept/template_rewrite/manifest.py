@@ -0,0 +1,80 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+
+
+log = logging.getLogger(__name__)
+
+
+def file_hash(path):
+    """Return the SHA-256 hex digest of the content of `path`."""
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+class Manifest(object):
+    """Remember the state of files after a successful rewrite.
+
+    The manifest is stored as JSON at `path`. It is only valid for the same
+    `settings`, a dict describing the rewrite configuration. Entries are
+    keyed by the absolute path of the file.
+    """
+
+    def __init__(self, path, settings):
+        self.path = pathlib.Path(path)
+        self.settings = settings
+        self.entries = {}
+        self._load()
+
+    def _load(self):
+        try:
+            data = json.loads(self.path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return
+        except ValueError:
+            log.warning('Ignoring broken manifest %s', self.path)
+            return
+        if data.get('settings') == self.settings:
+            self.entries = data['files']
+
+    @staticmethod
+    def _key(path):
+        return os.path.abspath(str(path))
+
+    def is_unchanged(self, path, rewriter):
+        """Tell whether `path` is unchanged since it was rewritten."""
+        entry = self.entries.get(self._key(path))
+        if entry is None or entry['rewriter'] != rewriter:
+            return False
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return False
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime_ns == entry['mtime_ns']:
+            return True
+        # The file was touched, so only the content can tell.
+        if file_hash(path) != entry['sha256']:
+            return False
+        entry['mtime_ns'] = stat.st_mtime_ns
+        return True
+
+    def update(self, path, rewriter):
+        """Store the current state of `path`."""
+        stat = path.stat()
+        self.entries[self._key(path)] = {
+            'rewriter': rewriter,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': file_hash(path),
+        }
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        tmp.write_text(json.dumps(
+            {'settings': self.settings, 'files': self.entries},
+            indent=1, sort_keys=True), encoding='utf-8')
+        tmp.replace(self.path)
@@ -4,9 +4,9 @@ import collections
 import functools
 import html.parser
 import io
-import lib2to3.pgen2.parse
 import logging
 import re
+import sys
 
 
 log = logging.getLogger(__name__)
@@ -16,8 +16,17 @@ RE_MULTI_ATTRIBUTES = (r'(?P<before>python:)(?P<expr>[^;]*)(?P<end>;|\Z)')
 # [\w\W] matches any symbol including newlines
 RE_SINGLE_ATTRIBUTES = (r'(?P<before>python:)(?P<expr>[\w\W]*)(?P<end>)')
 
+# The parser can only change the input if it contains one of: a Python
+# expression, a single quoted attribute or a comment with a double hyphen.
+RE_NEEDS_REWRITE = re.compile(r"python:|='|<!--(?:(?!--)[\w\W])*--(?!>)")
+
 DOUBLE_SEMICOLON_REPLACEMENT = '_)_replacement_☃_(_'
 
+# An attribute of a start tag: the name including the preceding whitespace,
+# the name and the raw value in double resp. single quotes if there is one.
+RE_ATTRIBUTE = re.compile(r'''(\s+([^\s/>=]+))(?:="([^"]*)"|='([^']*)')?''')
+RE_TAG_END = re.compile(r'\s*/?>$')
+
 # This prevents collision with attribute names.
 ENDTAG = '>endtag<'
 
@@ -25,7 +34,34 @@ ENDTAG = '>endtag<'
 class PTParseError(SyntaxError):
     """Error while parsing a page template.
 
-    Should be raised by rewrite_action on error."""
+    Should be raised by rewrite_action on error. The rewriters raise it after
+    the whole input was rewritten, the parts which cannot be parsed are kept
+    as they are. `errors` lists them as dicts of the `lineno`, the `tag` and
+    the `error` message.
+    """
+
+    errors = ()
+
+
+def action_errors():
+    """Return the exceptions a rewrite action raises on parse errors.
+
+    Besides `PTParseError` it is the `ParseError` of lib2to3 if it is
+    imported, which it is not unless an engine or action uses it.
+    """
+    parse = sys.modules.get('lib2to3.pgen2.parse')
+    if parse is None:
+        return PTParseError
+    return (PTParseError, parse.ParseError)
+
+
+def parse_error(filename, errors):
+    """Return the `PTParseError` for the parsing `errors` in `filename`."""
+    error = PTParseError(
+        '{} parsing error(s)'.format(len(errors)),
+        (filename, None, None, None))
+    error.errors = errors
+    return error
 
 
 class PythonExpressionFilter(saxutils.XMLFilterBase):
@@ -44,27 +80,41 @@ class PythonExpressionFilter(saxutils.XMLFilterBase):
             match_ob.group('end'),
         ])
 
+    def _rewrite(self, expr, lineno, tag, filename):
+        """Return the rewrite of `expr`.
+
+        An expression which cannot be parsed is kept and recorded in the
+        `parse_errors` of the parser.
+        """
+        try:
+            return self.rewrite_action(
+                expr,
+                lineno=lineno,
+                tag=tag,
+                filename=filename,
+            )
+        except action_errors() as e:
+            self._parent.parse_errors.append({
+                'lineno': lineno,
+                'tag': tag,
+                'error': str(e),
+            })
+            return expr
+
     def _rewrite_single_expression(self, match_ob, lineno, tag, filename):
         """Handle the match object of a single expression."""
-        replaced_value = self.rewrite_action(
-            match_ob.group('expr'),
-            lineno=lineno,
-            tag=tag,
-            filename=filename,
-        )
+        replaced_value = self._rewrite(
+            match_ob.group('expr'), lineno, tag, filename)
         return self._join_expression(replaced_value, match_ob)
 
     def _rewrite_multi_expression(self, match_ob, lineno, tag, filename):
         """Handle the match object of a multi expression."""
         # Turn the replacement to regular python after matching, before passing
         # it to the rewrite hook.
-        unquoted_value = self.rewrite_action(
+        unquoted_value = self._rewrite(
             match_ob.group('expr').replace(
                 DOUBLE_SEMICOLON_REPLACEMENT, ';'),
-            lineno=lineno,
-            tag=tag,
-            filename=filename,
-        )
+            lineno, tag, filename)
         # We have to escape the semicolon in python for pagetemplates
         quoted_value = unquoted_value.replace(';', ';;')
         return self._join_expression(quoted_value, match_ob)
@@ -78,9 +128,16 @@ class PythonExpressionFilter(saxutils.XMLFilterBase):
         else:
             return False
 
-    def startElement(self, name, attrs, ws_dict, is_short_tag, lineno):
-        """Rewrite the attributes at the start of an element."""
-        attrs = collections.OrderedDict(attrs)
+    def startElement(self, name, attrs, ws_dict, is_short_tag, lineno,
+                     text, spans):
+        """Rewrite the attributes at the start of an element.
+
+        `text` is the start tag as found in the input, it is passed as `tag`
+        to the rewrite action. `spans` maps the attributes to the positions
+        of their values in `text` if these can be replaced there, otherwise
+        it is `None` and the start tag is synthesized from `attrs`.
+        """
+        changed = []
         for attr, value in attrs.items():
             if name.startswith('tal:') or attr.startswith('tal:'):
                 if self._is_multi_expression(name, attr):
@@ -91,24 +148,32 @@ class PythonExpressionFilter(saxutils.XMLFilterBase):
                     rewrite_expression = self._rewrite_single_expression
 
                 if value is None:
-                    raise PTParseError
+                    raise PTParseError(
+                        'Attribute {!r} has no value'.format(attr))
 
-                value = value.replace(';;', DOUBLE_SEMICOLON_REPLACEMENT)
+                quoted = value.replace(';;', DOUBLE_SEMICOLON_REPLACEMENT)
 
-                tag = join_element(name, attrs, ws_dict)
                 rewrite_expression = functools.partial(
-                    rewrite_expression, lineno=lineno, tag=tag,
+                    rewrite_expression, lineno=lineno, tag=text,
                     filename=self.filename)
 
                 rewritten_value = re.sub(
-                    zpt_regex, rewrite_expression, value)
+                    zpt_regex, rewrite_expression, quoted)
 
                 # We want to undo the replacement also in cases the regex did
                 # not match.
-                attrs[attr] = rewritten_value.replace(
+                rewritten_value = rewritten_value.replace(
                     DOUBLE_SEMICOLON_REPLACEMENT, ';;')
-
-        self._cont_handler.startElement(name, attrs, ws_dict, is_short_tag)
+                if rewritten_value != value:
+                    attrs[attr] = rewritten_value
+                    changed.append(attr)
+
+        if spans is None:
+            text = None
+        elif changed:
+            text = splice_attributes(text, spans, attrs, changed)
+        self._cont_handler.startElement(
+            name, attrs, ws_dict, is_short_tag, text=text)
 
     def parse(self, source):
         self._parent.setContentHandler(self)
@@ -124,52 +189,48 @@ class HTMLGenerator(html.parser.HTMLParser):
 
     def handle_starttag(self, tag, attrs, is_short_tag=False):
         full_tag = self.get_starttag_text()
+        scanned_attrs, spans = scan_start_tag(full_tag, tag)
         ws_dict = {}
-        raw_attrs = []
-        parse_error = False
-        # Pattern that selects both the key with preceding whitespaces and the
-        # raw value
-        patterns = [
-            r'(\s+{})="([^"]*)"',  # Double quotes
-            r"(\s+{})='([^']*)'",  # Single quotes
-            r"(\s+{})\b",  # Singleton, no value
-        ]
+        raw_attrs = collections.OrderedDict()
+        error = None
         for attr, value in attrs:
-            for pattern in patterns:
-                mo = re.search(pattern.format(attr), full_tag,
-                               flags=re.IGNORECASE)
-                if mo:
-                    break
-            else:
-                # No pattern matches
-                parse_error = True
+            if '<' in attr:
+                error = 'Start tag is not closed before {!r}'.format(attr)
+                break
+            try:
+                # The value is already unescaped, but we want the raw value as
+                # this is the only way to preserve both `&` and `&amp;` in one
+                # string at the same time.
+                ws_dict[attr], raw_attrs[attr] = scanned_attrs[attr]
+            except KeyError:
+                error = 'Attribute {!r} is not preceded by whitespace'.format(
+                    attr)
                 break
 
-            # The value is already unescaped, but we want the raw value as this
-            # is the only way to preserve both `&` and `&amp;` in one string at
-            # the same time.
-            raw_value = mo.group(2) if len(mo.groups()) == 2 else None
-            ws_dict[attr] = mo.group(1)
-            raw_attrs.append((attr, raw_value))
-
-        if not parse_error:
+        if error is None:
             # Find end tag matching whitespaces and shorttag
-            mo = re.search(r'(\s*/?>$)', full_tag)
-            ws_dict[ENDTAG] = mo.group()
+            ws_dict[ENDTAG] = RE_TAG_END.search(full_tag).group()
+            if not len(scanned_attrs) == len(raw_attrs) == len(attrs):
+                # Attributes found by `scan_start_tag` are missing or
+                # repeated, so the start tag cannot be copied.
+                spans = None
 
             # XXX We are deeply coupling to our generator here, as we change
             # the signature wrt the base class.
             try:
                 self._cont_handler.startElement(
                     tag, raw_attrs, ws_dict, is_short_tag=is_short_tag,
-                    lineno=self.getpos()[0])
-            except (PTParseError, lib2to3.pgen2.parse.ParseError):
-                parse_error = True
+                    lineno=self.getpos()[0], text=full_tag, spans=spans)
+            except PTParseError as e:
+                error = str(e)
 
-        if parse_error:
+        if error is not None:
+            # Keep the start tag as it is.
+            self._write_raw(full_tag)
             self.parse_errors.append({
                 'lineno': self.getpos()[0],
                 'tag': full_tag,
+                'error': error,
             })
 
     def _write_raw(self, data):
@@ -193,7 +254,7 @@ class HTMLGenerator(html.parser.HTMLParser):
         # lineno is only needed for tal-expressions.
         self._cont_handler.startElement(
             '!' + decl, {}, {ENDTAG: '>'}, is_short_tag=False,
-            lineno=self.getpos()[0])
+            lineno=self.getpos()[0], text='<!{}>'.format(decl), spans={})
 
     def handle_endtag(self, tag):
         self._cont_handler.endElement(tag)
@@ -208,6 +269,175 @@ class HTMLGenerator(html.parser.HTMLParser):
         self._cont_handler = cont_handler
 
 
+class SpliceGenerator(HTMLGenerator):
+    """A HTML parser which only generates the parts of the input it changes.
+
+    Each callback starts a part of the input at the position `getpos`
+    returns, which ends where the next one starts. The output of the content
+    handler for each part is compared with the part. The parts whose output
+    differs are collected in `splices` as tuples of their start and end
+    position in the input and their output, all other parts of the input can
+    be copied as they are. Call `finish` after parsing.
+    """
+
+    def __init__(self, raw, pending):
+        super().__init__(convert_charrefs=False)
+        self.raw = raw
+        self.pending = pending
+        self.splices = []
+        # The start of the current part and the data if it is text.
+        self._start = 0
+        self._data = None
+        # The line `getpos` was last called on and the offset of its start.
+        self._lineno = 1
+        self._line_start = 0
+
+    def _offset(self):
+        """Return the position in the input `getpos` refers to."""
+        lineno, offset = self.getpos()
+        while self._lineno < lineno:
+            self._line_start = self.raw.index('\n', self._line_start) + 1
+            self._lineno += 1
+        return self._line_start + offset
+
+    def _next_part(self, end=None):
+        """End the current part at `end`, by default at `getpos`."""
+        if end is None:
+            end = self._offset()
+        start = self._start
+        parts = self.pending.parts
+        if self._data is not None:
+            # Text is a part of the input, so it is not written.
+            output = self._data
+            self._data = None
+            if len(output) != end - start:
+                self.splices.append((start, end, output))
+        elif parts:
+            output = ''.join(parts)
+            parts.clear()
+            if (len(output) != end - start
+                    or not self.raw.startswith(output, start)):
+                self.splices.append((start, end, output))
+        elif start < end:
+            # The parser dropped this part of the input.
+            self.splices.append((start, end, ''))
+        self._start = end
+
+    def finish(self):
+        """End the last part at the end of the input."""
+        self._next_part(len(self.raw))
+
+    def handle_starttag(self, tag, attrs, is_short_tag=False):
+        self._next_part()
+        super().handle_starttag(tag, attrs, is_short_tag)
+
+    def handle_endtag(self, tag):
+        self._next_part()
+        super().handle_endtag(tag)
+
+    def handle_data(self, data):
+        self._next_part()
+        self._data = data
+
+    def handle_pi(self, data):
+        self._next_part()
+        super().handle_pi(data)
+
+    def handle_comment(self, data):
+        self._next_part()
+        super().handle_comment(data)
+
+    def handle_charref(self, name):
+        self._next_part()
+        super().handle_charref(name)
+
+    def handle_entityref(self, name):
+        self._next_part()
+        super().handle_entityref(name)
+
+    def handle_decl(self, decl):
+        self._next_part()
+        super().handle_decl(decl)
+
+
+class PendingOutput(io.TextIOBase):
+    """Text stream collecting the output of the part being parsed."""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data)
+        return len(data)
+
+
+def scan_attributes(full_tag):
+    """Find the attributes of a start tag in a single pass.
+
+    Returns a dict mapping the lower case attribute names to tuples of the
+    name including the preceding whitespace and the raw value. The value is
+    `None` for attributes without a quoted value. For repeated attributes a
+    double quoted occurrence wins over a single quoted one and this one over
+    one without quotes.
+    """
+    return scan_start_tag(full_tag, '')[0]
+
+
+def scan_start_tag(full_tag, tag):
+    """Find the attributes of the start tag of the element `tag`.
+
+    Returns the attributes like `scan_attributes` and a dict mapping the
+    attribute names to the positions of their values in `full_tag`. It is
+    `None` unless `join_element` reproduces `full_tag`, i. e. the tag name
+    is lower case, the attributes are neither repeated nor single quoted and
+    nothing but whitespace is between them.
+    """
+    found = {}
+    ranks = {}
+    spans = {}
+    pos = len(tag) + 1
+    if not full_tag.startswith(tag, 1):
+        spans = None
+    for mo in RE_ATTRIBUTE.finditer(full_tag):
+        ws_name, name, double_quoted, single_quoted = mo.groups()
+        if double_quoted is not None:
+            rank, raw_value = 0, double_quoted
+        elif single_quoted is not None:
+            rank, raw_value = 1, single_quoted
+        else:
+            rank, raw_value = 2, None
+        name = name.lower()
+        if spans is not None:
+            if mo.start() != pos or rank == 1 or name in found:
+                spans = None
+            elif rank == 0:
+                spans[name] = mo.span(3)
+            pos = mo.end()
+        if rank < ranks.get(name, 3):
+            ranks[name] = rank
+            found[name] = (ws_name, raw_value)
+    if spans is not None and RE_TAG_END.match(full_tag, pos) is None:
+        spans = None
+    return found, spans
+
+
+def splice_attributes(full_tag, spans, attrs, changed):
+    """Replace the values of the `changed` attributes in the start tag.
+
+    `spans` are the positions of the values as returned by `scan_start_tag`,
+    `changed` lists the attributes in the order of `attrs`.
+    """
+    parts = []
+    pos = 0
+    for attr in changed:
+        start, end = spans[attr]
+        parts.append(full_tag[pos:start])
+        parts.append(attrs[attr].replace('"', '&quot;'))
+        pos = end
+    parts.append(full_tag[pos:])
+    return ''.join(parts)
+
+
 def quoteattr(data):
     """Quote an attribute value.
 
@@ -239,8 +469,11 @@ def join_element(name, attrs, ws_dict):
 class CustomXMLGenerator(saxutils.XMLGenerator):
     """XMLGenerator with escape tweaks."""
 
-    def startElement(self, name, attrs, ws_dict, is_short_tag):
-        self._write(join_element(name, attrs, ws_dict))
+    def startElement(self, name, attrs, ws_dict, is_short_tag, text=None):
+        """Write the start tag `text` or synthesize it if it is `None`."""
+        if text is None:
+            text = join_element(name, attrs, ws_dict)
+        self._write(text)
 
 
 class PTParserRewriter(object):
@@ -258,20 +491,39 @@ class PTParserRewriter(object):
     def _is_tal_content(self):
         return 'tal:' in self.raw
 
-    def rewrite_zpt(self, input_):
-        """Rewrite the input_ by parsing it.
+    @property
+    def needs_rewrite(self):
+        """Cheaply tell whether parsing the input could change anything."""
+        return (self._is_tal_content
+                and RE_NEEDS_REWRITE.search(self.raw) is not None)
+
+    def _parse(self, input_, output, rewrite_action):
+        """Parse input_ writing the result to output.
 
-        Python expressions are passed to `rewrite_action` for processing
+        Returns the parsing errors.
         """
-        output_gen = CustomXMLGenerator(self.output, encoding='utf-8')
+        output_gen = CustomXMLGenerator(output, encoding='utf-8')
         parser = HTMLGenerator(convert_charrefs=False)
         parser.parse_errors = []
         filter = PythonExpressionFilter(
-            parser, self.rewrite_action, filename=self.filename)
+            parser, rewrite_action, filename=self.filename)
         filter.setContentHandler(output_gen)
         filter.setErrorHandler(handler.ErrorHandler())
         filter.parse(input_)
-        for err in parser.parse_errors:
+        return parser.parse_errors
+
+    def rewrite_zpt(self, input_, output=None):
+        """Rewrite the input_ by parsing it.
+
+        Python expressions are passed to `rewrite_action` for processing. The
+        result is written to the text stream `output` if given, otherwise it
+        is returned.
+        """
+        buffered = output is None
+        if buffered:
+            output = self.output
+        parse_errors = self._parse(input_, output, self.rewrite_action)
+        for err in parse_errors:
             log.error(
                 'Parsing error in %s:%d \n\t%s',
                 self.filename,
@@ -279,14 +531,67 @@ class PTParserRewriter(object):
                 err['tag'],
                 exc_info=False,
             )
-        if len(parser.parse_errors):
-            raise PTParseError
+        if len(parse_errors):
+            raise parse_error(self.filename, parse_errors)
+
+        if buffered:
+            return output.getvalue()
+
+    def collect_expressions(self):
+        """Return the Python expressions in the input without rewriting them.
+
+        Parsing errors are ignored, they are reported on rewrite.
+        """
+        expressions = []
+
+        def collect(input_string, *args, **kwargs):
+            expressions.append(input_string)
+            return input_string
+
+        if self.needs_rewrite:
+            self._parse(self.raw, io.StringIO(), collect)
+        return expressions
+
+    def __call__(self, output=None):
+        """Return the rewrite of the parsed input.
+
+        If the text stream `output` is given, the rewrite is written to it
+        instead, so it is not buffered in memory.
+        """
+        if self.needs_rewrite:
+            return self.rewrite_zpt(self.raw, output)
+        if output is None:
+            return self.raw
+        output.write(self.raw)
 
-        self.output.seek(0)
-        return self.output.read()
 
-    def __call__(self):
-        """Return the rewrite of the parsed input."""
-        if self._is_tal_content:
-            return self.rewrite_zpt(self.raw)
-        return self.raw
+class PTSpliceRewriter(PTParserRewriter):
+    """A rewriter for pagetemplates which copies the unchanged parts.
+
+    Instead of generating the output from the parsed parts of the input, only
+    the parts which change are generated and the input between them is
+    copied. The result is the same as the one of `PTParserRewriter`.
+    """
+
+    def _parse(self, input_, output, rewrite_action):
+        """Parse input_ writing the result to output.
+
+        Returns the parsing errors.
+        """
+        pending = PendingOutput()
+        output_gen = CustomXMLGenerator(pending, encoding='utf-8')
+        parser = SpliceGenerator(input_, pending)
+        parser.parse_errors = []
+        filter = PythonExpressionFilter(
+            parser, rewrite_action, filename=self.filename)
+        filter.setContentHandler(output_gen)
+        filter.setErrorHandler(handler.ErrorHandler())
+        filter.parse(input_)
+        parser.finish()
+        pos = 0
+        for start, end, data in parser.splices:
+            output.write(input_[pos:start])
+            output.write(data)
+            pos = end
+        output.write(input_[pos:])
+        return parser.parse_errors
@@ -0,0 +1,102 @@
+import collections
+import contextlib
+import json
+import time
+
+
+class Stats(object):
+    """Counters and timers of a run, in total and per file.
+
+    Timers are counters named `time.<phase>` holding seconds. The times of
+    worker processes add up, so they can exceed the duration of the run.
+    `counters` holds the numbers which do not belong to a single file.
+    """
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.files = collections.OrderedDict()
+        self.hooks = []
+
+    @property
+    def totals(self):
+        totals = collections.Counter(self.counters)
+        for counters in self.files.values():
+            totals.update(counters)
+        return totals
+
+    def add_hook(self, hook):
+        """Register a callable to feed the numbers into other systems.
+
+        It is called as `hook(path, counters)` for each finished file and as
+        `hook(None, totals)` at the end of the run.
+        """
+        self.hooks.append(hook)
+
+    @contextlib.contextmanager
+    def timer(self, phase, counters=None):
+        """Add the time spent in the context to the `phase` timer."""
+        if counters is None:
+            counters = self.counters
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            counters['time.' + phase] += time.perf_counter() - start
+
+    def timed(self, iterable, phase):
+        """Yield the items of `iterable` adding the time spent getting them
+        to the `phase` timer of the run."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.counters['time.' + phase] += (
+                    time.perf_counter() - start)
+            yield item
+
+    def add_file(self, path, counters):
+        """Store the counters of a finished file."""
+        self.files[str(path)] = counters
+        for hook in self.hooks:
+            hook(str(path), counters)
+
+    def merge(self, other):
+        """Add the numbers of `other`, e.g. from a worker process."""
+        for path, counters in other.files.items():
+            self.add_file(path, counters)
+        self.counters.update(other.counters)
+
+    def finish(self):
+        """Call the hooks with the totals at the end of the run."""
+        totals = self.totals
+        for hook in self.hooks:
+            hook(None, totals)
+
+    def as_dict(self):
+        return {
+            'totals': dict(self.totals),
+            'files': {path: dict(counters)
+                      for path, counters in self.files.items()},
+        }
+
+    def dump(self, path):
+        """Write the numbers as JSON to `path`."""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+    def report(self):
+        """Return a human readable summary of the totals."""
+        totals = self.totals
+        counters = sorted(k for k in totals if not k.startswith('time.'))
+        timers = sorted(k for k in totals if k.startswith('time.'))
+        width = max([len(k) for k in counters + timers] + [0])
+        lines = []
+        for key in counters:
+            lines.append('{:<{}}  {:>12}'.format(key, width, totals[key]))
+        for key in timers:
+            lines.append('{:<{}}  {:>11.3f}s'.format(key, width, totals[key]))
+        return '\n'.join(lines)
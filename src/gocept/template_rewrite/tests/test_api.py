@@ -0,0 +1,63 @@
+from ..api import Result
+from ..api import rewrite_many
+from ..pagetemplates import PTParseError
+from ..stats import Stats
+import pytest
+
+
+TEMPLATES = [
+    ('one', '<p tal:content="python:a.has_key(\'b\')" />', 'pt'),
+    ('two', '<dtml-var expr="x.has_key(1)">', 'dtml'),
+    ('three', '<p tal:content="a" />', 'pt'),
+]
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_api__rewrite_many__1(jobs):
+    """It yields the rewrites of the templates in their order."""
+    stats = Stats()
+    assert [
+        Result('one', '<p tal:content="python:\'b\' in a" />', True, None),
+        Result('two', '<dtml-var expr="1 in x">', True, None),
+        Result('three', '<p tal:content="a" />', False, None),
+    ] == list(rewrite_many(TEMPLATES, jobs=jobs, stats=stats))
+    assert stats.totals['files'] == 3
+    assert stats.totals['files_changed'] == 2
+
+
+def test_api__rewrite_many__2():
+    """It consumes the templates while yielding the results."""
+    consumed = []
+
+    def templates():
+        for template in TEMPLATES:
+            consumed.append(template[0])
+            yield template
+
+    results = rewrite_many(templates())
+    assert next(results).name == 'one'
+    assert ['one'] == consumed
+    assert 2 == len(list(results))
+    assert ['one', 'two', 'three'] == consumed
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_api__rewrite_many__3(jobs, caplog):
+    """It yields the parse errors on `collect_errors` and raises them
+    otherwise."""
+    templates = [('broken', '<dtml-var expr="or or">', 'dtml')] + TEMPLATES
+    results = list(rewrite_many(templates, jobs=jobs, collect_errors=True))
+    assert isinstance(results[0].error, PTParseError)
+    assert results[0].text is None
+    assert ['one', 'two', 'three'] == [result.name for result in results[1:]]
+    assert 'Parsing error in broken:1' in caplog.text
+    with pytest.raises(PTParseError):
+        list(rewrite_many(templates, jobs=jobs))
+
+
+def test_api__rewrite_many__4():
+    """It raises a `ValueError` on unknown kinds and fixers."""
+    with pytest.raises(ValueError):
+        list(rewrite_many([('a', '', 'zcml')]))
+    with pytest.raises(ValueError):
+        list(rewrite_many(TEMPLATES, fixers=['foo']))
@@ -0,0 +1,83 @@
+from ..benchmark import STARTUP
+from ..benchmark import generate_corpora
+from ..benchmark import main
+from ..benchmark import measure_startup
+from ..benchmark import run
+from ..engines import load_engine
+import json
+import pytest
+
+
+CORPORA = {
+    'zpt-tiny': [('a.pt', '<p tal:content="python: a.has_key(1)" />')],
+    'dtml-tiny': [('a.dtml', '<dtml-var "a.has_key(1)">')],
+}
+
+
+@pytest.fixture()
+def subprocess_run(mocker):
+    """Do not start a new interpreter for measuring the startup."""
+    return mocker.patch('subprocess.run')
+
+
+def test_benchmark__generate_corpora__1():
+    """It generates the same corpora for the same seed."""
+    corpora = generate_corpora(2)
+    assert sorted(corpora) == [
+        'dtml-few-expressions', 'dtml-let',
+        'zpt-few-expressions', 'zpt-nested']
+    assert all(len(files) == 2 for files in corpora.values())
+    assert corpora == generate_corpora(2)
+
+
+def test_benchmark__run__1():
+    """It measures the rewriters, the engines and the whole run."""
+    results = run(repeat=1, corpora=CORPORA)
+    assert [(r['corpus'], r['name']) for r in results
+            if r['name'].endswith(('Rewriter', 'FileHandler'))] == [
+        ('dtml-tiny', 'DTMLRegexRewriter'),
+        ('dtml-tiny', 'FileHandler'),
+        ('zpt-tiny', 'PTParserRewriter'),
+        ('zpt-tiny', 'PTSpliceRewriter'),
+        ('zpt-tiny', 'FileHandler'),
+    ]
+    result = results[0]
+    assert result['files'] == 1
+    assert result['expressions'] == 1
+    assert result['files_per_second'] > 0
+    assert result['peak_memory'] > 0
+
+
+def test_benchmark__run__2(mocker, caplog):
+    """It skips the engines which cannot be imported."""
+    mocker.patch('gocept.template_rewrite.benchmark.load_engine',
+                 side_effect=[ImportError('No module named lib2to3'),
+                              load_engine('tokens')])
+    results = run(repeat=1, corpora=CORPORA)
+    assert {'rewrite_using_tokens'} == {
+        r['name'] for r in results if r['name'].startswith('rewrite_')}
+    assert ('Skipping the lib2to3 engine: No module named lib2to3'
+            in caplog.text)
+
+
+def test_benchmark__main__1(tmpdir, mocker, subprocess_run, caplog):
+    """It writes the results as JSON to a file."""
+    mocker.patch('gocept.template_rewrite.benchmark.generate_corpora',
+                 return_value=CORPORA)
+    output = tmpdir.join('results.json')
+    main(['--scale=1', '--repeat=1', '--jobs=2', '--output', str(output)])
+    report = json.loads(output.read())
+    assert report['scale'] == 1
+    assert report['jobs'] == 2
+    assert report['results'][0]['name'] == 'DTMLRegexRewriter'
+    assert sorted(report['startup']) == [
+        'empty-run', 'help', 'import', 'interpreter']
+    assert 'DTMLRegexRewriter on dtml-tiny' in caplog.text
+    assert 'Processing' not in caplog.text
+
+
+def test_benchmark__measure_startup__1(subprocess_run):
+    """It runs the startup code `repeat` times in a new interpreter."""
+    startup = measure_startup(2)
+    assert sorted(startup) == sorted(STARTUP)
+    assert subprocess_run.call_count == 2 * len(STARTUP)
@@ -0,0 +1,80 @@
+from ..cache import MISSING
+from ..cache import ExpressionCache
+from ..cache import PersistentCache
+
+
+def test_cache__ExpressionCache__get__1():
+    """It returns `MISSING` for unknown keys and counts hits and misses."""
+    cache = ExpressionCache()
+    assert cache.get('a') is MISSING
+    cache.set('a', 'A')
+    assert cache.get('a') == 'A'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache__ExpressionCache__set__1():
+    """It drops the least recently used entry if it is full."""
+    cache = ExpressionCache(maxsize=2)
+    cache.set('a', 'A')
+    cache.set('b', 'B')
+    cache.get('a')
+    cache.set('c', 'C')
+    assert len(cache) == 2
+    assert cache.get('b') is MISSING
+    assert cache.get('a') == 'A'
+
+
+def test_cache__ExpressionCache__set__2():
+    """It does not store anything with a `maxsize` of 0."""
+    cache = ExpressionCache(maxsize=0)
+    cache.set('a', 'A')
+    assert cache.get('a') is MISSING
+
+
+def test_cache__ExpressionCache__resize__1():
+    """It drops entries exceeding the new size."""
+    cache = ExpressionCache()
+    for key in 'abc':
+        cache.set(key, key.upper())
+    cache.resize(1)
+    assert len(cache) == 1
+    assert cache.get('c') == 'C'
+
+
+def test_cache__ExpressionCache__clear__1():
+    """It removes all entries and resets the counters."""
+    cache = ExpressionCache()
+    cache.set('a', 'A')
+    cache.get('a')
+    cache.clear()
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_cache__PersistentCache__get__1(tmpdir):
+    """It returns entries stored by another instance after `flush`."""
+    cache = PersistentCache(str(tmpdir), 'fp')
+    assert cache.get('a') is MISSING
+    cache.set('a', 'A')
+    assert cache.get('a') == 'A'
+    cache.close()
+    cache = PersistentCache(str(tmpdir), 'fp')
+    assert cache.get('a') == 'A'
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_cache__PersistentCache__get__2(tmpdir):
+    """It does not return entries stored for another fingerprint."""
+    cache = PersistentCache(str(tmpdir), 'fp')
+    cache.set('a', 'A')
+    cache.flush()
+    assert PersistentCache(str(tmpdir), 'other').get('a') is MISSING
+
+
+def test_cache__PersistentCache__close__1(tmpdir):
+    """It writes pending entries on close."""
+    cache = PersistentCache(str(tmpdir), 'fp')
+    cache.set('a', 'A')
+    cache.close()
+    cache.close()
+    assert PersistentCache(str(tmpdir), 'fp').get('a') == 'A'
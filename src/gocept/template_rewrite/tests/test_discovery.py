@@ -0,0 +1,152 @@
+from ..discovery import DEFAULT_EXCLUDES
+from ..discovery import FileFinder
+from ..discovery import Rule
+from ..discovery import _scan
+from ..discovery import parse_gitignore
+from ..discovery import translate
+import os
+import pathlib
+import pytest
+
+
+def make_tree(root, files):
+    """Create the `files` given as a dict of relative paths to contents."""
+    for name, content in files.items():
+        path = pathlib.Path(str(root), name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+
+
+def find(root, *args, **kw):
+    return [os.path.relpath(path, str(root)).replace(os.sep, '/')
+            for path in FileFinder(*args, **kw).find([root])]
+
+
+@pytest.mark.parametrize('pattern, relpath, is_dir, expected', [
+    ('*.pt', 'a/b.pt', False, True),
+    ('*.pt', 'a/b.dtml', False, False),
+    ('var', 'a/var', True, True),
+    ('var/', 'a/var', False, False),
+    ('/var', 'a/var', True, False),
+    ('a/*.pt', 'a/b.pt', False, True),
+    ('a/*.pt', 'a/c/b.pt', False, False),
+    ('a/**/b.pt', 'a/c/d/b.pt', False, True),
+    ('**/c/*.pt', 'a/c/b.pt', False, True),
+    ('a/**', 'a/c/b.pt', False, True),
+    ('b[0-9].pt', 'b1.pt', False, True),
+    ('b[!0-9].pt', 'b1.pt', False, False),
+    ('b?.pt', 'b12.pt', False, False),
+    ('b?.pt', 'b1.pt', False, True),
+    ('a?b', 'a/b', False, False),
+    ('b**.pt', 'b12.pt', False, True),
+    ('a**/b.pt', 'a/c/b.pt', False, False),
+    ('\\*.pt', '*.pt', False, True),
+    ('\\*.pt', 'a.pt', False, False),
+    ('b[ab].pt', 'bb.pt', False, True),
+    ('[ab', '[ab', False, True),
+])
+def test_discovery__Rule__matches__1(pattern, relpath, is_dir, expected):
+    """It matches paths like the patterns of `.gitignore` files."""
+    name = relpath.rpartition('/')[2]
+    assert Rule(pattern).matches(relpath, name, is_dir) is expected
+
+
+@pytest.mark.parametrize('pattern, regex', [
+    ('*.pt', r'[^/]*\.pt'),
+    ('b**.pt', r'b[^/]*\.pt'),
+    ('**/c', '(?:.*/)?c'),
+    ('a/**/c', 'a/(?:.*/)?c'),
+    ('a/**', 'a/.*'),
+    ('b?.pt', r'b[^/]\.pt'),
+    ('\\[a]', r'\[a\]'),
+    ('a\\', r'a\\'),
+    ('[a-c]', '[a-c]'),
+    ('[!a-c]', '[^a-c]'),
+    ('[a\\]', r'[a\\]'),
+    ('[a-c', r'\[a\-c'),
+])
+def test_discovery__translate__1(pattern, regex):
+    """It translates glob patterns to regular expressions."""
+    assert regex == translate(pattern)
+
+
+def test_discovery__parse_gitignore__1():
+    """It skips comments and blank lines and keeps escaped characters."""
+    rules = parse_gitignore([
+        '# comment\n', '\n', '\\#a \n', '\\!b\n', 'c\\ \n', '!d/\n'])
+    names = ['#a', '!b', 'c ', 'd']
+    assert all(
+        rule.matches(name, name, True) for rule, name in zip(rules, names))
+    assert [False, False, False, True] == [rule.negate for rule in rules]
+
+
+def test_discovery___scan__1(tmpdir, caplog):
+    """It logs directories which cannot be listed as empty."""
+    assert ([], [], []) == _scan(str(tmpdir.join('missing')), True)
+    assert 'Cannot list' in caplog.text
+
+
+def test_discovery___scan__2(tmpdir, caplog):
+    """It treats a `.gitignore` which cannot be read as empty and entries
+    which cannot be inspected as files."""
+    tmpdir.join('.gitignore').mksymlinkto('missing')
+    tmpdir.join('loop').mksymlinkto('loop')
+    tmpdir.join('dir').mkdir()
+    tmpdir.join('link').mksymlinkto('dir')
+    assert (['.gitignore', 'loop'], ['dir'], []) == _scan(str(tmpdir), True)
+    assert 'Cannot read' in caplog.text
+
+
+def test_discovery__FileFinder__find__1(tmpdir):
+    """It yields the files of a directory before its subdirectories."""
+    make_tree(tmpdir, {'b/c.pt': '', 'a/b.pt': '', 'z.pt': '', 'c.pt': ''})
+    assert ['c.pt', 'z.pt', 'a/b.pt', 'b/c.pt'] == find(tmpdir)
+
+
+def test_discovery__FileFinder__find__2(tmpdir):
+    """It skips the files and directories matching `exclude` and the ones
+    not matching `include`."""
+    make_tree(tmpdir, {
+        'a.pt': '', 'a.dtml': '', '.git/b.pt': '', 'src/var/c.pt': '',
+        'src/d.pt': '', 'src/e.egg-info/f.pt': '', 'skip/g.pt': ''})
+    assert ['a.dtml', 'a.pt', 'src/d.pt'] == find(
+        tmpdir, exclude=DEFAULT_EXCLUDES + ['/skip'])
+    assert ['a.pt', 'src/d.pt'] == find(
+        tmpdir, include=['*.pt'], exclude=DEFAULT_EXCLUDES + ['/skip'])
+    assert 6 == len(find(tmpdir, exclude=['skip']))
+
+
+def test_discovery__FileFinder__find__3(tmpdir):
+    """It skips the files ignored by `.gitignore` files."""
+    make_tree(tmpdir, {
+        '.gitignore': '# generated\n*.out\nparts/\n!keep.out\n',
+        'a.pt': '', 'a.pt.out': '', 'keep.out': '', 'parts/b.pt': '',
+        'src/.gitignore': '/c.pt\n', 'src/c.pt': '', 'src/d/c.pt': '',
+        'src/d/e.out': ''})
+    assert ['.gitignore', 'a.pt', 'keep.out', 'src/.gitignore',
+            'src/d/c.pt'] == find(tmpdir)
+    assert 9 == len(find(tmpdir, gitignore=False))
+
+
+def test_discovery__FileFinder__find__4(tmpdir):
+    """It yields paths which are not directories unchanged."""
+    make_tree(tmpdir, {'a.pt': ''})
+    path = str(tmpdir.join('a.pt'))
+    assert [path] == list(FileFinder(exclude=['*.pt']).find([path]))
+
+
+def test_discovery__FileFinder__find__5(tmpdir):
+    """It counts the excluded and ignored files and directories."""
+    make_tree(tmpdir, {
+        '.gitignore': 'b.pt\n', 'a.pt': '', 'b.pt': '', 'c.dtml': '',
+        'var/d.pt': '', 'var/e.pt': ''})
+    finder = FileFinder(include=['*.pt'], exclude=['var'])
+    assert ['a.pt'] == [
+        os.path.basename(path) for path in finder.find([str(tmpdir)])]
+    assert 2 == finder.pruned
+
+
+def test_discovery__FileFinder__find__6(tmpdir):
+    """It excludes only directories using patterns ending with a slash."""
+    make_tree(tmpdir, {'build': '', 'src/build/a.pt': '', 'src/b.pt': ''})
+    assert ['build', 'src/b.pt'] == find(tmpdir, exclude=['build/'])
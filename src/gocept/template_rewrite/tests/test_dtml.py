@@ -1,5 +1,10 @@
+from gocept.template_rewrite.pagetemplates import PTParseError
+import gocept.template_rewrite.benchmark
 import gocept.template_rewrite.dtml
+import io
+import logging
 import pytest
+import random
 
 
 DTML_VAR_EXPRESSION = """
@@ -162,3 +167,222 @@ def test_dtml__DTMLRegexRewriter____call____3(input, expected):
     rw = gocept.template_rewrite.dtml.DTMLRegexRewriter(
         input, lambda x, **kw: "rewritten")
     assert rw() == expected
+
+
+@pytest.mark.parametrize('input, expected', [
+    ('<dtml-var expr="a">', True),
+    ('<dtml-let a="b">', True),
+    ('<dtml-if "num < 5">', True),
+    ('<dtml-var a>\n"quoted"', False),
+    ('SELECT * FROM table WHERE a = "b"', False),
+])
+def test_dtml__DTMLRegexRewriter__needs_rewrite__1(input, expected):
+    """It tells whether the input contains expressions."""
+    rw = gocept.template_rewrite.dtml.DTMLRegexRewriter(
+        input, lambda x, **kw: "rewritten")
+    assert rw.needs_rewrite is expected
+    assert (rw() != input) is expected
+
+
+@pytest.mark.parametrize('input, expected', [
+    ('<dtml-var expr="a">', '<dtml-var expr="rewritten">'),
+    ('<dtml-var a>', '<dtml-var a>'),
+])
+def test_dtml__DTMLRegexRewriter____call____4(input, expected):
+    """It writes the rewrite to the given output stream."""
+    output = io.StringIO()
+    rw = gocept.template_rewrite.dtml.DTMLRegexRewriter(
+        input, lambda x, **kw: "rewritten")
+    assert rw(output) is None
+    assert output.getvalue() == expected
+
+
+def test_dtml__DTMLRegexRewriter__collect_expressions__1():
+    """It returns the expressions without rewriting them."""
+    rw = gocept.template_rewrite.dtml.DTMLRegexRewriter(
+        let_expression, lambda x, **kw: "rewritten")
+    assert rw.collect_expressions() == [
+        "foo.replace(';','')", "bar.replace(';','')", "baz.replace(';','')"]
+
+
+@pytest.mark.parametrize('input', [
+    '<dtml-let expr="a">',
+    '<dtml-let "a" b="c">',
+    '<dtml-if "a <dtml-let b=" c="d">',
+    '<dtml-let a="b" <dtml-var expr="c">',
+    '<dtml-var expr="a" b="<dtml-var expr="c">">',
+    gocept.template_rewrite.benchmark.generate_dtml(random.Random(0), 20, .5),
+])
+def test_dtml__DTMLRegexRewriter____call____5(input):
+    """It rewrites like substituting `dtml_regex` and then `dtml_let_regex`.
+
+    Tags within other tags are rewritten this way, too.
+    """
+    rw = gocept.template_rewrite.dtml.DTMLRegexRewriter(
+        input, lambda x, **kw: "rewritten")
+    assert rw() == rw._substitute()
+
+
+def test_dtml__DTMLRegexRewriter____call____6():
+    """It passes the location of the expressions to the rewrite action."""
+    calls = []
+
+    def action(src, lineno, tag, filename):
+        calls.append((src, lineno, tag, filename))
+        return src
+
+    input = ('SELECT *\n<dtml-if expr="a">\n'
+             '<dtml-let b="c"\n  d="e">\n<dtml-var "f"><dtml-var "g">')
+    rw = gocept.template_rewrite.dtml.DTMLRegexRewriter(
+        input, action, filename='query.sql')
+    assert rw() == input
+    assert [
+        ('a', 2, '<dtml-if expr="a">', 'query.sql'),
+        ('c', 3, '<dtml-let b="c"\n  d="e">', 'query.sql'),
+        ('e', 4, '<dtml-let b="c"\n  d="e">', 'query.sql'),
+        ('f', 5, '<dtml-var "f">', 'query.sql'),
+        ('g', 5, '<dtml-var "g">', 'query.sql'),
+    ] == calls
+    calls.clear()
+    # The line numbers are the same if the input is rewritten in two passes.
+    assert rw._substitute() == input
+    assert ['a', 'f', 'g', 'c', 'e'] == [call[0] for call in calls]
+    assert [2, 5, 5, 3, 4] == [call[1] for call in calls]
+
+
+def test_dtml__DTMLRegexRewriter____call____7(caplog):
+    """It raises an error after reporting the location of each expression
+    which cannot be parsed."""
+    def action(src, lineno, tag, filename):
+        if src.startswith('or'):
+            raise PTParseError
+        return 'rewritten'
+
+    input = ('<dtml-var expr="a">\n<dtml-if expr="or or">\n'
+             '<dtml-let a="b"\n          c="or">')
+    with pytest.raises(PTParseError):
+        gocept.template_rewrite.dtml.DTMLRegexRewriter(
+            input, action, filename='broken.dtml')()
+    assert [
+        ('gocept.template_rewrite.dtml', logging.ERROR,
+         'Parsing error in broken.dtml:2 \n\t<dtml-if expr="or or">'),
+        ('gocept.template_rewrite.dtml', logging.ERROR,
+         'Parsing error in broken.dtml:4 \n\t'
+         '<dtml-let a="b"\n          c="or">'),
+    ] == caplog.record_tuples
+
+
+@pytest.mark.parametrize('rewriter', [
+    gocept.template_rewrite.dtml.DTMLRegexRewriter,
+    gocept.template_rewrite.dtml.DTMLMappedRewriter])
+def test_dtml__DTMLRegexRewriter____call____8(rewriter):
+    """It keeps the expressions which cannot be parsed and lists them in the
+    error after rewriting the rest of the input."""
+    def action(src, lineno, tag, filename):
+        if src.startswith('or'):
+            raise PTParseError('Cannot parse {!r}'.format(src))
+        return 'rewritten'
+
+    input = '<dtml-var expr="a">\n<dtml-let a="or" b="c">'
+    expected = '<dtml-var expr="rewritten">\n<dtml-let a="or" b="rewritten">'
+    output = io.StringIO()
+    if rewriter is gocept.template_rewrite.dtml.DTMLMappedRewriter:
+        input = input.encode('utf-8')
+        expected = expected.encode('utf-8')
+        output = io.BytesIO()
+    with pytest.raises(PTParseError) as err:
+        rewriter(input, action, filename='broken.dtml')(output)
+    assert output.getvalue() == expected
+    assert err.value.filename == 'broken.dtml'
+    assert err.value.errors == [{
+        'lineno': 2,
+        'tag': '<dtml-let a="or" b="c">',
+        'error': "Cannot parse 'or'",
+    }]
+
+
+@pytest.mark.parametrize('input', [
+    '<dtml-let expr="a">',
+    '<dtml-if "a <dtml-let b=" c="d">',
+    '<dtml-var expr="ä"> ü <dtml-let a="b"\n c="€">',
+    '<dtml-vär "a">\xa0<dtml-let\xa0a="b">',
+    '<dtml-var expr="a"',
+    '<dtml-let expr="a" ">',
+    '<dtml-var "a>',
+    '<dtml-var a <dtml-var b',
+    '<dtml-let a="b" <dtml-var c="d">',
+    '<dtml-var "a <dtml-if b" x>',
+    'no tags',
+    gocept.template_rewrite.benchmark.generate_dtml(random.Random(0), 20, .5),
+])
+def test_dtml__DTMLMappedRewriter____call____1(input, mocker):
+    """It writes the same as `DTMLRegexRewriter` encoded."""
+    mocker.patch('gocept.template_rewrite.dtml.CHUNK_SIZE', 3)
+    calls = []
+
+    def action(src, lineno, tag, filename):
+        calls.append((src, lineno, tag))
+        return 'rewritten'
+
+    expected = gocept.template_rewrite.dtml.DTMLRegexRewriter(
+        input, action)()
+    expected_calls = calls[:]
+    calls.clear()
+    rw = gocept.template_rewrite.dtml.DTMLMappedRewriter(
+        input.encode('utf-8'), action)
+    assert rw() == expected.encode('utf-8')
+    assert calls == expected_calls
+    assert rw.collect_expressions() == (
+        gocept.template_rewrite.dtml.DTMLRegexRewriter(
+            input, None).collect_expressions())
+
+
+def test_dtml__DTMLMappedRewriter____call____2(mocker):
+    """It only decodes the tags of inputs without tags in other tags."""
+    decode = mocker.spy(
+        gocept.template_rewrite.dtml.DTMLMappedRewriter, '_decode')
+    input = ('SELECT *\n<dtml-if expr="a">\n' + 'x' * 100 +
+             '<dtml-let b="c"\n  d="e">\n')
+    rw = gocept.template_rewrite.dtml.DTMLMappedRewriter(
+        input.encode('utf-8'), lambda x, **kw: x)
+    output = io.BytesIO()
+    assert rw(output) is None
+    assert output.getvalue() == input.encode('utf-8')
+    # The tags are found once to check for tags in tags and once to rewrite
+    # them.
+    assert [18, 24] * 2 == [
+        end - start for _, start, end in (
+            call.args for call in decode.call_args_list)]
+
+
+@pytest.mark.parametrize('input', [
+    '<dtml-var a',
+    '<dtml-var a>',
+    '<dtml-var "a',
+    '<dtml-var expr="a"',
+    '<dtml-var expr="a" b>',
+])
+def test_dtml__DTMLMappedRewriter__needs_rewrite__1(input):
+    """It tells the same as `DTMLRegexRewriter`."""
+    assert gocept.template_rewrite.dtml.DTMLMappedRewriter(
+        input.encode('utf-8'), None).needs_rewrite is (
+            gocept.template_rewrite.dtml.DTMLRegexRewriter(
+                input, None).needs_rewrite)
+
+
+@pytest.mark.parametrize('input', [
+    '<dtml-let a="b" <dtml-var c="d">',
+    '<dtml-var "a <dtml-if b" x>',
+])
+def test_dtml__DTMLMappedRewriter___tags__1(input):
+    """It stops after a tag starting within another one."""
+    rw = gocept.template_rewrite.dtml.DTMLMappedRewriter(
+        input.encode('utf-8'), None)
+    assert [None] == list(rw._tags())
+
+
+def test_dtml___Discard__1():
+    """It is a writable stream forgetting what is written to it."""
+    stream = gocept.template_rewrite.dtml._Discard()
+    assert stream.writable()
+    assert 3 == stream.write(b'abc')
@@ -0,0 +1,87 @@
+from ..encoding import decode
+from ..encoding import declared_encoding
+from ..encoding import detect
+from ..encoding import is_ascii_compatible
+import codecs
+import pytest
+
+
+def test_encoding__declared_encoding__1():
+    """It returns the encoding of a byte order mark."""
+    assert declared_encoding(codecs.BOM_UTF8 + b'<p/>') == 'utf-8'
+    assert declared_encoding(
+        codecs.BOM_UTF16_LE + '<p/>'.encode('utf-16-le')) == 'utf-16-le'
+
+
+def test_encoding__declared_encoding__2():
+    """It returns the encoding of an xml declaration."""
+    assert declared_encoding(
+        b'<?xml version="1.0" encoding="ISO-8859-1"?><p/>') == 'iso-8859-1'
+
+
+def test_encoding__declared_encoding__3():
+    """It returns the charset of a meta tag."""
+    assert declared_encoding(
+        b'<html><head><META Charset="cp1252"></head></html>') == 'cp1252'
+    assert declared_encoding(
+        b'<meta http-equiv="Content-Type" content="text/html;'
+        b' charset=latin-1" />') == 'latin-1'
+
+
+def test_encoding__declared_encoding__4():
+    """It prefers the xml declaration over a meta tag."""
+    assert declared_encoding(
+        b'<?xml version="1.0" encoding="latin-1"?>'
+        b'<meta charset="utf-8" />') == 'latin-1'
+
+
+@pytest.mark.parametrize('data', [
+    b'<p>no declaration</p>',
+    b'<meta charset="no-such-encoding" />',
+    b'<meta charset="utf-16" />',
+    b' ' * 1024 + b'<meta charset="latin-1" />',
+])
+def test_encoding__declared_encoding__5(data):
+    """It returns `None` if there is no usable declaration.
+
+    Declarations of unknown encodings, of ones not compatible with ASCII or
+    after the first kilobyte are ignored.
+    """
+    assert declared_encoding(data) is None
+
+
+def test_encoding__detect__1():
+    """It returns the default if there is no declaration."""
+    assert detect(b'<p/>') == 'utf-8'
+    assert detect(b'<p/>', 'latin-1') == 'latin-1'
+    assert detect(b'<meta charset="cp1252" />', 'latin-1') == 'cp1252'
+
+
+def test_encoding__decode__1():
+    """It returns the text and the encoding."""
+    assert decode('<p>ä</p>'.encode('latin-1'), 'latin-1') == (
+        '<p>ä</p>', 'latin-1')
+    assert decode(b'<p>a</p>\r\n') == ('<p>a</p>\r\n', 'utf-8')
+
+
+def test_encoding__decode__2():
+    """It keeps a byte order mark in the text."""
+    assert decode(codecs.BOM_UTF8 + b'<p/>') == ('﻿<p/>', 'utf-8')
+
+
+def test_encoding__decode__3():
+    """It raises `UnicodeDecodeError` if the data cannot be decoded."""
+    with pytest.raises(UnicodeDecodeError):
+        decode('<p>ä</p>'.encode('latin-1'))
+
+
+@pytest.mark.parametrize('encoding, expected', [
+    ('utf-8', True),
+    ('latin-1', True),
+    ('utf-16', False),
+    ('cp037', False),
+    ('undefined', False),
+])
+def test_encoding__is_ascii_compatible__1(encoding, expected):
+    """It tells whether an encoding encodes ASCII characters like ASCII."""
+    assert is_ascii_compatible(encoding) is expected
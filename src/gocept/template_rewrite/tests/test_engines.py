@@ -0,0 +1,209 @@
+from .. import engines
+from ..cache import ExpressionCache
+from ..engines import rewrite
+import pytest
+import subprocess
+import sys
+
+
+def upper(src, lineno, tag, filename):
+    """Engine used in the tests."""
+    return src.upper()
+
+
+@pytest.fixture
+def cache(mocker):
+    """Use an empty expression cache."""
+    cache = ExpressionCache()
+    mocker.patch('gocept.template_rewrite.engines.expression_cache', cache)
+    return cache
+
+
+@pytest.fixture
+def engine():
+    """Restore the default engine after the test."""
+    yield
+    engines.use_engine()
+
+
+def test_engines__rewrite__1(cache, mocker):
+    """It rewrites repeated expressions only once."""
+    engines.get_engine()
+    engine = mocker.spy(engines, 'engine')
+    assert rewrite('  unicode(x)', None, None, None) == 'str(x)'
+    assert rewrite('unicode(x)', None, None, None) == 'str(x)'
+    assert rewrite(' x', None, None, None) == ' x'
+    assert rewrite('x', None, None, None) == 'x'
+    # `x` is not passed to the engine as no fixer can change it.
+    assert engine.call_count == 1
+    assert cache.hits == 2
+
+
+def test_engines__rewrite__2(tmpdir, cache, mocker):
+    """It reuses rewrites stored in the persistent cache."""
+    engines.open_persistent_cache(str(tmpdir))
+    try:
+        assert rewrite('unicode(x)', None, None, None) == 'str(x)'
+        engines.flush_persistent_cache()
+        cache.clear()
+        engines.open_persistent_cache(str(tmpdir))
+        engines.get_engine()
+        engine = mocker.spy(engines, 'engine')
+        assert rewrite('unicode(x)', None, None, None) == 'str(x)'
+        assert engine.call_count == 0
+        assert engines.persistent_cache.hits == 1
+    finally:
+        engines.open_persistent_cache(None)
+    assert engines.persistent_cache is None
+
+
+def test_engines__use_engine__1(engine):
+    """It selects an engine by its name."""
+    pytest.importorskip('lib2to3.refactor')
+    engines.use_engine('lib2to3')
+    assert engines.engine_name == 'lib2to3'
+    assert engines.get_engine().__name__ == 'rewrite_using_2to3'
+    assert rewrite('print x', None, None, None) == 'print(x)'
+
+
+def test_engines__use_engine__2(engine, cache):
+    """It loads an engine given as `module:callable`."""
+    engines.use_engine('gocept.template_rewrite.tests.test_engines:upper')
+    assert rewrite(' x', None, None, None) == 'X'
+    engines.use_engine()
+    assert len(cache) == 0
+    assert rewrite(' x', None, None, None) == ' x'
+
+
+def test_engines__get_engine__1(engine):
+    """It loads the engine on first use."""
+    pytest.importorskip('lib2to3.refactor')
+    engines.use_engine('lib2to3')
+    assert engines.engine is None
+    engine = engines.get_engine()
+    assert engines.get_engine() is engine
+    assert engine.__name__ == 'rewrite_using_2to3'
+
+
+def test_engines__get_engine__2():
+    """It loads no engine and none of the modules needed only for some
+    options when importing the script."""
+    code = (
+        'import gocept.template_rewrite.main, sys\n'
+        'print(sorted(name for name in sys.modules if "lib2to3" in name'
+        ' or "tokenrewrite" in name or name in ['
+        '"pkg_resources", "concurrent.futures", "csv", "difflib", "mmap",'
+        ' "multiprocessing", "sqlite3"]))')
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert output.strip() == b'[]'
+
+
+def test_engines__use_fixes__1(engine, cache):
+    """It rewrites using the selected fixers only."""
+    engines.use_fixes(exclude_fixers=['has_key'])
+    try:
+        assert rewrite('unicode(a.has_key(b))', None, None, None) == (
+            'str(a.has_key(b))')
+        engines.use_fixes(['has_key'])
+        assert rewrite('unicode(a.has_key(b))', None, None, None) == (
+            'unicode(b in a)')
+    finally:
+        engines.use_fixes()
+    assert rewrite('unicode(a.has_key(b))', None, None, None) == (
+        'str(b in a)')
+
+
+def test_engines__select_fixes__1():
+    """It returns the names of the fixers to use."""
+    assert engines.select_fixes('tokens', ['dict', 'zip']) == ['dict', 'zip']
+    fixes = engines.select_fixes('tokens', exclude_fixers=['dict'])
+    assert 'has_key' in fixes
+    assert 'dict' not in fixes
+
+
+def test_engines__select_fixes__2():
+    """It raises a `ValueError` on unknown or unsupported fixers."""
+    with pytest.raises(ValueError, match='Unknown fixers.*: foo'):
+        engines.select_fixes('tokens', exclude_fixers=['foo', 'dict'])
+    upper = 'gocept.template_rewrite.tests.test_engines:upper'
+    assert engines.select_fixes(upper) is None
+    with pytest.raises(ValueError, match='does not support'):
+        engines.select_fixes(upper, ['dict'])
+
+
+@pytest.mark.parametrize('src, expected', [
+    ('x + 1', True),
+    ("request.get('x')", True),
+    ('a.has_key(b)', False),
+    ("u'x'", False),
+    ("'\\u1234'", False),
+    ('10L', False),
+    ('0777', False),
+    ('a <> b', False),
+    ('`a`', False),
+    ('x +', False),
+])
+def test_engines__is_unaffected__1(src, expected):
+    """It tells whether no fixer in use can change an expression."""
+    assert engines.is_unaffected(src) is expected
+
+
+def test_engines__is_unaffected__2(engine):
+    """It cannot tell for engines without triggers."""
+    engines.use_engine('gocept.template_rewrite.tests.test_engines:upper')
+    assert engines.is_unaffected('x + 1') is False
+
+
+def test_engines__is_unaffected__3(mocker):
+    """It cannot tell if the triggers of a fixer are not known."""
+    mocker.patch('gocept.template_rewrite.engines.triggers', engines.MISSING)
+    mocker.patch('gocept.template_rewrite.tokenrewrite.fix_triggers',
+                 return_value=None)
+    assert engines.is_unaffected('x + 1') is False
+    assert engines.triggers is None
+
+
+def test_engines__fired_fixes__1():
+    """It returns the fixers which change an expression."""
+    assert engines.fired_fixes(' print d.has_key(x)') == ('print', 'has_key')
+    assert engines.fired_fixes('x + 1') == ()
+    assert engines.fired_fixes('x.keys') == ()
+    assert engines.fired_fixes('foo(') == ()
+    assert engines.get_engine()('unicode(x)', None, None, None) == 'str(x)'
+
+
+def test_engines__fired_fixes__2(engine):
+    """It returns no fixers for engines without fixers."""
+    engines.use_engine('gocept.template_rewrite.tests.test_engines:upper')
+    assert engines.fired_fixes('print x') == ()
+
+
+def test_engines__load_engine__1():
+    """It raises a `ValueError` on unknown engine names."""
+    with pytest.raises(ValueError):
+        engines.load_engine('unknown')
+
+
+def test_engines__fingerprint__1():
+    """It differs between the engines."""
+    pytest.importorskip('lib2to3.refactor')
+    assert engines.fingerprint() == engines.fingerprint('tokens')
+    assert engines.fingerprint() != engines.fingerprint('lib2to3')
+    assert engines.fingerprint() != engines.fingerprint(
+        'tokens', exclude_fixers=['dict'])
+
+    upper = 'gocept.template_rewrite.tests.test_engines:upper'
+    assert engines.fingerprint(upper) != engines.fingerprint()
+
+
+def test_engines__init_worker__1(engine):
+    """It lets the engine in use set up a worker process."""
+    pytest.importorskip('lib2to3.refactor')
+    from .. import lib2to3
+    engines.use_engine('lib2to3')
+    engines.init_worker()
+    assert lib2to3.tool is None
+    engines.get_engine()('print x', None, None, None)
+    assert lib2to3.tool is not None
+    engines.init_worker()
+    assert lib2to3.tool is None
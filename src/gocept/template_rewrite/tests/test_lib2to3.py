@@ -1,4 +1,11 @@
-from ..lib2to3 import rewrite_using_2to3
+import pytest
+
+
+pytest.importorskip('lib2to3.refactor')
+
+from .. import lib2to3  # noqa: E402
+from ..lib2to3 import rewrite_using_2to3  # noqa: E402
+from ..pagetemplates import PTParseError  # noqa: E402
 
 
 def test_lib2to3__rewrite_using_2to3__1():
@@ -11,3 +18,32 @@ def test_lib2to3__rewrite_using_2to3__2():
     """It does not rewrite `.next()`, i.e. omits fixer `fix_next`."""
     res = rewrite_using_2to3('iter.next()', None, None, None)
     assert res == 'iter.next()'
+
+
+@pytest.mark.parametrize('src', ['or or', 'foo(', 'a\n  or b'])
+def test_lib2to3__rewrite_using_2to3__3(src):
+    """It raises a `PTParseError` if the expression cannot be parsed."""
+    with pytest.raises(PTParseError):
+        rewrite_using_2to3(src, None, None, None)
+
+
+def test_lib2to3__use_fixes__1():
+    """It uses only the given fixers and creates the tool on first use."""
+    lib2to3.use_fixes(['has_key'])
+    try:
+        assert lib2to3.tool is None
+        res = rewrite_using_2to3('unicode(x.has_key(y))', None, None, None)
+        assert res == 'unicode(y in x)'
+        assert lib2to3.tool is not None
+    finally:
+        lib2to3.use_fixes()
+    assert 'unicode' in lib2to3.get_fixes()
+    assert 'next' not in lib2to3.get_fixes()
+
+
+def test_lib2to3__fix_triggers__1():
+    """It returns the names in the pattern of a fixer."""
+    assert lib2to3.fix_triggers('has_key') == {'has_key', 'not'}
+    assert lib2to3.fix_triggers('unicode') == {'unicode', 'unichr', 'string'}
+    assert 'StringIO' in lib2to3.fix_triggers('imports')
+    assert lib2to3.fix_triggers('ws_comma') is None
@@ -1,11 +1,28 @@
+from .. import engines
+from ..cache import ExpressionCache
+from ..dtml import DTMLMappedRewriter
 from ..dtml import DTMLRegexRewriter
+from ..main import FileHandler
+from ..main import _OutputFile
+from ..main import _call_in_worker
+from ..main import _init_worker
 from ..main import main
+from ..main import parser
+from ..main import unified_diff
 from ..pagetemplates import PTParseError
 from ..pagetemplates import PTParserRewriter
+from ..pagetemplates import PTSpliceRewriter
+import json
+import logging
+import os
 import pathlib
 import pkg_resources
 import pytest
 import shutil
+import subprocess
+import sys
+import threading
+import time
 
 
 FIXTURE_DIR = pkg_resources.resource_filename(
@@ -38,10 +55,10 @@ def test_main__main__2(files):
     testfiles = files / 'sane'
     main([str(testfiles), '--keep-files'])
     res_files = [x.name for x in testfiles.iterdir()]
+    # broken.html does not change, so there is no output file.
     assert [
         'README.txt',
         'broken.html',
-        'broken.html.out',
         'one.pt',
         'one.pt.out',
         'three.xpt',
@@ -69,7 +86,6 @@ def test_main__main__3b(files, caplog):
     res_files = [x.name for x in files.rglob('*.*')]
     assert ['README.txt',
             'broken.html',
-            'broken.html.out',
             'broken.pt',
             'broken2.pt',
             'broken3.pt',
@@ -81,7 +97,8 @@ def test_main__main__3b(files, caplog):
             'two.dtml.out',
             ] == sorted(res_files)
     assert caplog.text.count('Processing') == 7
-    assert caplog.text.count('Parsing error') == 4
+    # broken3.pt contains no Python expressions, so it is not parsed.
+    assert caplog.text.count('Parsing error') == 3
     # Source files are not changed:
     for file in pathlib.Path(FIXTURE_DIR).rglob('*.*'):
         source = file.read_text()
@@ -113,9 +130,701 @@ def test_main__main__6(files, mocker):
     assert PTParserRewriter.__call__.call_count == 0
 
 
+def test_main__main__7(files):
+    """It creates the same output with multiple `--jobs` as in serial."""
+    serial = files / 'sane'
+    parallel = files / 'parallel'
+    shutil.copytree(str(serial), str(parallel))
+    assert main([str(serial), '--keep-files', '--jobs=1']) == 0
+    assert main([str(parallel), '--keep-files', '--jobs=3']) == 0
+    for path in serial.glob('*.out'):
+        assert path.read_text() == (parallel / path.name).read_text()
+
+
+def test_main__main__8(files, caplog):
+    """It reports errors in order of the files on `--jobs`."""
+    assert main([str(files), '--collect-errors', '--jobs=1']) == 1
+    serial_log = caplog.text
+    caplog.clear()
+    assert main([str(files), '--collect-errors', '--jobs=3']) == 1
+    assert caplog.text == serial_log
+    assert caplog.text.count('Parsing error') == 3
+
+
+def test_main__main__9(files):
+    """It stops on the first parsing error on `--jobs`."""
+    with pytest.raises(PTParseError):
+        main([str(files), '--jobs=3'])
+
+
+def test_main__main__10(files, mocker):
+    """It configures the size of the expression cache on `--cache-size`."""
+    cache = mocker.patch(
+        'gocept.template_rewrite.engines.expression_cache', ExpressionCache())
+    main([str(files / 'sane'), '--jobs=1'])
+    assert len(cache) > 0
+    cache.clear()
+    main([str(files / 'sane'), '--jobs=1', '--cache-size=0'])
+    assert cache.maxsize == 0
+    assert len(cache) == 0
+
+
+def test_main__main__11(files, tmpdir, mocker):
+    """It stores rewritten expressions in a database on `--cache-dir`."""
+    mocker.patch(
+        'gocept.template_rewrite.engines.expression_cache', ExpressionCache())
+    cache_dir = tmpdir.join('cache')
+    try:
+        main([str(files / 'sane'), '--keep-files', '--jobs=2',
+              '--cache-dir', str(cache_dir)])
+    finally:
+        engines.open_persistent_cache(None)
+    assert cache_dir.join('expressions.sqlite').check()
+    engines.get_engine()
+    refactor = mocker.spy(engines, 'engine')
+    try:
+        main([str(files / 'sane'), '--keep-files', '--jobs=1',
+              '--cache-dir', str(cache_dir)])
+        assert engines.persistent_cache.hits > 0
+    finally:
+        engines.open_persistent_cache(None)
+    assert refactor.call_count == 0
+
+
+def test_main__main__12(files, tmpdir, caplog):
+    """It skips files rewritten by a previous run on `--incremental`."""
+    args = [str(files / 'sane'), '--incremental', '--jobs=1',
+            '--cache-dir', str(tmpdir.join('cache'))]
+    try:
+        main(args)
+        assert caplog.text.count('Processing') == 4
+        caplog.clear()
+        (files / 'sane' / 'one.pt').write_text('<p tal:content="x"></p>')
+        main(args)
+        assert caplog.text.count('Processing') == 1
+        assert 'one.pt' in caplog.text
+    finally:
+        engines.open_persistent_cache(None)
+
+
+def test_main__main__13(files, capsys):
+    """It requires `--cache-dir` on `--incremental`."""
+    with pytest.raises(SystemExit):
+        main([str(files), '--incremental'])
+    assert 'requires `--cache-dir`' in capsys.readouterr().err
+
+
+def test_main__main__14(files, caplog):
+    """It counts the files without expressions."""
+    main([str(files / 'sane'), '--jobs=2'])
+    assert 'Processed 4 files, 1 of them without expressions.' in caplog.text
+
+
+@pytest.mark.parametrize('jobs', ['--jobs=1', '--jobs=2'])
+def test_main__main__15(files, jobs):
+    """It creates the same output on `--batch` as without."""
+    single = files / 'sane'
+    batch = files / 'batch'
+    shutil.copytree(str(single), str(batch))
+    assert main([str(single), '--keep-files', '--jobs=1']) == 0
+    assert main([str(batch), '--keep-files', '--batch', jobs]) == 0
+    for path in single.glob('*.out'):
+        assert path.read_text() == (batch / path.name).read_text()
+
+
+def test_main__main__16(files, mocker, caplog):
+    """It rewrites each distinct expression only once on `--batch`."""
+    action = mocker.spy(FileHandler, 'rewrite_action')
+    (files / 'sane' / 'four.pt').write_text(
+        '<p tal:content="python:a.has_key(\'b\')"></p>')
+    main([str(files / 'sane'), '--batch', '--jobs=1'])
+    # one.pt, three.xpt and four.pt share an expression
+    assert 'Rewriting 2 distinct expressions.' in caplog.text
+    assert action.call_count == 2
+    assert (files / 'sane' / 'four.pt').read_text() == (
+        '<p tal:content="python:\'b\' in a"></p>')
+
+
+def test_main__main__17(files, caplog):
+    """It reports the same parsing errors on `--batch` as without."""
+    assert main([str(files), '--collect-errors', '--jobs=1']) == 1
+    errors = [r.getMessage() for r in caplog.records if r.levelname == 'ERROR']
+    caplog.clear()
+    assert main([str(files), '--batch', '--collect-errors', '--jobs=2']) == 1
+    assert errors == [
+        r.getMessage() for r in caplog.records if r.levelname == 'ERROR']
+    assert caplog.text.count('Parsing error') == 3
+    with pytest.raises(PTParseError):
+        main([str(files), '--batch', '--jobs=1'])
+
+
+STATS_CALLS = []
+
+
+def record_stats(path, counters):
+    """Stats hook for `test_main__main__18` and `test_main__main__42`."""
+    STATS_CALLS.append((path, counters, threading.current_thread()))
+
+
+@pytest.mark.parametrize('jobs', ['--jobs=1', '--jobs=2'])
+def test_main__main__18(files, tmpdir, capsys, jobs):
+    """It reports counters and timers on `--stats`."""
+    del STATS_CALLS[:]
+    stats_json = tmpdir.join('stats.json')
+    main([str(files / 'sane'), '--keep-files', jobs, '--stats',
+          '--stats-json', str(stats_json),
+          '--stats-hook', __name__ + ':record_stats'])
+    report = capsys.readouterr().err
+    assert 'expressions_changed' in report
+    assert 'time.rewrite' in report
+    stats = json.loads(stats_json.read())
+    assert stats['totals']['files'] == 4
+    assert stats['totals']['expressions'] == 3
+    assert stats['totals']['expressions_changed'] == 3
+    one = stats['files'][str(files / 'sane' / 'one.pt')]
+    assert one['expressions'] == 1
+    assert one['bytes_read'] == 45
+    assert STATS_CALLS[-1][0] is None
+    assert sorted(path for path, counters, thread in STATS_CALLS[:-1]) == (
+        sorted(stats['files']))
+    assert STATS_CALLS[-1][1]['files'] == 4
+
+
+def test_main__main__19(files):
+    """It produces the same output using the lib2to3 engine."""
+    pytest.importorskip('lib2to3.refactor')
+    testfiles = files / 'sane'
+    main([str(testfiles), '--keep-files', '--jobs=1'])
+    expected = {
+        path.name: path.read_text() for path in testfiles.glob('*.out')}
+    for path in testfiles.glob('*.out'):
+        path.unlink()
+    try:
+        main([str(testfiles), '--keep-files', '--jobs=1',
+              '--engine=lib2to3'])
+        assert engines.engine_name == 'lib2to3'
+    finally:
+        engines.use_engine()
+    assert expected == {
+        path.name: path.read_text() for path in testfiles.glob('*.out')}
+
+
+def test_main__main__20(files, capsys):
+    """It exits with an error on an engine which cannot be loaded."""
+    with pytest.raises(SystemExit):
+        main([str(files / 'sane'), '--engine=unknown'])
+    assert 'Cannot load engine' in capsys.readouterr().err
+
+
+def test_main__main__21(files):
+    """It uses only the fixers given by `--fixers` or `--exclude-fixers`."""
+    testfiles = files / 'sane'
+    try:
+        main([str(testfiles), '--keep-files', '--jobs=1',
+              '--exclude-fixers=has_key'])
+        assert not (testfiles / 'one.pt.out').exists()
+        main([str(testfiles), '--keep-files', '--jobs=1',
+              '--fixers=dict,has_key'])
+        assert "'b' in a" in (testfiles / 'one.pt.out').read_text()
+    finally:
+        engines.use_fixes()
+
+
+def test_main__main__22(files, capsys):
+    """It exits with an error on unknown fixers."""
+    with pytest.raises(SystemExit):
+        main([str(files / 'sane'), '--fixers=dict,foo'])
+    assert 'Unknown fixers' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('jobs', ['--jobs=1', '--jobs=2'])
+def test_main__main__23(files, capsys, jobs):
+    """It reports the expressions changed per fixer on `--profile-fixers`."""
+    main([str(files / 'sane'), '--keep-files', jobs, '--profile-fixers'])
+    report = capsys.readouterr().err.splitlines()
+    assert report[0] == 'Expressions changed by each fixer:'
+    assert report[1].split() == ['has_key', '3']
+    assert report[2].split() == ['apply', '0']
+
+
+@pytest.mark.parametrize('jobs', ['--jobs=1', '--jobs=2'])
+def test_main__main__24(files, tmpdir, jobs):
+    """It creates the same output and statistics on `--pipeline`."""
+    serial = files / 'sane'
+    pipeline = files / 'pipeline'
+    shutil.copytree(str(serial), str(pipeline))
+    serial_json = tmpdir.join('serial.json')
+    pipeline_json = tmpdir.join('pipeline.json')
+    assert main([str(serial), '--jobs=1', '--stats-json',
+                 str(serial_json)]) == 0
+    assert main([str(pipeline), '--pipeline', jobs, '--stats-json',
+                 str(pipeline_json)]) == 0
+    assert sorted(path.name for path in serial.iterdir()) == sorted(
+        path.name for path in pipeline.iterdir())
+    for path in serial.iterdir():
+        assert path.read_text() == (pipeline / path.name).read_text()
+    totals = json.loads(serial_json.read())['totals']
+    pipeline_totals = json.loads(pipeline_json.read())['totals']
+    for key in ['files', 'skipped', 'expressions', 'bytes_read',
+                'bytes_written']:
+        assert totals[key] == pipeline_totals[key]
+
+
+@pytest.mark.parametrize('jobs', ['--jobs=1', '--jobs=2'])
+def test_main__main__25(files, caplog, jobs):
+    """It reports the same parsing errors on `--pipeline` as without."""
+    assert main([str(files), '--collect-errors', '--jobs=1']) == 1
+    messages = [r.getMessage() for r in caplog.records]
+    caplog.clear()
+    assert main([str(files), '--collect-errors', '--pipeline', jobs]) == 1
+    assert messages == [r.getMessage() for r in caplog.records]
+    assert not list(files.rglob('*.tmp'))
+    with pytest.raises(PTParseError):
+        main([str(files), '--pipeline', jobs])
+
+
+def test_main__main__26(files, mocker):
+    """It holds at most `PIPELINE_DEPTH` files per stage on `--pipeline`."""
+    mocker.patch('gocept.template_rewrite.main.PIPELINE_DEPTH', 1)
+    for i in range(10):
+        (files / 'sane' / '{}.pt'.format(i)).write_text(
+            '<p tal:content="python:a.has_key({})"></p>'.format(i))
+    assert main([str(files / 'sane'), '--pipeline', '--jobs=2']) == 0
+    assert (files / 'sane' / '9.pt').read_text() == (
+        '<p tal:content="python:9 in a"></p>')
+
+
+def test_main__main__27(files, caplog):
+    """It skips the excluded files and directories and only on request the
+    default excludes and the ones ignored by `.gitignore` files."""
+    sane = files / 'sane'
+    (sane / 'var').mkdir()
+    (sane / 'var' / 'four.pt').write_text('<p tal:content="python:1"></p>')
+    (sane / '.gitignore').write_text('three.xpt\n')
+    main([str(sane), '--exclude=*.dtml', '--exclude-default',
+          '--respect-gitignore', '--jobs=1'])
+    assert caplog.text.count('Processing') == 2
+    assert 'Processing {}'.format(sane / 'one.pt') in caplog.text
+    assert 'Skipped 3 excluded or ignored files and directories.' in (
+        caplog.text)
+    caplog.clear()
+    main([str(sane), '--include=*.pt', '--jobs=1'])
+    assert caplog.text.count('Processing') == 2
+    assert 'Processing {}'.format(sane / 'var' / 'four.pt') in caplog.text
+    assert 'Skipped' not in caplog.text
+
+
+@pytest.mark.parametrize('pipeline', [[], ['--pipeline']])
+def test_main__main__28(files, pipeline):
+    """It neither writes nor renames files which do not change."""
+    testfiles = files / 'sane'
+    html = testfiles / 'broken.html'
+    os.utime(str(html), ns=(0, 0))
+    assert main([str(testfiles), '--jobs=1'] + pipeline) == 0
+    assert html.stat().st_mtime_ns == 0
+    assert not list(testfiles.glob('*.out'))
+    assert "'b' in a" in (testfiles / 'one.pt').read_text()
+
+
+@pytest.mark.parametrize('args', [
+    ['--jobs=1'], ['--jobs=2'], ['--jobs=1', '--pipeline'],
+    ['--jobs=2', '--pipeline'], ['--jobs=1', '--mmap']])
+def test_main__main__29(files, caplog, args):
+    """It only reports the files which would change on `--check`."""
+    testfiles = files / 'sane'
+    assert main([str(testfiles), '--check'] + args) == 1
+    assert caplog.text.count('Would rewrite') == 3
+    assert 'Would rewrite {}'.format(testfiles / 'one.pt') in caplog.text
+    assert '3 files would be rewritten.' in caplog.text
+    for path in testfiles.iterdir():
+        assert path.read_text() == (
+            pathlib.Path(FIXTURE_DIR, 'sane', path.name).read_text())
+    assert main([str(testfiles / 'broken.html'), '--check']) == 0
+
+
+@pytest.mark.parametrize('parts, changed', [
+    (['ab', 'c'], False),
+    (['ab'], True),
+    (['ab', 'cd'], True),
+    (['x'], True),
+])
+def test_main___OutputFile__finish__1(tmpdir, parts, changed):
+    """It only writes the file if the written text differs."""
+    path = pathlib.Path(str(tmpdir), 'out')
+    output = _OutputFile(path, 'abc')
+    for part in parts:
+        output.write(part)
+    assert output.finish() is changed
+    assert path.exists() is changed
+    if changed:
+        assert path.read_text() == ''.join(parts)
+
+
+def test_main___OutputFile__getvalue__1():
+    """It returns the written text if `keep` is true."""
+    output = _OutputFile(None, 'abc', keep=True)
+    output.write('abc')
+    assert output.getvalue() == 'abc'
+    output.write('d')
+    assert output.getvalue() == 'abcd'
+
+
+def test_main___OutputFile__discard__1(tmpdir):
+    """It removes the file written before an error."""
+    path = pathlib.Path(str(tmpdir), 'out')
+    output = _OutputFile(path, 'abc')
+    assert output.writable()
+    output.write('x')
+    assert path.exists()
+    output.discard()
+    assert not path.exists()
+
+
+@pytest.mark.parametrize('args', [
+    ['--jobs=1'], ['--jobs=2'], ['--jobs=1', '--pipeline'],
+    ['--jobs=2', '--pipeline']])
+def test_main__main__30(files, capsys, args):
+    """It prints a diff of the changes instead of writing them on `--diff`.
+    """
+    testfiles = files / 'sane'
+    assert main([str(testfiles), '--diff', '--jobs=1']) == 0
+    expected = capsys.readouterr().out
+    assert main([str(testfiles), '--diff'] + args) == 0
+    assert expected == capsys.readouterr().out
+    one = str(testfiles / 'one.pt')
+    assert expected.startswith(
+        '--- {}\n+++ {}\n@@ -1 +1 @@\n'.format(one, one))
+    assert [str(testfiles / name) for name in ['one.pt', 'three.xpt',
+                                               'two.dtml']] == [
+        line[4:] for line in expected.splitlines()
+        if line.startswith('--- ')]
+    assert not list(testfiles.glob('*.out'))
+    assert (testfiles / 'one.pt').read_text() == (
+        pathlib.Path(FIXTURE_DIR, 'sane', 'one.pt').read_text())
+
+
+def test_main__main__31(files, mocker):
+    """It copies the unchanged parts of page templates on `--splice`."""
+    serial = files / 'sane'
+    splice = files / 'splice'
+    shutil.copytree(str(serial), str(splice))
+    mocker.spy(PTSpliceRewriter, '_parse')
+    assert main([str(serial), '--keep-files', '--jobs=1']) == 0
+    assert PTSpliceRewriter._parse.call_count == 0
+    assert main([str(splice), '--keep-files', '--jobs=1', '--splice']) == 0
+    assert PTSpliceRewriter._parse.call_count == 2
+    assert sorted(path.name for path in splice.glob('*.out')) == sorted(
+        path.name for path in serial.glob('*.out'))
+    for path in serial.glob('*.out'):
+        assert path.read_text() == (splice / path.name).read_text()
+
+
+@pytest.mark.parametrize('args', [[], ['--batch'], ['--pipeline']])
+def test_main__main__32(files, mocker, args):
+    """It memory maps DTML files on `--mmap`."""
+    serial = files / 'sane'
+    mapped = files / 'mapped'
+    shutil.copytree(str(serial), str(mapped))
+    (mapped / 'empty.dtml').write_text('')
+    (serial / 'empty.dtml').write_text('')
+    mocker.spy(DTMLMappedRewriter, '__call__')
+    assert main([str(serial), '--keep-files', '--jobs=1'] + args) == 0
+    assert DTMLMappedRewriter.__call__.call_count == 0
+    assert main(
+        [str(mapped), '--keep-files', '--jobs=1', '--mmap'] + args) == 0
+    assert DTMLMappedRewriter.__call__.call_count == (
+        0 if args == ['--pipeline'] else 1 + args.count('--batch'))
+    assert sorted(path.name for path in mapped.glob('*.out')) == sorted(
+        path.name for path in serial.glob('*.out'))
+    for path in serial.glob('*.out'):
+        assert path.read_text() == (mapped / path.name).read_text()
+
+
+@pytest.mark.parametrize('args', [
+    [], ['--batch'], ['--pipeline'], ['--mmap'], ['--diff']])
+def test_main__main__33(tmpdir, capsys, args):
+    """It writes the files in the encoding given by `--encoding`."""
+    path = pathlib.Path(str(tmpdir)) / 'a.dtml'
+    path.write_bytes('ä<dtml-var "x <> y">\r\n'.encode('latin-1'))
+    assert main([str(path), '--encoding=latin-1', '--jobs=1'] + args) == 0
+    if args == ['--diff']:
+        assert '+ä<dtml-var "x != y">' in capsys.readouterr().out
+    else:
+        assert path.read_bytes() == (
+            'ä<dtml-var "x != y">\r\n'.encode('latin-1'))
+
+
+@pytest.mark.parametrize('args', [[], ['--pipeline'], ['--mmap']])
+def test_main__main__34(tmpdir, args):
+    """It writes the files in the encoding they declare."""
+    path = pathlib.Path(str(tmpdir)) / 'a.pt'
+    path.write_bytes(
+        '<meta charset="cp1252" />\n<p tal:content="python: x <> y">€</p>'
+        .encode('cp1252'))
+    assert main([str(path), '--jobs=1'] + args) == 0
+    assert path.read_bytes() == (
+        '<meta charset="cp1252" />\n<p tal:content="python:x != y">€</p>'
+        .encode('cp1252'))
+
+
+@pytest.mark.parametrize('args', [
+    [], ['--pipeline'], ['--mmap'], ['--mmap', '--batch']])
+def test_main__main__35(tmpdir, caplog, args):
+    """It reports files which cannot be decoded as errors."""
+    path = pathlib.Path(str(tmpdir)) / 'a.dtml'
+    path.write_bytes('<dtml-var "\'ä\' <> y">'.encode('latin-1'))
+    assert main([str(path), '--collect-errors', '--jobs=1'] + args) == 1
+    assert 'Cannot decode {} using utf-8'.format(path) in caplog.text
+    assert path.read_bytes() == '<dtml-var "\'ä\' <> y">'.encode('latin-1')
+    with pytest.raises(PTParseError):
+        main([str(path), '--jobs=1'] + args)
+
+
+def test_main__main__36(capsys):
+    """It exits on an unknown `--encoding`."""
+    with pytest.raises(SystemExit):
+        main(['.', '--encoding=no-such-encoding'])
+    assert "Unknown encoding 'no-such-encoding'" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('args', [
+    ['--jobs=1'], ['--jobs=2'], ['--batch', '--jobs=1'],
+    ['--pipeline', '--jobs=1'], ['--pipeline', '--jobs=2'],
+    ['--mmap', '--jobs=1']])
+def test_main__main__37(files, caplog, args):
+    """It keeps the expressions which cannot be parsed on `--quarantine` and
+    replaces the files nevertheless."""
+    (files / 'broken' / 'mixed.pt').write_text(
+        '<p tal:content="python:a.has_key(1)"></p>\n'
+        '<p tal:content="python:or or"></p>\n')
+    (files / 'broken' / 'mixed.dtml').write_text(
+        '<dtml-var "a <> b"><dtml-var "or or">')
+    assert main([str(files), '--quarantine'] + args) == 1
+    assert caplog.text.count('Parsing error') == 5
+    assert 'skipping file replacement' not in caplog.text
+    assert not list(files.rglob('*.out'))
+    assert (files / 'broken' / 'mixed.pt').read_text() == (
+        '<p tal:content="python:1 in a"></p>\n'
+        '<p tal:content="python:or or"></p>\n')
+    assert (files / 'broken' / 'mixed.dtml').read_text() == (
+        '<dtml-var "a != b"><dtml-var "or or">')
+    assert (files / 'sane' / 'one.pt').read_text() == (
+        '<span tal:content="python:\'b\' in a" />\n')
+    for name in ['broken.pt', 'broken2.pt']:
+        assert (files / 'broken' / name).read_text() == pathlib.Path(
+            FIXTURE_DIR, 'broken', name).read_text()
+
+
+def test_main__main__38(files):
+    """It rewrites only the files with errors again on `--quarantine` and
+    `--incremental`."""
+    cache_dir = str(files / 'cache')
+    args = [str(files), '--quarantine', '--incremental',
+            '--cache-dir', cache_dir, '--jobs=1']
+    assert main(args) == 1
+    (files / 'broken' / 'broken2.pt').write_text(
+        '<div tal:content="python:a.has_key(1)"></div>')
+    report = str(files / 'report.json')
+    assert main(args + ['--error-report', report]) == 1
+    assert [error['file'] for error in json.loads(
+        pathlib.Path(report).read_text())] == [
+        str(files / 'broken' / 'broken.pt')]
+    assert (files / 'broken' / 'broken2.pt').read_text() == (
+        '<div tal:content="python:1 in a"></div>')
+
+
+@pytest.mark.parametrize('args', [[], ['--pipeline'], ['--jobs=2']])
+def test_main__main__39(files, args):
+    """It writes the parsing errors to a JSON file on `--error-report`."""
+    report = files / 'report.json'
+    assert main([str(files), '--collect-errors', '--error-report',
+                 str(report)] + args) == 1
+    assert json.loads(report.read_text()) == [{
+        'file': str(files / 'broken' / 'broken.pt'),
+        'line': 1,
+        'tag': '<div tal:define="a python:b\n'
+               '                          or c" />',
+        'error': "Cannot parse 'b\\n                          or c':"
+                 " unexpected indent (<unknown>, line 2)",
+    }, {
+        'file': str(files / 'broken' / 'broken2.pt'),
+        'line': 1,
+        'tag': '<div class="something"'
+               ' tal:content="python:invalid syntax">',
+        'error': "Cannot parse 'invalid syntax': invalid syntax"
+                 " (<unknown>, line 1)",
+    }, {
+        'file': str(files / 'broken' / 'broken2.pt'),
+        'line': 3,
+        'tag': '<span tal:replace= "python:1">',
+        'error': "Attribute 'tal:replace' has no value",
+    }]
+
+
+def test_main__main__40(tmpdir):
+    """It writes the parsing errors as CSV to a `.csv` `--error-report`."""
+    tmpdir = pathlib.Path(str(tmpdir))
+    path = tmpdir / 'a.dtml'
+    path.write_bytes('<dtml-var "\'ä\'">'.encode('latin-1'))
+    report = tmpdir / 'report.csv'
+    assert main([str(path), '--collect-errors', '--jobs=1',
+                 '--error-report', str(report)]) == 1
+    assert report.read_bytes().decode('utf-8') == (
+        'file,line,tag,error\r\n'
+        '{},,,Cannot decode using utf-8: \'utf-8\' codec can\'t decode'
+        ' byte 0xe4 in position 12: invalid continuation byte\r\n'.format(
+            path))
+
+
+@pytest.mark.parametrize('jobs', ['--jobs=1', '--jobs=2'])
+def test_main__main__41(files, jobs):
+    """It exits on a parsing error on `--pipeline`."""
+    process = subprocess.run(
+        [sys.executable, '-c',
+         'import gocept.template_rewrite.main, sys;'
+         ' gocept.template_rewrite.main.main(sys.argv[1:])',
+         str(files / 'broken'), '--pipeline', jobs],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+    assert process.returncode == 1
+    assert b'PTParseError' in process.stderr
+
+
+@pytest.mark.parametrize('jobs', ['--jobs=1', '--jobs=2'])
+def test_main__main__42(files, jobs):
+    """It calls the stats hooks in the main thread on `--pipeline`."""
+    del STATS_CALLS[:]
+    assert main([str(files / 'sane'), '--pipeline', jobs,
+                 '--stats-hook', __name__ + ':record_stats']) == 0
+    assert len(STATS_CALLS) == 5
+    assert {thread for path, counters, thread in STATS_CALLS} == {
+        threading.main_thread()}
+    assert STATS_CALLS[-1][1]['bytes_written'] > 0
+
+
+def test_main__FileHandler___map__1(mocker):
+    """It consumes tasks which are not a list in the current thread and at
+    most `PIPELINE_DEPTH` of them ahead of the results."""
+    mocker.patch('gocept.template_rewrite.main.PIPELINE_DEPTH', 2)
+    handler = FileHandler([], parser.parse_args(['--jobs=2']))
+    threads = []
+
+    def tasks():
+        for i in range(6):
+            threads.append(threading.current_thread())
+            yield (['a.has_key({})'.format(i)],)
+
+    consumed = []
+    for result, error in handler._map('rewrite_expressions', tasks()):
+        assert error is None
+        consumed.append(len(threads))
+    assert [2, 3, 4, 5, 6, 6] == consumed
+    assert {threading.current_thread()} == set(threads)
+
+
+def test_main__main__43(tmpdir, mocker):
+    """It stops writing on the first error on `--pipeline` and raises it."""
+    tmpdir = pathlib.Path(str(tmpdir))
+    for name in 'abc':
+        (tmpdir / (name + '.pt')).write_text(
+            '<p tal:content="python:a.has_key(1)" />')
+    replace = mocker.patch('pathlib.Path.replace', side_effect=OSError)
+    with pytest.raises(OSError):
+        main([str(tmpdir), '--pipeline', '--jobs=1'])
+    assert replace.call_count == 1
+    assert not list(tmpdir.glob('*.out'))
+
+
+def test_main__main__44(files, mocker):
+    """It stops reading the files on an error on `--pipeline`."""
+    read = FileHandler._read
+    paths = []
+
+    def slow_read(self, path, counters):
+        paths.append(path.name)
+        time.sleep(0.2)
+        return read(self, path, counters)
+
+    mocker.patch.object(FileHandler, '_read', slow_read)
+    with pytest.raises(PTParseError):
+        main([str(files / 'broken'), '--pipeline', '--jobs=1'])
+    assert ['broken.pt', 'broken2.pt'] == paths
+
+
+def test_main__main__45(capsys):
+    """It exits if no path is given."""
+    with pytest.raises(SystemExit):
+        main([])
+    assert 'arguments are required: path' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('args', [['--mmap'], ['--mmap', '--batch']])
+def test_main__main__46(tmpdir, args):
+    """It reads the DTML files whose encoding is not compatible with ASCII
+    instead of memory mapping them."""
+    path = pathlib.Path(str(tmpdir)) / 'a.dtml'
+    path.write_bytes('<dtml-var "x <> y">'.encode('utf-16'))
+    assert main([str(path), '--jobs=1'] + args) == 0
+    assert path.read_bytes() == '<dtml-var "x != y">'.encode('utf-16')
+
+
+@pytest.mark.parametrize('args', [[], ['--batch']])
+def test_main__main__47(files, mocker, args):
+    """It raises errors which are no parsing errors on `--collect-errors`."""
+    mocker.patch('pathlib.Path.read_bytes', side_effect=OSError('broken'))
+    with pytest.raises(OSError, match='broken'):
+        main([str(files / 'sane'), '--collect-errors', '--jobs=1'] + args)
+
+
+def test_main___call_in_worker__1(files, mocker):
+    """It returns the result, the raised exception, the log records and the
+    statistics of a call in a worker process."""
+    mocker.patch.object(logging.getLogger(), 'handlers', [])
+    mocker.patch.object(logging.getLogger(), 'level', logging.INFO)
+    handler = FileHandler([], parser.parse_args(['--jobs=2']))
+    _init_worker(handler)
+    result, error, records, stats = _call_in_worker(
+        ('rewrite_expressions', (['a.has_key(1)'],)))
+    assert result == {'a.has_key(1)': '1 in a'}
+    assert error is None
+    assert records == []
+
+    path = files / 'broken' / 'broken.pt'
+    result, error, records, stats = _call_in_worker(
+        ('rewrite_file', (path, PTParserRewriter)))
+    assert result is None
+    assert isinstance(error, PTParseError)
+    assert records[0].args is None
+    assert 'Processing {}'.format(path) == records[0].msg
+    assert [str(path)] == list(stats.files)
+    assert _call_in_worker(('rewrite_expressions', ([],)))[2] == []
+
+
+def test_main___call_in_worker__2(mocker):
+    """It makes the log records of exceptions picklable."""
+    mocker.patch.object(logging.getLogger(), 'handlers', [])
+    _init_worker(FileHandler([], parser.parse_args(['--jobs=2'])))
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        logging.getLogger(__name__).exception('Failed: %s', 'a')
+    records = _call_in_worker(('rewrite_expressions', ([],)))[2]
+    assert records[0].msg == 'Failed: a'
+    assert records[0].exc_info is None
+    assert 'ValueError: boom' in records[0].exc_text
+
+
+def test_main__unified_diff__1():
+    """It marks a missing newline at the end of the file."""
+    assert unified_diff('a.pt', 'a\nb', 'a\nc') == (
+        '--- a.pt\n+++ a.pt\n@@ -1,2 +1,2 @@\n a\n-b\n'
+        '\\ No newline at end of file\n+c\n'
+        '\\ No newline at end of file\n')
+
+
 def test_main__PTParserRewriter__1(files, mocker):
     """It skips rewrite of a file without `tal:` in content."""
     mocker.spy(PTParserRewriter, 'rewrite_zpt')
-    main([str(files / 'sane/broken.html'), str(files / 'sane/one.pt')])
+    main([str(files / 'sane/broken.html'), str(files / 'sane/one.pt'),
+          '--jobs=1'])
     # broken.html is not rewritten
     assert PTParserRewriter.rewrite_zpt.call_count == 1
@@ -0,0 +1,50 @@
+from ..manifest import Manifest
+import os
+import pathlib
+
+
+def test_manifest__Manifest__is_unchanged__1(tmpdir):
+    """It recognizes files stored in a saved manifest."""
+    path = pathlib.Path(str(tmpdir), 'one.pt')
+    path.write_text('<p></p>')
+    manifest = Manifest(tmpdir.join('manifest.json'), {'a': 1})
+    assert not manifest.is_unchanged(path, 'PTParserRewriter')
+    manifest.update(path, 'PTParserRewriter')
+    manifest.save()
+    manifest = Manifest(tmpdir.join('manifest.json'), {'a': 1})
+    assert manifest.is_unchanged(path, 'PTParserRewriter')
+    assert not manifest.is_unchanged(path, 'DTMLRegexRewriter')
+
+
+def test_manifest__Manifest__is_unchanged__2(tmpdir):
+    """It ignores the entries stored with other settings."""
+    path = pathlib.Path(str(tmpdir), 'one.pt')
+    path.write_text('<p></p>')
+    manifest = Manifest(tmpdir.join('manifest.json'), {'a': 1})
+    manifest.update(path, 'PTParserRewriter')
+    manifest.save()
+    manifest = Manifest(tmpdir.join('manifest.json'), {'a': 2})
+    assert not manifest.is_unchanged(path, 'PTParserRewriter')
+
+
+def test_manifest__Manifest__is_unchanged__3(tmpdir):
+    """It compares the content of touched files."""
+    path = pathlib.Path(str(tmpdir), 'one.pt')
+    path.write_text('<p></p>')
+    manifest = Manifest(tmpdir.join('manifest.json'), {})
+    manifest.update(path, 'PTParserRewriter')
+    os.utime(str(path), ns=(0, 0))
+    assert manifest.is_unchanged(path, 'PTParserRewriter')
+    path.write_text('<a></a>')
+    os.utime(str(path), ns=(1, 1))
+    assert not manifest.is_unchanged(path, 'PTParserRewriter')
+    path.unlink()
+    assert not manifest.is_unchanged(path, 'PTParserRewriter')
+
+
+def test_manifest__Manifest___load__1(tmpdir, caplog):
+    """It ignores a broken manifest file."""
+    tmpdir.join('manifest.json').write('{')
+    manifest = Manifest(tmpdir.join('manifest.json'), {})
+    assert manifest.entries == {}
+    assert 'Ignoring broken manifest' in caplog.text
@@ -1,20 +1,29 @@
-from gocept.template_rewrite.lib2to3 import rewrite_using_2to3
 from gocept.template_rewrite.pagetemplates import PTParseError
 from gocept.template_rewrite.pagetemplates import PTParserRewriter
+from gocept.template_rewrite.pagetemplates import PTSpliceRewriter
+from gocept.template_rewrite.pagetemplates import action_errors
+from gocept.template_rewrite.pagetemplates import scan_attributes
+from gocept.template_rewrite.pagetemplates import scan_start_tag
+from gocept.template_rewrite.tokenrewrite import rewrite_using_tokens
+import gocept.template_rewrite.benchmark
+import io
 import logging
 import pytest
+import random
+import sys
 
 
 @pytest.fixture(scope='module', autouse=True)
 def rewriter():
     """We want to parse all the strings in tests.
 
-    The parser makes an optimization for files without `tal:` in reality.
+    The parser makes an optimization for files without `tal:` and Python
+    expressions in reality. The original property is returned.
     """
-    old_prop = PTParserRewriter._is_tal_content
-    PTParserRewriter._is_tal_content = True
-    yield
-    PTParserRewriter._is_tal_content = old_prop
+    old_prop = PTParserRewriter.needs_rewrite
+    PTParserRewriter.needs_rewrite = True
+    yield old_prop
+    PTParserRewriter.needs_rewrite = old_prop
 
 
 @pytest.mark.parametrize('input, expected', [
@@ -150,8 +159,8 @@ def test_pagetemplates__PTParserRewriter____call____3(
 ])
 def test_pagetemplates__PTParserRewriter____call____4(
         input, expected):
-    """It can be used with a preconfigured 2to3 rewrite_action."""
-    rw = PTParserRewriter(input, rewrite_using_2to3)
+    """It can be used with a preconfigured rewrite_action."""
+    rw = PTParserRewriter(input, rewrite_using_tokens)
     assert rw() == expected
 
 
@@ -177,8 +186,8 @@ def test_pagetemplates__PTParserRewriter____call____4(
 ])
 def test_pagetemplates__PTParserRewriter____call____5(
         input):
-    """It is not changed by the preconfigured 2to3 rewrite_action."""
-    rw = PTParserRewriter(input, rewrite_using_2to3)
+    """It is not changed by the preconfigured rewrite_action."""
+    rw = PTParserRewriter(input, rewrite_using_tokens)
     assert rw() == input
 
 
@@ -193,7 +202,7 @@ def test_pagetemplates__PTParserRewriter____call____6(caplog):
 <p tal:attributes="color python: or or"></p>
 """
     with pytest.raises(PTParseError):
-        assert PTParserRewriter(broken, rewrite_using_2to3,
+        assert PTParserRewriter(broken, rewrite_using_tokens,
                                 filename='broken.pt')()
     assert [
         ('gocept.template_rewrite.pagetemplates', logging.ERROR,
@@ -204,3 +213,233 @@ def test_pagetemplates__PTParserRewriter____call____6(caplog):
          'Parsing error in broken.pt:5 \n\t'
          '<p tal:attributes="color python: or or">'),
     ] == caplog.record_tuples
+
+
+@pytest.mark.parametrize('input, expected', [
+    ('<p tal:content="python: 1"></p>', True),
+    ("<p tal:content='a'></p>", True),
+    ('<p tal:content="a"><!-- a -- b --></p>', True),
+    ('<p tal:content="a"><!-- a - b --></p><!-- c -->', False),
+    ('<p tal:content="string:a"></p>', False),
+    ('<p class="python: 1"></p>', False),
+])
+def test_pagetemplates__PTParserRewriter__needs_rewrite__1(
+        input, expected, mocker, rewriter):
+    """It tells whether parsing could change the input."""
+    mocker.patch.object(PTParserRewriter, 'needs_rewrite', rewriter)
+    rw = PTParserRewriter(input, lambda x, lineno, tag, filename: x)
+    assert rw.needs_rewrite is expected
+
+
+@pytest.mark.parametrize('input, expected', [
+    ('<p>', {}),
+    ('''<p a="1" B='2'\n   c d=e/>''', {
+        'a': (' a', '1'), 'b': (' B', '2'), 'c': ('\n   c', None),
+        'd': (' d', None)}),
+    # The name of an attribute occurring in a value does not count.
+    ('<p title=" id=1" id="2">', {
+        'title': (' title', ' id=1'), 'id': (' id', '2')}),
+    # Quoted values win for repeated attributes.
+    ('''<p a a='1' a="2" a='3'>''', {'a': (' a', '2')}),
+    # Attributes not preceded by whitespace are not found.
+    ('<p a="1"b="2">', {'a': (' a', '1')}),
+])
+def test_pagetemplates__scan_attributes__1(input, expected):
+    """It finds the raw attributes in a start tag."""
+    assert scan_attributes(input) == expected
+
+
+@pytest.mark.parametrize('input, tag, expected', [
+    ('<p a="1"\n  b c="">', 'p', {'a': (6, 7), 'c': (16, 16)}),
+    ('<p/>', 'p', {}),
+    ('<P a="1">', 'p', None),
+    ("<p a='1'>", 'p', None),
+    ('<p a="1" a="2">', 'p', None),
+    ('<p a=1>', 'p', None),
+    ('<p a="1"b="2">', 'p', None),
+])
+def test_pagetemplates__scan_start_tag__1(input, tag, expected):
+    """It finds the values which can be replaced in the start tag."""
+    assert scan_start_tag(input, tag)[1] == expected
+
+
+def test_pagetemplates__PTParserRewriter____call____8():
+    """It passes the start tag as found in the input to the action."""
+    tags = []
+
+    def action(x, lineno, tag, filename):
+        tags.append(tag)
+        return 'b'
+
+    rw = PTParserRewriter(
+        '<P tal:define="x python:a"\n tal:content="python:a">', action)
+    assert rw() == '<p tal:define="x python:b"\n tal:content="python:b">'
+    assert tags == ['<P tal:define="x python:a"\n tal:content="python:a">'] * 2
+
+
+@pytest.mark.parametrize('input, expected', [
+    # Unchanged start tags are copied as they are.
+    ('<p  tal:content="python:b" \n checked\t/>',
+     '<p  tal:content="python:b" \n checked\t/>'),
+    ('<p\ttal:content="python:a"\n checked tal:replace="python: 1"  >',
+     '<p\ttal:content="python:b"\n checked tal:replace="python: 1"  >'),
+    ('<p tal:content="python:a + \'&quot;\'" class="a">',
+     '<p tal:content="python:b + \'&quot;\'" class="a">'),
+    ('<p tal:content="python:\'a\'">',
+     '<p tal:content="python:&quot;b&quot;">'),
+])
+def test_pagetemplates__PTParserRewriter____call____9(input, expected):
+    """It replaces the changed values in the start tag."""
+    rw = PTParserRewriter(
+        input, lambda x, lineno, tag, filename: x.replace(
+            'a', 'b').replace("\'b\'", '"b"'))
+    assert rw() == expected
+
+
+@pytest.mark.parametrize('input', [
+    '<p tal:content="python: 1"></p>',
+    '<p>no tal</p>',
+])
+def test_pagetemplates__PTParserRewriter____call____7(input):
+    """It writes the rewrite to the given output stream."""
+    output = io.StringIO()
+    rw = PTParserRewriter(input, lambda x, lineno, tag, filename: x)
+    assert rw(output) is None
+    assert output.getvalue() == input
+
+
+def test_pagetemplates__PTParserRewriter__collect_expressions__1(caplog):
+    """It returns the expressions ignoring parsing errors."""
+    rw = PTParserRewriter(
+        '<p tal:define="a python: 1; b python: 2" tal:content="python:a">'
+        '<span tal:replace= "python:1"></span></p>',
+        lambda x, lineno, tag, filename: "rewritten")
+    assert rw.collect_expressions() == [' 1', ' 2', 'a']
+    assert caplog.text == ''
+
+
+@pytest.mark.parametrize('input', [
+    '<p tal:content="python: a" class=\'b\'>x &amp y</p>',
+    '<p tal:content="python: a" class=\'b\' hidden>x</p>',
+    '<P tal:replace="python: a"/></P >text<!-- a -- b --></>&#65 &x',
+    '</><p tal:content="python: a">',
+    ('<!DOCTYPE html><p tal:content="python: a">&amp;<?pi?>'
+     '<script>a <b> c</script><br /></p>'),
+    '<p tal:define="a python: a;; a" tal:content="string:a">a</p>\n<p',
+    '<p tal:content="python: a"\ttal:replace>a</p>',
+    '<p\n tal:content="python: a">\r\n&amp\n</P\n><!--\na -- b-->\n</>x',
+    gocept.template_rewrite.benchmark.generate_zpt(
+        random.Random(0), 4, 4, .5),
+])
+def test_pagetemplates__PTSpliceRewriter____call____1(input):
+    """It returns the same as `PTParserRewriter`.
+
+    The parts of the input are found using the public API of `HTMLParser`,
+    so this holds on all Python versions.
+    """
+    def action(x, lineno, tag, filename):
+        return x.replace('a', 'b')
+
+    try:
+        expected = PTParserRewriter(input, action)()
+    except PTParseError:
+        with pytest.raises(PTParseError):
+            PTSpliceRewriter(input, action)()
+    else:
+        assert PTSpliceRewriter(input, action)() == expected
+        output = io.StringIO()
+        PTSpliceRewriter(input, action)(output)
+        assert output.getvalue() == expected
+
+
+@pytest.mark.parametrize('rewriter', [PTParserRewriter, PTSpliceRewriter])
+def test_pagetemplates__PTParserRewriter____call____10(rewriter):
+    """It keeps the expressions and start tags which cannot be parsed and
+    lists them in the error after rewriting the rest of the input."""
+    def action(src, lineno, tag, filename):
+        if src.startswith('or'):
+            raise PTParseError('Cannot parse {!r}'.format(src))
+        return 'rewritten'
+
+    input = ('<p tal:attributes="a python:a; b python:or;; c"></p>\n'
+             '<p tal:content="python:a" tal:x class="c"></p>\n'
+             '<p tal:content="python:b" class="c"id="d"></p>\n'
+             '<p tal:content="python:c"></p>')
+    output = io.StringIO()
+    with pytest.raises(PTParseError) as err:
+        rewriter(input, action, filename='broken.pt')(output)
+    assert output.getvalue() == (
+        '<p tal:attributes="a python:rewritten; b python:or;; c"></p>\n'
+        '<p tal:content="python:a" tal:x class="c"></p>\n'
+        '<p tal:content="python:b" class="c"id="d"></p>\n'
+        '<p tal:content="python:rewritten"></p>')
+    assert err.value.filename == 'broken.pt'
+    assert err.value.errors == [{
+        'lineno': 1,
+        'tag': '<p tal:attributes="a python:a; b python:or;; c">',
+        'error': "Cannot parse 'or; c'",
+    }, {
+        'lineno': 2,
+        'tag': '<p tal:content="python:a" tal:x class="c">',
+        'error': "Attribute 'tal:x' has no value",
+    }, {
+        'lineno': 3,
+        'tag': '<p tal:content="python:b" class="c"id="d">',
+        'error': "Attribute 'id' is not preceded by whitespace",
+    }]
+
+
+def test_pagetemplates__PTParserRewriter____call____11():
+    """It treats a `ParseError` of lib2to3 raised by the rewrite action as a
+    parsing error."""
+    parse = pytest.importorskip('lib2to3.pgen2.parse')
+
+    def action(src, lineno, tag, filename):
+        raise parse.ParseError('bad input', 1, None, None)
+
+    input = '<p tal:content="python:a"></p>'
+    with pytest.raises(PTParseError) as err:
+        PTParserRewriter(input, action, filename='broken.pt')()
+    assert [(1, '<p tal:content="python:a">')] == [
+        (e['lineno'], e['tag']) for e in err.value.errors]
+
+
+@pytest.mark.parametrize('rewriter', [PTParserRewriter, PTSpliceRewriter])
+def test_pagetemplates__PTParserRewriter____call____12(rewriter):
+    """It rewrites start tags with attribute names containing characters
+    which are special in regular expressions."""
+    input = ('<p *ngIf="a" (click)="f()" [class]="c"'
+             ' tal:content="python:long(a)"></p>')
+    assert rewriter(input, rewrite_using_tokens)() == (
+        '<p *ngIf="a" (click)="f()" [class]="c"'
+        ' tal:content="python:int(a)"></p>')
+
+
+@pytest.mark.parametrize('rewriter', [PTParserRewriter, PTSpliceRewriter])
+def test_pagetemplates__PTParserRewriter____call____13(rewriter):
+    """It raises a `PTParseError` on a start tag which is not closed before
+    the next tag or comment."""
+    input = '<p <!-- c -- d -->\n<p tal:content="python:long(a)"></p>'
+    with pytest.raises(PTParseError) as err:
+        rewriter(input, rewrite_using_tokens, filename='broken.pt')()
+    assert err.value.errors == [{
+        'lineno': 1,
+        'tag': '<p <!-- c -- d -->',
+        'error': "Start tag is not closed before '<!--'",
+    }]
+
+
+def test_pagetemplates__PTParserRewriter____call____14(mocker):
+    """It returns the input as it is if it needs no rewrite."""
+    mocker.patch.object(PTParserRewriter, 'needs_rewrite', False)
+    input = '<p class="a <> b" />'
+    assert PTParserRewriter(input, None)() is input
+    output = io.StringIO()
+    PTParserRewriter(input, None)(output)
+    assert output.getvalue() == input
+
+
+def test_pagetemplates__action_errors__1(mocker):
+    """It only includes the `ParseError` of lib2to3 if it is imported."""
+    mocker.patch.dict(sys.modules, {'lib2to3.pgen2.parse': None})
+    assert action_errors() is PTParseError
@@ -0,0 +1,66 @@
+from ..stats import Stats
+import collections
+import json
+
+
+def test_stats__Stats__totals__1():
+    """It adds up the counters of the run and of the files."""
+    stats = Stats()
+    stats.counters['time.collect'] = 1.5
+    stats.add_file('a.pt', collections.Counter(files=1, expressions=2))
+    stats.add_file('b.pt', collections.Counter(files=1, expressions=3))
+    assert stats.totals == {'time.collect': 1.5, 'files': 2, 'expressions': 5}
+
+
+def test_stats__Stats__timer__1():
+    """It adds the time spent in the context to the phase."""
+    stats = Stats()
+    counters = collections.Counter()
+    with stats.timer('parse', counters):
+        pass
+    with stats.timer('parse', counters):
+        pass
+    with stats.timer('collect'):
+        pass
+    assert counters['time.parse'] > 0
+    assert stats.counters['time.collect'] > 0
+
+
+def test_stats__Stats__timed__1():
+    """It adds the time spent getting the items to the phase."""
+    stats = Stats()
+    assert [1, 2] == list(stats.timed(iter([1, 2]), 'collect'))
+    assert stats.counters['time.collect'] > 0
+
+
+def test_stats__Stats__merge__1():
+    """It adds the numbers of another instance calling the hooks."""
+    calls = []
+    stats = Stats()
+    stats.add_hook(lambda path, counters: calls.append((path, counters)))
+    other = Stats()
+    other.counters['batch_expressions'] = 4
+    other.add_file('a.pt', collections.Counter(files=1))
+    stats.merge(other)
+    stats.finish()
+    assert calls == [('a.pt', {'files': 1}),
+                     (None, {'files': 1, 'batch_expressions': 4})]
+
+
+def test_stats__Stats__dump__1(tmpdir):
+    """It writes the totals and the numbers per file as JSON."""
+    stats = Stats()
+    stats.add_file('a.pt', collections.Counter(files=1))
+    stats.dump(str(tmpdir.join('stats.json')))
+    assert json.loads(tmpdir.join('stats.json').read()) == {
+        'totals': {'files': 1}, 'files': {'a.pt': {'files': 1}}}
+
+
+def test_stats__Stats__report__1():
+    """It renders the counters and timers as table."""
+    stats = Stats()
+    stats.counters['files'] = 3
+    stats.counters['time.parse'] = 0.25
+    assert stats.report() == (
+        'files                  3\n'
+        'time.parse        0.250s')
@@ -0,0 +1,329 @@
+from ..benchmark import EXPRESSIONS
+from ..pagetemplates import PTParseError
+from ..tokenrewrite import get_fixes
+from ..tokenrewrite import rewrite_using_tokens
+from ..tokenrewrite import use_fixes
+import pytest
+import time
+import warnings
+
+
+# Upper bound of the mean time to rewrite an expression in seconds.
+LATENCY_TARGET = 0.001
+
+# Python 2 expressions and statements which are rewritten the same way by
+# lib2to3 and the token engine.
+COMPATIBILITY = [
+    'print "Hello world"',
+    'print',
+    'print x,',
+    'print >>f, x, y,',
+    'print (x)',
+    'print (a, b)',
+    'print d.has_key(x)',
+    'x; print y',
+    'for i in range(len(x)): print i',
+    "a.has_key('b')",
+    "not a.has_key('b') and c",
+    'not a.has_key(b) == c',
+    'a.has_key(b) + 1',
+    '-a.has_key(b)',
+    'x is not a.has_key(b)',
+    'a.has_key(b) if c else d',
+    'a.has_key(b or c)',
+    'a.has_key( b )',
+    'a.has_key(b).real',
+    'a.b[1].has_key(x)',
+    'a.has_key(b.has_key(c))',
+    'a.has_key(x, y)',
+    'a.has_key(x,)',
+    'lambda x: x.has_key(y)',
+    "test(here.has_key('x'), 'a', 'b')",
+    'd.keys()',
+    'd.keys()[0]',
+    'sorted(d.keys())',
+    'len(d.keys())',
+    'd.iteritems()',
+    'dict(items.iteritems())',
+    'iter(d.iteritems())',
+    '[x for x in d.iteritems() if x]',
+    '[x for x in d.keys()]',
+    '{k: v for k, v in d.iteritems()}',
+    'for x in d.iteritems(): pass',
+    'd.viewkeys()',
+    'd .keys( )',
+    'f(*d.keys())',
+    'x in d.keys()',
+    'd.itervalues().next()',
+    'unicode(x)',
+    'unichr(10)',
+    "u'abc'",
+    'u"a\\u1234" + "\\u12"',
+    "ur'x'",
+    "u'a' 'b'",
+    'isinstance(x, (str, unicode))',
+    'isinstance(x, (int, long, float))',
+    'long(a)',
+    'x.long',
+    '10L + 0777 + 0xFFL + 00',
+    'basestring',
+    'a <> b',
+    '`x`',
+    '`a, b`',
+    'StandardError',
+    'xrange(10)',
+    'range( 1, 2 )',
+    'list(range(10))',
+    '[i for i in range(3)]',
+    'x in range(3)',
+    'x not in range(3)',
+    'range(3)[0]',
+    "raw_input('x')",
+    "input('x')",
+    "eval(input('x'))",
+    'x.raw_input()',
+    'f.func_name',
+    'f.im_class',
+    'sys.maxint',
+    'x.sys.maxint',
+    'os.getcwdu()',
+    'map(f, x)',
+    'len(map(f, x))',
+    'len(map(None, x))',
+    'len(map(lambda x: x.title, items))',
+    'len(map(None, a, b))',
+    "', '.join(map(str, x))",
+    'sorted(map(f, x), key=g)',
+    'len(filter(lambda x: a if x else b, items))',
+    'len(filter(None, items))',
+    'zip(a, b)',
+    'len(zip(a, b)[0])',
+    'dict(zip(a, b))',
+    'for a, b in zip(x, y): pass',
+    'exec "x = 1"',
+    'exec code in ns, l',
+    'try:\n    x\nexcept (A, B), e:\n    y',
+    'iter.next()',
+    "item.get('title', None) or ''",
+    'a if b else c',
+    'apply(f, args)',
+    'apply(f, args, kw)',
+    'apply(a.b, (1,))',
+    'apply(a + b, x)',
+    'apply(f, *x)',
+    'apply(f, d.keys())',
+    'reduce(f, x)',
+    'reduce(f, x, 0)',
+    'reduce(f, x)[0]',
+    'x = reduce(f, x)\ny = 1',
+    'reduce(f, intern(x))',
+    'imap(f, x)',
+    'itertools.imap(f, x)',
+    'itertools.izip(a, b)',
+    'itertools.ifilterfalse(f, x)',
+    'izip_longest(a, b)',
+    'intern(x)',
+    'intern( x ).y',
+    'x.intern(y)',
+    'reload(x)',
+    'types.StringType',
+    'types.NoneType',
+    'isinstance(x, types.StringTypes)',
+    'x.types.StringType',
+    'operator.isCallable(x)',
+    'operator.sequenceIncludes(a, b)',
+    'operator.isSequenceType(x)',
+    'operator.isNumberType(x) and operator.isMappingType(x)',
+    'operator.repeat(a, 2)',
+    'isCallable(x)',
+    'sys.exc_type',
+    'sys.exc_value',
+    'sys .exc_traceback',
+    'lambda (a, b): a + b',
+    'map(lambda (k, v): k, d.items())',
+    'x = map(lambda (k, v): k, y)',
+    'filter(lambda (k, v): v, x)',
+    'lambda (a): a',
+    'lambda ((a, b), c): a + b + c',
+    'lambda (a, b): lambda (a, b): a',
+    'lambda (a, b): x.a',
+    'a_b + (lambda (a, b): a)(x)',
+    '[x for x in 1, 2]',
+    '[x for x in 1, 2 if x]',
+    '(x for x in 1, 2,)',
+    'raise E, v',
+    'raise E, v, t',
+    'raise E, None, t',
+    'raise E, (a, b)',
+    'raise (E1, E2), V',
+    'raise E',
+    'if x: raise E, v',
+    'g.throw(E, v)',
+    'g.throw(E, v, t)',
+    'execfile(x)',
+    'execfile(x, g, l)',
+    'self.assertEquals(a, b)',
+    'f.xreadlines()',
+    'f.xreadlines',
+]
+
+
+@pytest.mark.parametrize('src, expected', [
+    ('print "Hello world"', 'print("Hello world")'),
+    ('print >>f, x,', "print(x, end=' ', file=f)"),
+    ("a.has_key('b')", "'b' in a"),
+    ("not a.has_key('b')", "'b' not in a"),
+    ('a.has_key(b) == c', '(b in a) == c'),
+    ('a.has_key(not x)', '(not x) in a'),
+    ('d.keys()[0]', 'list(d.keys())[0]'),
+    ('len(d.iteritems())', 'len(iter(d.items()))'),
+    ('sorted(d.iteritems())', 'sorted(d.items())'),
+    ('d.viewvalues()', 'd.values()'),
+    ('unicode(x) + u"\\u1234"', 'str(x) + "\\u1234"'),
+    ('"\\u1234"', '"\\\\u1234"'),
+    ('10L + 0777', '10 + 0o777'),
+    ('a <> b', 'a != b'),
+    ('`a, b`', 'repr((a, b))'),
+    ('isinstance(x, (str, unicode))', 'isinstance(x, str)'),
+    ('len(xrange(3)) + len(range(3))', 'len(range(3)) + len(list(range(3)))'),
+    ('len(filter(lambda x: x > 0, items))',
+     'len([x for x in items if x > 0])'),
+    ('exec code in ns', 'exec(code, ns)'),
+    ('try:\n    x\nexcept E, e:\n    y', 'try:\n    x\nexcept E as e:\n    y'),
+    ('apply(f, args, kw)', 'f(*args, **kw)'),
+    ('reduce(f, x)', 'from functools import reduce\nreduce(f, x)'),
+    ('intern(x)', 'import sys\nsys.intern(x)'),
+    ('itertools.imap(f, x)', 'map(f, x)'),
+    ('isinstance(x, types.StringTypes)', 'isinstance(x, (str,))'),
+    ('operator.isCallable(x)', 'callable(x)'),
+    ('sys.exc_type', 'sys.exc_info()[0]'),
+    ('lambda (a, b): a + b', 'lambda a_b: a_b[0] + a_b[1]'),
+    ('[x for x in 1, 2]', '[x for x in (1, 2)]'),
+    ('raise E, v', 'raise E(v)'),
+    # Operands and arguments which are parenthesized or not:
+    ('f(*d.has_key(k))', 'f(*k in d)'),
+    ('x in d.has_key(k)', 'x in (k in d)'),
+    # Names which only look like the ones the fixers change:
+    ('string.join(a, b) + number', 'string.join(a, b) + number'),
+    ('func_name + im_func', 'func_name + im_func'),
+    ('getcwdu() + failUnless(x)', 'getcwdu() + failUnless(x)'),
+    ('g.throw("foo", v)', 'g.throw("foo", v)'),
+    ('f.xreadlines() ** 2', 'f.xreadlines() ** 2'),
+    # Statements:
+    ('print', 'print()'),
+    ('print >>f', 'print(file=f)'),
+    ('print x;', 'print(x);'),
+    ('try: x\nexcept (A, B): y', 'try: x\nexcept (A, B): y'),
+    ('try: x\nexcept E,e: y', 'try: x\nexcept E as e: y'),
+    ('raise', 'raise'),
+    ('raise E from e', 'raise E from e'),
+    ('raise "foo"', 'raise "foo"'),
+    ('raise (E, V)', 'raise E'),
+    # Builtins which are called with other arguments:
+    ('filter(f, l)', 'list(filter(f, l))'),
+    ('for x in filter(f, l): y', 'for x in filter(f, l): y'),
+    ('isinstance(x, ())', 'isinstance(x, ())'),
+    ('apply(f) + apply(f, a, k=1)', 'apply(f) + apply(f, a, k=1)'),
+    ('intern(x,)', 'import sys\nsys.intern(x,)'),
+    ('intern(a) + intern(b)', 'import sys\nsys.intern(a) + sys.intern(b)'),
+    ('intern(*a) + intern(k=x) + intern()',
+     'intern(*a) + intern(k=x) + intern()'),
+    ('reduce(f)', 'reduce(f)'),
+    ('execfile(a, b, c, d)',
+     'exec(compile(open(a, b, c, d, "rb").read(), a, b, c, d, \'exec\'))'),
+    # Lambdas using their tuple parameters in brackets:
+    ('lambda (x, y): f(x)', 'lambda x_y: f(x_y[0])'),
+    ('lambda (x, y): (lambda (a, b): a)', 'lambda x_y: (lambda a_b: a_b[0])'),
+])
+def test_tokenrewrite__rewrite_using_tokens__1(src, expected):
+    """It rewrites like the lib2to3 fixers."""
+    assert rewrite_using_tokens(src, None, None, None) == expected
+
+
+def test_tokenrewrite__rewrite_using_tokens__2():
+    """It returns unchanged expressions including leading white space."""
+    assert rewrite_using_tokens(' x.next()', None, None, None) == ' x.next()'
+    assert rewrite_using_tokens(' long(x)', None, None, None) == 'int(x)'
+    assert rewrite_using_tokens('exec', None, None, None) == 'exec'
+
+
+@pytest.mark.parametrize('src', [
+    'or or', 'invalid syntax', 'foo(', 'foo)', '(]', 'a $ b', "'abc",
+    'a\n  or b', 'try: x\nexcept E, e', 'exec in d', 'lambda (x, 1): x',
+    'lambda (x, y=1): x',
+])
+def test_tokenrewrite__rewrite_using_tokens__3(src):
+    """It raises a `PTParseError` if the expression cannot be parsed."""
+    with pytest.raises(PTParseError):
+        rewrite_using_tokens(src, None, None, None)
+
+
+def test_tokenrewrite__rewrite_using_tokens__4():
+    """It rewrites an expression in less than `LATENCY_TARGET`."""
+    expressions = [
+        expr.format(name='title', num=1) for expr in EXPRESSIONS] * 50
+    start = time.perf_counter()
+    for expr in expressions:
+        rewrite_using_tokens(expr, None, None, None)
+    elapsed = time.perf_counter() - start
+    assert elapsed / len(expressions) < LATENCY_TARGET
+
+
+@pytest.mark.parametrize('src, fixer', [
+    ('urllib.quote(x)', 'urllib'),
+    ('sys.exitfunc = f', 'exitfunc'),
+    ('from itertools import imap', 'future'),
+    ('def __nonzero__(self): pass', 'nonzero'),
+    ('sys.path + intern(x)', 'intern'),
+    ("'doc'\nreduce(f, x)", 'reduce'),
+    ('raise ()', 'raise'),
+])
+def test_tokenrewrite__rewrite_using_tokens__6(src, fixer):
+    """It raises a `PTParseError` if the expression needs a fixer which is not
+    supported."""
+    with pytest.raises(PTParseError) as err:
+        rewrite_using_tokens(src, None, None, None)
+    assert "the fixer '{}' is not supported".format(fixer) in str(err.value)
+
+
+def test_tokenrewrite__rewrite_using_tokens__7():
+    """It leaves expressions unchanged which only unsupported fixers in
+    `--exclude-fixers` would change."""
+    fixes = get_fixes()
+    use_fixes([fix for fix in fixes if fix != 'urllib'])
+    try:
+        assert rewrite_using_tokens(
+            'urllib.quote(x)', None, None, None) == 'urllib.quote(x)'
+    finally:
+        use_fixes(fixes)
+
+
+def test_tokenrewrite__rewrite_using_tokens__8():
+    """It rewrites lambdas with a parenthesized parameter in `map` and
+    `filter` if `tuple_params` is in `--exclude-fixers`."""
+    fixes = get_fixes()
+    use_fixes([fix for fix in fixes if fix != 'tuple_params'])
+    try:
+        assert rewrite_using_tokens(
+            'x = map(lambda (x): x + 1, l)', None, None, None) == (
+            'x = [x + 1 for x in l]')
+        assert rewrite_using_tokens(
+            'x = filter(lambda (x): x, l)', None, None, None) == (
+            'x = [x for x in l if x]')
+        with pytest.raises(PTParseError):
+            rewrite_using_tokens(
+                'x = map(lambda (x, y): x, l)', None, None, None)
+    finally:
+        use_fixes(fixes)
+
+
+@pytest.mark.parametrize('src', COMPATIBILITY + [
+    expr.format(name='title', num=1) for expr in EXPRESSIONS])
+def test_tokenrewrite__rewrite_using_tokens__5(src):
+    """It is compatible with the lib2to3 engine where lib2to3 exists."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        pytest.importorskip('lib2to3.refactor')
+        from ..lib2to3 import rewrite_using_2to3
+    expected = rewrite_using_2to3(src, None, None, None)
+    assert rewrite_using_tokens(src, None, None, None) == expected
@@ -0,0 +1,1428 @@
+"""Rewrite Python 2 expressions to Python 3 based on their tokens.
+
+The fixers of lib2to3 are implemented on the tokens of the expression, nested
+by brackets, instead of a syntax tree. The output is the same as the one of
+the lib2to3 fixers of the same name. The result is checked using the `ast`
+module.
+
+The fixers in `UNSUPPORTED` are not implemented, they mostly rewrite import
+statements. An expression containing a token they could change is reported as
+error unless they are excluded.
+"""
+from gocept.template_rewrite.pagetemplates import PTParseError
+import ast
+import hashlib
+import itertools
+import re
+
+
+# White space, line continuations and comments before a token.
+_PREFIX = r'(?P<prefix>(?:[ \t\f\r\n]|\\\r?\n|#[^\r\n]*)*)'
+_STRING = (r'(?P<string>[rRuUbBfF]{0,2}(?:'
+           r"'''(?:[^\\]|\\[\w\W])*?'''|"
+           r'"""(?:[^\\]|\\[\w\W])*?"""|'
+           r"'(?:[^'\\\r\n]|\\[\w\W])*'|"
+           r'"(?:[^"\\\r\n]|\\[\w\W])*"))')
+_NUMBER = (r'(?P<number>(?:0[xX][0-9a-fA-F]+|0[oO][0-7]+|0[bB][01]+|'
+           r'(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?)[jJlL]?)')
+_NAME = r'(?P<name>[^\W\d]\w*)'
+_OP = (r'(?P<op>\*\*=?|//=?|<<=?|>>=?|<>|[!=<>]=|->|\.\.\.|[-+*/%&|^@:]=|'
+       r'[-+*/%&|^~<>=.,:;@(){}\[\]`])')
+RE_TOKEN = re.compile(
+    _PREFIX + '(?:' + '|'.join([_STRING, _NUMBER, _NAME, _OP]) + ')?')
+RE_CONTINUATION = re.compile(r'\\\r?\n')
+
+BRACKETS = {'(': ')', '[': ']', '{': '}'}
+
+KEYWORDS = {
+    'and', 'as', 'assert', 'break', 'class', 'continue', 'def', 'del',
+    'elif', 'else', 'except', 'exec', 'finally', 'for', 'from', 'global',
+    'if', 'import', 'in', 'is', 'lambda', 'nonlocal', 'not', 'or', 'pass',
+    'print', 'raise', 'return', 'try', 'while', 'with', 'yield'}
+
+# Keywords starting a statement which ends in a colon.
+COMPOUND_STATEMENTS = {
+    'class', 'def', 'elif', 'else', 'except', 'finally', 'for', 'if', 'try',
+    'while', 'with'}
+
+# Operators binding tighter than `not`, an operand of them is parenthesized.
+OPERATORS = {
+    '<', '>', '==', '>=', '<=', '!=', '<>', '|', '^', '&', '<<', '>>', '+',
+    '-', '*', '/', '%', '//', '**', '~', '@'}
+
+# Tokens which make an expression more than an operand of `in`.
+COMPOUND = {
+    '<', '>', '==', '>=', '<=', '!=', '<>', 'in', 'not', 'is', 'and', 'or',
+    'if', 'lambda', 'for'}
+
+# Calls which consume the whole iterable passed to them, see lib2to3.
+CONSUMING_CALLS = {
+    'sorted', 'list', 'set', 'any', 'all', 'tuple', 'sum', 'min', 'max',
+    'enumerate'}
+ITER_EXEMPT = CONSUMING_CALLS | {'iter'}
+ITERATING_CALLS = {
+    'iter', 'list', 'tuple', 'sorted', 'set', 'sum', 'any', 'all',
+    'enumerate', '.join'}
+
+DICT_METHODS = {
+    'keys', 'items', 'values', 'iterkeys', 'iteritems', 'itervalues',
+    'viewkeys', 'viewitems', 'viewvalues'}
+FUNC_ATTRS = {
+    'func_closure', 'func_doc', 'func_globals', 'func_name', 'func_defaults',
+    'func_code', 'func_dict'}
+METHOD_ATTRS = {
+    'im_func': '__func__', 'im_self': '__self__',
+    'im_class': '__self__.__class__'}
+NAMES = {
+    'unicode': 'str', 'unichr': 'chr', 'basestring': 'str',
+    'StandardError': 'Exception'}
+ASSERTS = {
+    'assert_': 'assertTrue', 'assertEquals': 'assertEqual',
+    'assertNotEquals': 'assertNotEqual',
+    'assertAlmostEquals': 'assertAlmostEqual',
+    'assertNotAlmostEquals': 'assertNotAlmostEqual',
+    'assertRegexpMatches': 'assertRegex',
+    'assertRaisesRegexp': 'assertRaisesRegex',
+    'failUnlessEqual': 'assertEqual', 'failIfEqual': 'assertNotEqual',
+    'failUnlessAlmostEqual': 'assertAlmostEqual',
+    'failIfAlmostEqual': 'assertNotAlmostEqual', 'failUnless': 'assertTrue',
+    'failUnlessRaises': 'assertRaises', 'failIf': 'assertFalse'}
+TYPES = {
+    'BooleanType': 'bool', 'BufferType': 'memoryview', 'ClassType': 'type',
+    'ComplexType': 'complex', 'DictType': 'dict', 'DictionaryType': 'dict',
+    'EllipsisType': 'type(Ellipsis)', 'FloatType': 'float', 'IntType': 'int',
+    'ListType': 'list', 'LongType': 'int', 'ObjectType': 'object',
+    'NoneType': 'type(None)', 'NotImplementedType': 'type(NotImplemented)',
+    'SliceType': 'slice', 'StringType': 'bytes', 'StringTypes': '(str,)',
+    'TupleType': 'tuple', 'TypeType': 'type', 'UnicodeType': 'str',
+    'XRangeType': 'range'}
+ITERTOOLS = {'imap', 'ifilter', 'izip', 'izip_longest', 'ifilterfalse'}
+# The functions of `operator` and their replacement: a function of
+# `operator`, `callable` or the abstract base class to check `isinstance`.
+OPERATOR = {
+    'sequenceIncludes': 'contains', 'repeat': 'mul', 'irepeat': 'imul',
+    'isCallable': 'callable',
+    'isSequenceType': 'collections.abc.Sequence',
+    'isMappingType': 'collections.abc.Mapping',
+    'isNumberType': 'numbers.Number'}
+EXC_INFO = ['exc_type', 'exc_value', 'exc_traceback']
+
+# The fixers of lib2to3 used by default which are not implemented together
+# with the tokens they could change.
+UNSUPPORTED = [
+    ('exitfunc', {'exitfunc'}),
+    ('future', {'import'}),
+    ('import', {'import'}),
+    ('imports', {'import'}),
+    ('imports2', {'import'}),
+    ('itertools_imports', {'import'}),
+    ('metaclass', {'__metaclass__'}),
+    ('nonzero', {'__nonzero__'}),
+    ('urllib', {'urllib', 'urllib2'}),
+]
+
+
+class Unsupported(Exception):
+    """An expression needs a fixer which is not implemented for it."""
+
+
+class Leaf(object):
+    """A token and the white space preceding it.
+
+    `type` is the name of the token group of `RE_TOKEN` or `atom` resp.
+    `comparison` for text already rewritten by a fixer.
+    """
+
+    def __init__(self, type, value, prefix=''):
+        self.type = type
+        self.value = value
+        self.prefix = prefix
+
+    def __str__(self):
+        return self.prefix + self.value
+
+
+class Group(object):
+    """Tokens enclosed in brackets or backticks."""
+
+    type = 'group'
+
+    def __init__(self, open_):
+        self.open = open_
+        self.value = open_.value
+        self.items = []
+        self.close = None
+
+    @property
+    def prefix(self):
+        return self.open.prefix
+
+    def __str__(self):
+        return str(self.open) + _render(self.items) + str(self.close)
+
+
+class Root(Group):
+    """The tokens of an expression and the changes to it as a whole."""
+
+    def __init__(self, src):
+        super().__init__(Leaf('op', ''))
+        self.close = Leaf('op', '')
+        self.src = src
+        # `(fixer, package, name)` of the imports to add, see `_touch_import`.
+        self.imports = []
+        self._names = None
+        self._numbers = itertools.count(1)
+
+    @property
+    def names(self):
+        """The names used in the expression, computed on first use."""
+        if self._names is None:
+            self._names = {
+                match.group('name') for match in RE_TOKEN.finditer(self.src)
+                if match.lastgroup == 'name'}
+        return self._names
+
+    def new_name(self, template):
+        """Return a name not used in the expression like lib2to3 does."""
+        name = template
+        while name in self.names:
+            name += str(next(self._numbers))
+        self.names.add(name)
+        return name
+
+
+def _render(items):
+    return ''.join(str(item) for item in items)
+
+
+def _text(items, prefix=''):
+    """Render `items` with `prefix` instead of the white space before them."""
+    if not items:
+        return ''
+    return prefix + _render(items)[len(items[0].prefix):]
+
+
+def _is(item, *values):
+    """Tell whether `item` is one of the operators or names in `values`."""
+    return item.type in ('op', 'name') and item.value in values
+
+
+def _is_name(item, *values):
+    return item.type == 'name' and item.value in values
+
+
+def _is_call(item):
+    return item.type == 'group' and item.value == '('
+
+
+def _split(items):
+    """Split `items` at the commas."""
+    parts = [[]]
+    for item in items:
+        if _is(item, ','):
+            parts.append([])
+        else:
+            parts[-1].append(item)
+    return parts
+
+
+def _arguments(items):
+    """Split `items` into arguments, a trailing comma is left out.
+
+    Returns `None` if an argument is empty.
+    """
+    args = _split(items)
+    if len(args) > 1 and not args[-1]:
+        args.pop()
+    return args if all(args) else None
+
+
+def _is_keyword(arg):
+    return len(arg) > 2 and _is(arg[1], '=')
+
+
+def tokenize(src):
+    """Return the tokens of `src` nested by brackets.
+
+    Raises `PTParseError` on invalid tokens and unbalanced brackets.
+    """
+    root = Root(src)
+    stack = [root]
+    pos = 0
+    while True:
+        match = RE_TOKEN.match(src, pos)
+        prefix = match.group('prefix')
+        if match.lastgroup == 'prefix':
+            if match.end() < len(src):
+                raise PTParseError(
+                    'Invalid token at {}: {!r}'.format(match.end(), src))
+            root.close.prefix = prefix
+            break
+        pos = match.end()
+        leaf = Leaf(match.lastgroup, match.group(match.lastgroup), prefix)
+        top = stack[-1]
+        if leaf.type != 'op':
+            top.items.append(leaf)
+        elif leaf.value in BRACKETS or (
+                leaf.value == '`' and top.value != '`'):
+            group = Group(leaf)
+            top.items.append(group)
+            stack.append(group)
+        elif leaf.value in ')]}`':
+            if BRACKETS.get(top.value, '`') != leaf.value or top is root:
+                raise PTParseError('Unbalanced {!r}: {!r}'.format(
+                    leaf.value, src))
+            top.close = leaf
+            stack.pop()
+        else:
+            top.items.append(leaf)
+    if len(stack) > 1:
+        raise PTParseError('Unclosed {!r}: {!r}'.format(stack[-1].value, src))
+    return root
+
+
+class Chain(object):
+    """A primary expression: an atom followed by attributes, calls and
+    subscriptions in `items[start:end]`."""
+
+    def __init__(self, items, start, end, call, root):
+        self.items = items
+        self.start = start
+        self.end = end
+        self.parts = items[start:end]
+        self.call = call
+        self.root = root
+
+    @property
+    def top(self):
+        """Tell whether the chain is not in brackets."""
+        return self.items is self.root.items
+
+    @property
+    def prefix(self):
+        return self.parts[0].prefix
+
+    @property
+    def prev(self):
+        return self.items[self.start - 1] if self.start else None
+
+    @property
+    def next(self):
+        return self.items[self.end] if self.end < len(self.items) else None
+
+    @property
+    def is_power(self):
+        """Tell whether the chain is a whole `power` node of lib2to3, i.e. not
+        the base of `**`."""
+        return self.next is None or not _is(self.next, '**')
+
+    @property
+    def is_argument(self):
+        """Tell whether the chain is the only argument of a call."""
+        return self.call is not None and self.start == 0 and (
+            self.end == len(self.items))
+
+    @property
+    def is_first_argument(self):
+        """Tell whether the chain is the first of several arguments."""
+        return self.call is not None and self.start == 0 and (
+            self.next is not None and _is(self.next, ','))
+
+    @property
+    def is_statement(self):
+        """Tell whether the chain is an expression statement."""
+        return self.top and (self.prev is None or _is(self.prev, ';')) and (
+            self.next is None or _is(self.next, ';'))
+
+    def _in_for(self, index):
+        """Tell whether `items[index]` is the `in` of a `for` loop."""
+        for item in reversed(self.items[:index]):
+            if _is(item, 'for'):
+                return True
+            if item.type in ('op', 'name') and not _is(item, ',', '.', '*') \
+                    and (item.type == 'op' or item.value in KEYWORDS):
+                return False
+        return False
+
+    @property
+    def is_iterable(self):
+        """Tell whether the chain is iterated over by a `for` loop."""
+        prev, next_ = self.prev, self.next
+        return (
+            prev is not None and _is(prev, 'in') and
+            self._in_for(self.start - 1) and
+            (next_ is None or _is(next_, 'for', 'if', ':')))
+
+    @property
+    def is_tested(self):
+        """Tell whether the chain is the right hand side of `in`."""
+        prev, next_ = self.prev, self.next
+        return (
+            prev is not None and _is(prev, 'in') and
+            not self._in_for(self.start - 1) and
+            not (self.start > 1 and _is(self.items[self.start - 2], 'not')) and
+            (next_ is None or not _is(next_, *OPERATORS)))
+
+    @property
+    def is_negated(self):
+        """Tell whether the chain is the operand of a unary `not`."""
+        prev = self.prev
+        return (
+            prev is not None and _is(prev, 'not') and
+            not (self.start > 1 and _is(self.items[self.start - 2], 'is')) and
+            not self._binds_next)
+
+    @property
+    def _binds_next(self):
+        next_ = self.next
+        return next_ is not None and (
+            _is(next_, 'in', 'is', 'not', *OPERATORS))
+
+    @property
+    def is_operand(self):
+        """Tell whether the chain is an operand of an operator binding
+        tighter than `not`."""
+        prev = self.prev
+        if prev is not None:
+            if _is(prev, '*', '**') and (
+                    self.start == 1 or _is(self.items[self.start - 2], ',')):
+                return False  # star argument
+            if _is(prev, 'is', *OPERATORS):
+                return True
+            if _is(prev, 'in') and not self._in_for(self.start - 1):
+                return True
+            if _is(prev, 'not') and self.start > 1 and (
+                    _is(self.items[self.start - 2], 'is')):
+                return True
+        return self._binds_next
+
+    def in_special_context(self):
+        """Tell whether only iterating over the chain matters.
+
+        This is `lib2to3.fixer_util.in_special_context`.
+        """
+        return self.is_iterable or (
+            self.is_argument and self.call in ITERATING_CALLS) or (
+            self.is_first_argument and self.call in ('sorted', 'enumerate'))
+
+    def trailers(self, start):
+        """Split the parts from `start` into the trailers."""
+        trailers = []
+        index = start
+        while index < len(self.parts):
+            size = 2 if _is(self.parts[index], '.') else 1
+            trailers.append(self.parts[index:index + size])
+            index += size
+        return trailers
+
+
+def _chain_end(items, start):
+    end = start + 1
+    if items[start].type == 'string':
+        while end < len(items) and items[end].type == 'string':
+            end += 1
+    while end < len(items):
+        item = items[end]
+        if item.type == 'group' and item.value in '([':
+            end += 1
+        elif _is(item, '.') and end + 1 < len(items) and (
+                items[end + 1].type == 'name'):
+            end += 2
+        else:
+            break
+    return end
+
+
+def _is_atom(item):
+    if item.type in ('string', 'number', 'atom'):
+        return True
+    if item.type == 'group':
+        return item.value in BRACKETS
+    return item.type == 'name' and item.value not in KEYWORDS
+
+
+def _call_name(items, index):
+    """Return the name of the function called by `items[index]`.
+
+    It is `.join` for calls of a `join` method, an empty string for other
+    calls and `None` if `items[index]` is not a call.
+    """
+    if not _is_call(items[index]) or index == 0:
+        return None
+    prev = items[index - 1]
+    if prev.type == 'name' and prev.value not in KEYWORDS:
+        if index > 1 and _is(items[index - 2], '.'):
+            return '.join' if prev.value == 'join' else ''
+        return prev.value
+    if prev.type == 'group' and prev.value in '([':
+        return ''
+    return None
+
+
+# Fixers of single tokens, they are only called for the tokens they can
+# change, see `TOKEN_FIXERS`. Names like `string` are passed to the fixers of
+# the token type as well.
+
+
+def fix_ne(items, index):
+    items[index].value = '!='
+
+
+def fix_numliterals(items, index):
+    leaf = items[index]
+    if leaf.type != 'number':
+        return
+    value = leaf.value
+    if value[-1] in 'Ll':
+        leaf.value = value[:-1]
+    elif value.startswith('0') and value.isdigit() and len(set(value)) > 1:
+        leaf.value = '0o' + value[1:]
+
+
+def fix_unicode(items, index):
+    leaf = items[index]
+    if _is_name(leaf, 'unicode', 'unichr'):
+        leaf.value = NAMES[leaf.value]
+    elif leaf.type == 'string':
+        value = leaf.value
+        if value[0] in '\'"' and '\\' in value:
+            value = r'\\'.join([
+                v.replace('\\u', r'\\u').replace('\\U', r'\\U')
+                for v in value.split(r'\\')
+            ])
+        if value[0] in 'uU':
+            value = value[1:]
+        leaf.value = value
+
+
+def fix_basestring(items, index):
+    items[index].value = 'str'
+
+
+def fix_standarderror(items, index):
+    items[index].value = 'Exception'
+
+
+def fix_long(items, index):
+    if _is_name(items[index], 'long') and not (
+            index and _is(items[index - 1], '.')):
+        items[index].value = 'int'
+
+
+def _attribute(items, index, names):
+    return _is_name(items[index], *names) and index > 1 and (
+        _is(items[index - 1], '.'))
+
+
+def fix_funcattrs(items, index):
+    if _attribute(items, index, FUNC_ATTRS):
+        items[index].value = '__{}__'.format(items[index].value[5:])
+
+
+def fix_methodattrs(items, index):
+    if _attribute(items, index, METHOD_ATTRS):
+        items[index].value = METHOD_ATTRS[items[index].value]
+
+
+def _module_attribute(items, index, module, name):
+    return _attribute(items, index, [name]) and (
+        _is_name(items[index - 2], module)) and not (
+        index > 2 and _is(items[index - 3], '.'))
+
+
+def fix_renames(items, index):
+    if _module_attribute(items, index, 'sys', 'maxint'):
+        items[index].value = 'maxsize'
+
+
+def fix_getcwdu(items, index):
+    if _module_attribute(items, index, 'os', 'getcwdu'):
+        items[index].value = 'getcwd'
+
+
+def fix_asserts(items, index):
+    if _attribute(items, index, ASSERTS):
+        items[index].value = ASSERTS[items[index].value]
+
+
+def _unsupported(name):
+    """Return a fixer which reports that the fixer `name` is needed."""
+    def fix_unsupported(items, index):
+        raise Unsupported(name)
+    return fix_unsupported
+
+
+def fix_repr(items, index):
+    group = items[index]
+    expr = _render(group.items)
+    if len(_split(group.items)) > 1:
+        expr = '(' + expr + ')'
+    items[index] = Leaf('atom', 'repr(' + expr + ')', group.prefix)
+
+
+# Fixers of statements, they get the tokens of one statement starting with
+# their keyword.
+
+
+def _print_arguments(items):
+    """Return the arguments of `print` as a call."""
+    end = file_ = None
+    if items and _is(items[-1], ','):
+        items = items[:-1]
+        end = ' '
+    if items and _is(items[0], '>>'):
+        file_, _, items = _partition(items[1:])
+    args = [_text(items)] if items else []
+    if end is not None:
+        args.append('end=' + repr(end))
+    if file_ is not None:
+        args.append('file=' + _text(file_))
+    return ', '.join(args)
+
+
+def _partition(items):
+    """Split `items` at the first comma."""
+    for index, item in enumerate(items):
+        if _is(item, ','):
+            return items[:index], item, items[index + 1:]
+    return items, None, []
+
+
+def fix_print(items):
+    args = items[1:]
+    if len(args) == 1 and args[0].type == 'group' and args[0].value == '(':
+        inner = args[0].items
+        if not inner or len(inner) == 1 and (
+                inner[0].type in ('name', 'string', 'group', 'atom')) or (
+                all(item.type == 'string' for item in inner)):
+            return
+    call = 'print(' + _print_arguments(args) + ')'
+    items[:] = [Leaf('atom', call, items[0].prefix)]
+
+
+def fix_exec(items):
+    if len(items) < 2:
+        return
+    code, rest = items[1:], []
+    for index, item in enumerate(code):
+        if _is(item, 'in'):
+            code, rest = code[:index], code[index + 1:]
+            break
+    args = _text(code)
+    if rest:
+        args += ',' + _render(rest)
+    items[:] = [Leaf('atom', 'exec(' + args + ')', items[0].prefix)]
+
+
+def fix_except(items):
+    colon = next(
+        (index for index, item in enumerate(items) if _is(item, ':')), None)
+    if colon is None:
+        return
+    parts = _split(items[1:colon])
+    if len(parts) == 2 and len(parts[1]) == 1 and parts[1][0].type == 'name':
+        comma = colon - 2
+        items[comma] = Leaf('name', 'as', ' ')
+        if not items[comma + 1].prefix:
+            items[comma + 1].prefix = ' '
+
+
+def _is_tuple(items):
+    """Tell whether `items` are parenthesized tokens, which lib2to3 takes for
+    a tuple."""
+    if len(items) != 1 or not _is_call(items[0]):
+        return False
+    inner = items[0].items
+    return not inner or len(inner) > 1 or (
+        inner[0].type in ('group', 'atom', 'comparison'))
+
+
+def _with_value(exc, val, tb=None, call=True):
+    """Return the exception `exc` created using `val` as lib2to3 does."""
+    if _is_tuple(val):
+        args = _render(val[0].items)
+    else:
+        args = _text(val)
+    new = _render(exc)
+    if call:
+        new += '(' + args + ')'
+    if tb is not None:
+        new += '.with_traceback(' + _text(tb) + ')'
+    return new
+
+
+def fix_raise(items):
+    if len(items) < 2:
+        return
+    args = _split(items[1:])
+    if len(args) > 3 or not all(args) or any(
+            _is(item, 'from') for item in items):
+        return
+    exc = args[0]
+    if len(exc) == 1 and exc[0].type == 'string':
+        return
+    if _is_tuple(exc):
+        while _is_tuple(exc):
+            parts = _split(exc[0].items)
+            if len(parts) < 2 or not parts[0]:
+                raise Unsupported('raise')
+            exc = parts[0]
+        exc = [Leaf('atom', _text(exc), ' ')]
+    elif len(args) == 1:
+        return
+    new = 'raise'
+    if len(args) == 1:
+        new += _render(exc)
+    else:
+        val = args[1]
+        tb = args[2] if len(args) == 3 else None
+        new += _with_value(exc, val, tb, call=tb is None or not (
+            len(val) == 1 and _is_name(val[0], 'None')))
+    items[:] = [Leaf('atom', new, items[0].prefix)]
+
+
+# Fixers of primary expressions, they return the rewritten chain or `None`.
+
+
+def fix_has_key(chain):
+    parts = chain.parts
+    for index in range(1, len(parts) - 2):
+        if _is(parts[index], '.') and _is_name(parts[index + 1], 'has_key') \
+                and _is_call(parts[index + 2]):
+            break
+    else:
+        return None
+    args = _split(parts[index + 2].items)
+    if len(args) == 2 and not args[1]:
+        args.pop()
+    if len(args) != 1 or not args[0] or any(_is(i, '=') for i in args[0]):
+        return None
+    arg = args[0]
+    if any(_is(i, *COMPOUND) or i.type == 'comparison' for i in arg):
+        arg = '(' + _render(arg) + ')'
+    else:
+        arg = _text(arg)
+    negated = chain.is_negated
+    op = ' not in ' if negated else ' in '
+    new = arg + op + _text(parts[:index])
+    type_ = 'comparison'
+    after = parts[index + 3:]
+    if after:
+        new = '(' + new + ')' + _render(after)
+        type_ = 'atom'
+    if negated:
+        prefix = chain.prev.prefix
+        chain.start -= 1
+        return Leaf(type_, new, prefix)
+    if chain.is_operand:
+        new = '(' + new + ')'
+        type_ = 'atom'
+    return Leaf(type_, new, chain.prefix)
+
+
+def fix_dict(chain):
+    parts = chain.parts
+    for index in range(1, len(parts) - 2):
+        if (_is(parts[index], '.')
+                and _is_name(parts[index + 1], *DICT_METHODS)
+                and _is_call(parts[index + 2])
+                and not parts[index + 2].items):
+            break
+    else:
+        return None
+    method = parts[index + 1]
+    name = method.value
+    isiter = name.startswith('iter')
+    isview = name.startswith('view')
+    if isiter or isview:
+        name = name[4:]
+    tail = parts[index + 3:]
+    special = not tail and (
+        chain.is_argument and
+        chain.call in (ITER_EXEMPT if isiter else CONSUMING_CALLS) or
+        isiter and chain.is_iterable)
+    new = '{}.{}{}{}'.format(
+        _text(parts[:index]), method.prefix, name, parts[index + 2])
+    if not (special or isview):
+        new = '{}({})'.format('iter' if isiter else 'list', new)
+    return Leaf('atom', new + _render(tail), chain.prefix)
+
+
+def _called(chain, *names):
+    parts = chain.parts
+    return _is_name(parts[0], *names) and len(parts) > 1 and (
+        _is_call(parts[1]))
+
+
+def fix_xrange(chain):
+    if not _called(chain, 'range', 'xrange') or not chain.parts[1].items:
+        return None
+    parts = chain.parts
+    if parts[0].value == 'xrange':
+        parts[0].value = 'range'
+        return None
+    if chain.is_argument and chain.call in CONSUMING_CALLS or (
+            chain.is_iterable or chain.is_tested):
+        return None
+    new = 'list(range({}))'.format(_render(parts[1].items))
+    return Leaf('atom', new + _render(parts[2:]), chain.prefix)
+
+
+def _list_comp(xp, fp, it, test=None):
+    new = '[{} for {} in {}'.format(_text(xp), fp, _text(it))
+    if test is not None:
+        new += ' if ' + test
+    return new + ']'
+
+
+def _lambda(arg):
+    """Return the parameter and the body of a lambda with one parameter."""
+    if len(arg) < 4 or not _is(arg[0], 'lambda') or not _is(arg[2], ':'):
+        return None, None
+    param = arg[1]
+    if param.type == 'group' and param.value == '(' and (
+            len(param.items) == 1):
+        param = param.items[0]
+    if param.type != 'name' or param.value in KEYWORDS:
+        return None, None
+    return param.value, arg[3:]
+
+
+def fix_map(chain):
+    if not _called(chain, 'map'):
+        return None
+    parts = chain.parts
+    args = _split(parts[1].items)
+    trailers = _render(parts[2:])
+    if chain.is_statement:
+        new = 'list(' + _text(parts) + ')'
+    elif len(args) == 2 and args[1] and _lambda(args[0])[0] is not None:
+        fp, xp = _lambda(args[0])
+        new = _list_comp(xp, fp, args[1]) + trailers
+    elif len(args) in (2, 3) and len(args[0]) == 1 and (
+            _is_name(args[0][0], 'None')) and args[1] and (
+            len(args) == 2 or not args[2]):
+        new = 'list(' + _text(args[1]) + ')' + trailers
+    else:
+        if len(args) > 1 and len(args[0]) == 1 and (
+                _is_name(args[0][0], 'None')):
+            return None  # map(None, ...) truncates in Python 3
+        if chain.in_special_context():
+            return None
+        new = 'list(map' + str(parts[1]) + ')' + trailers
+    return Leaf('atom', new, chain.prefix)
+
+
+def fix_filter(chain):
+    if not _called(chain, 'filter'):
+        return None
+    parts = chain.parts
+    args = _split(parts[1].items)
+    trailers = _render(parts[2:])
+    if len(args) == 2 and args[1] and _lambda(args[0])[0] is not None:
+        fp, xp = _lambda(args[0])
+        test = _text(xp)
+        if any(_is(item, 'if') for item in xp):
+            test = '(' + test + ')'
+        new = _list_comp([Leaf('name', fp)], fp, args[1], test) + trailers
+    elif len(args) == 2 and len(args[0]) == 1 and (
+            _is_name(args[0][0], 'None')) and args[1]:
+        new = _list_comp([Leaf('name', '_f')], '_f', args[1], '_f') + trailers
+    else:
+        if chain.in_special_context():
+            return None
+        new = 'list(filter' + str(parts[1]) + ')' + trailers
+    return Leaf('atom', new, chain.prefix)
+
+
+def fix_zip(chain):
+    if not _called(chain, 'zip') or chain.in_special_context():
+        return None
+    parts = chain.parts
+    trailers = ''.join(_text(t) for t in chain.trailers(2))
+    new = 'list(zip' + _text(parts[1:2]) + ')' + trailers
+    return Leaf('atom', new, chain.prefix)
+
+
+def fix_input(chain):
+    if not _called(chain, 'input') or len(chain.parts) != 2:
+        return None
+    if chain.is_argument and chain.call == 'eval':
+        return None
+    return Leaf('atom', 'eval(' + _text(chain.parts) + ')', chain.prefix)
+
+
+def fix_isinstance(chain):
+    parts = chain.parts
+    if not _called(chain, 'isinstance') or len(parts) != 2:
+        return None
+    args = _split(parts[1].items)
+    if len(args) != 2 or len(args[1]) != 1 or not _is_call(args[1][0]):
+        return None
+    types = args[1][0]
+    if len(_split(types.items)) < 2:
+        return None
+    names = set()
+    new = []
+    indexes = iter(range(len(types.items)))
+    for index in indexes:
+        item = types.items[index]
+        if _is_type_name(types.items, index) and item.value in names:
+            if index < len(types.items) - 1:
+                next(indexes)  # the comma
+        else:
+            new.append(item)
+            if _is_type_name(types.items, index):
+                names.add(item.value)
+    if new and _is(new[-1], ','):
+        del new[-1]
+    if len(_split(new)) == 1:
+        new[0].prefix = types.prefix
+        parts[1].items[-1:] = new
+    else:
+        types.items[:] = new
+    return None
+
+
+def _is_type_name(items, index):
+    """Tell whether `items[index]` is a name between commas."""
+    return items[index].type == 'name' and (
+        index == 0 or _is(items[index - 1], ',')) and (
+        index == len(items) - 1 or _is(items[index + 1], ','))
+
+
+def fix_raw_input(chain):
+    if _called(chain, 'raw_input'):
+        chain.parts[0].value = 'input'
+    return None
+
+
+def _touch_import(chain, fixer, package, name):
+    """Add `from package import name` or `import name` to the expression like
+    lib2to3's `touch_import`, see `_imports`."""
+    imports = chain.root.imports
+    if all((package, name) != (p, n) for _, p, n in imports):
+        imports.append((fixer, package, name))
+
+
+def fix_apply(chain):
+    parts = chain.parts
+    if not _called(chain, 'apply') or len(parts) != 2 or not chain.is_power:
+        return None
+    args = _arguments(parts[1].items)
+    if args is None or len(args) not in (2, 3) or any(
+            _is_keyword(arg) for arg in args):
+        return None
+    func, args, kwds = args[0], args[1], args[2] if len(args) == 3 else None
+    if _is(args[0], '*', '**') or kwds is not None and _is(kwds[0], '**'):
+        return None
+    if len(func) == 1 and (
+            func[0].type in ('atom', 'group') or _is_atom(func[0]) and (
+                func[0].type == 'name')) or len(func) > 1 and (
+            _is_atom(func[0]) and _chain_end(func, 0) == len(func)):
+        new = _text(func)
+    else:
+        new = '(' + _render(func) + ')'
+    new += '(*' + _text(args)
+    if kwds is not None:
+        new += ', **' + _text(kwds)
+    return Leaf('atom', new + ')', chain.prefix)
+
+
+def _import_and_call(chain, module, fixer):
+    """Call the function of `module` named by the chain like lib2to3's
+    `ImportAndCall`."""
+    parts = chain.parts
+    args = _split(parts[1].items)
+    if len(args) == 2 and not args[1]:
+        args.pop()  # an argument list, which may start with a star
+    elif len(args) != 1 or args[0] and _is(args[0][0], '*', '**'):
+        return None
+    if not args[0] or _is_keyword(args[0]):
+        return None
+    _touch_import(chain, fixer, None, module)
+    new = '{}.{}{}'.format(module, parts[0].value, _render(parts[1:]))
+    return Leaf('atom', new, chain.prefix)
+
+
+def fix_intern(chain):
+    if not _called(chain, 'intern'):
+        return None
+    return _import_and_call(chain, 'sys', 'intern')
+
+
+def fix_reload(chain):
+    if not _called(chain, 'reload'):
+        return None
+    return _import_and_call(chain, 'importlib', 'reload')
+
+
+def fix_reduce(chain):
+    parts = chain.parts
+    if _called(chain, 'reduce') and len(parts) == 2 and chain.is_power:
+        args = _split(parts[1].items)
+        if len(args) in (2, 3) and all(args) and not any(
+                _is_keyword(arg) for arg in args):
+            _touch_import(chain, 'reduce', 'functools', 'reduce')
+    return None
+
+
+def fix_execfile(chain):
+    parts = chain.parts
+    if not _called(chain, 'execfile') or len(parts) != 2 or (
+            not chain.is_power or not parts[1].items):
+        return None
+    call = parts[1]
+    args = _split(call.items)
+    if len(args) > 3 or not all(args):
+        args = [call.items]
+    filename = args[0]
+    new = 'exec(compile(open({}, "rb"{}.read(), {}, \'exec\')'.format(
+        _render(filename), call.close, _text(filename))
+    for arg in args[1:]:
+        new += ',' + _render(arg)
+    return Leaf('atom', new + ')', chain.prefix)
+
+
+def fix_itertools(chain):
+    parts = chain.parts
+    if not chain.is_power or not _is_call(parts[-1]):
+        return None
+    if len(parts) == 2 and _is_name(parts[0], *ITERTOOLS):
+        func, prefix = parts[0], chain.prefix
+    elif len(parts) == 4 and _is_name(parts[0], 'itertools') and (
+            _is_name(parts[2], *ITERTOOLS)):
+        func = parts[2]
+        if func.value in ('ifilterfalse', 'izip_longest'):
+            func.value = func.value[1:]
+            return None
+        prefix = chain.prefix or func.prefix
+    else:
+        return None
+    return Leaf('atom', func.value[1:] + str(parts[-1]), prefix)
+
+
+def fix_types(chain):
+    parts = chain.parts
+    if len(parts) == 3 and _is_name(parts[0], 'types') and (
+            _is_name(parts[2], *TYPES)) and chain.is_power:
+        return Leaf('atom', TYPES[parts[2].value], chain.prefix)
+    return None
+
+
+def fix_operator(chain):
+    parts = chain.parts
+    if len(parts) != 4 or not _is_name(parts[0], 'operator') or (
+            not _is_name(parts[2], *OPERATOR)) or (
+            not _is_call(parts[3]) or not parts[3].items) or (
+            not chain.is_power):
+        return None
+    new = OPERATOR[parts[2].value]
+    obj = _render(parts[3].items)
+    if new == 'callable':
+        return Leaf('atom', 'callable(' + obj + ')', chain.prefix)
+    if '.' not in new:
+        parts[2].value = new
+        return None
+    module = new.rpartition('.')[0]
+    _touch_import(chain, 'operator', None, module)
+    new = 'isinstance({}, {})'.format(obj, new)
+    return Leaf('atom', new, chain.prefix)
+
+
+def fix_sys_exc(chain):
+    parts = chain.parts
+    if len(parts) == 3 and _is_name(parts[0], 'sys') and (
+            _is_name(parts[2], *EXC_INFO)) and chain.is_power:
+        new = 'sys{}.{}exc_info()[{}]'.format(
+            parts[1].prefix, parts[2].prefix,
+            EXC_INFO.index(parts[2].value))
+        return Leaf('atom', new, chain.prefix)
+    return None
+
+
+def fix_throw(chain):
+    parts = chain.parts
+    if len(parts) != 4 or not _is(parts[1], '.') or (
+            not _is_name(parts[2], 'throw')) or (
+            not _is_call(parts[3]) or not chain.is_power):
+        return None
+    args = _split(parts[3].items)
+    if len(args) not in (2, 3) or not all(args) or (
+            len(args[0]) == 1 and args[0][0].type == 'string'):
+        return None
+    exc = args[0]
+    new = _with_value(exc, args[1], args[2] if len(args) == 3 else None)
+    parts[3].items[:] = [Leaf('atom', new[len(exc[0].prefix):],
+                              exc[0].prefix)]
+    return None
+
+
+def fix_xreadlines(chain):
+    parts = chain.parts
+    if not chain.is_power:
+        return None
+    if len(parts) > 3 and _is(parts[-3], '.') and (
+            _is_name(parts[-2], 'xreadlines')) and (
+            _is_call(parts[-1]) and not parts[-1].items):
+        return Leaf('atom', _text(parts[:-3]), chain.prefix)
+    if len(parts) > 2 and _is(parts[-2], '.') and (
+            _is_name(parts[-1], 'xreadlines')):
+        parts[-1].value = '__iter__'
+    return None
+
+
+# Fixers of atoms in brackets, they get the group.
+
+
+def fix_paren(group):
+    items = group.items
+    start = next(
+        (index for index, item in enumerate(items) if _is(item, 'for')), 0)
+    if not start or start + 3 >= len(items) or (
+            not _is(items[start + 2], 'in')) or (
+            items[start + 1].type != 'name' or
+            items[start + 1].value in KEYWORDS):
+        return
+    start += 3
+    end = next((index for index, item in enumerate(items[start:], start)
+                if _is(item, 'for', 'if')), len(items))
+    target = items[start:end]
+    args = _arguments(target)
+    if args is None or len(args) < 2:
+        return
+    new = '(' + _text(target) + ')'
+    items[start:end] = [Leaf('atom', new, target[0].prefix)]
+
+
+# Fixers of lambdas, they get the tokens around the lambda, its index and the
+# `Root` to create new names.
+
+
+def _params(group):
+    """Return the names of the tuple parameter in `group` nested like
+    lib2to3's `find_params` or `None` if they are not only names."""
+    params = []
+    parts = _arguments(group.items)
+    if parts is None or any(len(part) != 1 for part in parts):
+        return None
+    for [item] in parts:
+        if item.type == 'name' and item.value not in KEYWORDS:
+            params.append(item.value)
+        elif _is_call(item) and _params(item) is not None:
+            params.append(_params(item))
+        else:
+            return None
+    if len(params) == 1 and not any(_is(i, ',') for i in group.items):
+        return params[0]
+    return params
+
+
+def _tuple_name(params):
+    return '_'.join(
+        _tuple_name(param) if isinstance(param, list) else param
+        for param in params)
+
+
+def _indexes(params, prefix='', indexes=None):
+    """Map the names in `params` to their subscriptions like lib2to3's
+    `map_to_index`, which only keeps the innermost two."""
+    if indexes is None:
+        indexes = {}
+    for index, param in enumerate(params):
+        trailer = '[{}]'.format(index)
+        if isinstance(param, list):
+            _indexes(param, trailer, indexes)
+        else:
+            indexes[param] = prefix + trailer
+    return indexes
+
+
+def _replace_names(items, names):
+    for index, item in enumerate(items):
+        if item.type == 'group':
+            _replace_names(item.items, names)
+        elif item.type == 'name' and item.value in names:
+            items[index] = Leaf('atom', names[item.value], item.prefix)
+
+
+def _fix_lambdas(items, root):
+    for index, item in enumerate(items):
+        if item.type == 'group':
+            _fix_lambdas(item.items, root)
+        elif _is(item, 'lambda'):
+            fix_tuple_params(items, index, root)
+
+
+def fix_tuple_params(items, index, root):
+    if index + 3 >= len(items) or not _is_call(items[index + 1]) or (
+            not _is(items[index + 2], ':')):
+        return
+    params = _params(items[index + 1])
+    if params is None:
+        return
+    start = end = index + 3
+    lambdas = 0  # in the body, whose colon is not the end of the body
+    while end < len(items) and not (
+            _is(items[end], ',', ';', 'for') or
+            _is(items[end], ':') and not lambdas or
+            items is root.items and end > start and '\n' in (
+                RE_CONTINUATION.sub('', items[end].prefix))):
+        if _is(items[end], 'lambda'):
+            lambdas += 1
+        elif _is(items[end], ':'):
+            lambdas -= 1
+        end += 1
+    body = items[start:end]
+    # lib2to3 rewrites the lambdas in the body first.
+    _fix_lambdas(body, root)
+    if isinstance(params, str):
+        items[index + 1] = Leaf('name', params, ' ')
+    else:
+        name = root.new_name(_tuple_name(params))
+        items[index + 1] = Leaf('name', name, ' ')
+        _replace_names(body, {
+            param: name + indexes
+            for param, indexes in _indexes(params).items()})
+    items[start:end] = body
+
+
+# The fixers by their name in `lib2to3.fixes` in the order they are applied
+# together with the tokens they can change. Numbers and strings are given by
+# their type.
+TOKEN_FIXERS = [
+    ('ne', fix_ne, {'<>'}),
+    ('numliterals', fix_numliterals, {'number'}),
+    ('unicode', fix_unicode, {'unicode', 'unichr', 'string'}),
+    ('basestring', fix_basestring, {'basestring'}),
+    ('standarderror', fix_standarderror, {'StandardError'}),
+    ('long', fix_long, {'long'}),
+    ('funcattrs', fix_funcattrs, FUNC_ATTRS),
+    ('methodattrs', fix_methodattrs, set(METHOD_ATTRS)),
+    ('renames', fix_renames, {'maxint'}),
+    ('getcwdu', fix_getcwdu, {'getcwdu'}),
+    ('repr', fix_repr, {'`'}),
+    ('asserts', fix_asserts, set(ASSERTS)),
+] + [(name, _unsupported(name), triggers) for name, triggers in UNSUPPORTED]
+# Fixers of statements starting with one of the keywords.
+STATEMENT_FIXERS = [
+    ('print', fix_print, {'print'}),
+    ('exec', fix_exec, {'exec'}),
+    ('except', fix_except, {'except'}),
+    ('raise', fix_raise, {'raise'}),
+]
+# Fixers of primary expressions containing one of the names.
+CHAIN_FIXERS = [
+    ('has_key', fix_has_key, {'has_key'}),
+    ('dict', fix_dict, DICT_METHODS),
+    ('xrange', fix_xrange, {'range', 'xrange'}),
+    ('map', fix_map, {'map'}),
+    ('filter', fix_filter, {'filter'}),
+    ('zip', fix_zip, {'zip'}),
+    ('input', fix_input, {'input'}),
+    ('raw_input', fix_raw_input, {'raw_input'}),
+    ('isinstance', fix_isinstance, {'isinstance'}),
+    ('apply', fix_apply, {'apply'}),
+    ('intern', fix_intern, {'intern'}),
+    ('reload', fix_reload, {'reload'}),
+    ('reduce', fix_reduce, {'reduce'}),
+    ('execfile', fix_execfile, {'execfile'}),
+    ('itertools', fix_itertools, ITERTOOLS),
+    ('types', fix_types, set(TYPES)),
+    ('operator', fix_operator, set(OPERATOR)),
+    ('sys_exc', fix_sys_exc, set(EXC_INFO)),
+    ('throw', fix_throw, {'throw'}),
+    ('xreadlines', fix_xreadlines, {'xreadlines'}),
+]
+# Fixers of atoms in brackets containing one of the keywords.
+GROUP_FIXERS = [
+    ('paren', fix_paren, {'for'}),
+]
+# Fixers of lambdas.
+LAMBDA_FIXERS = [
+    ('tuple_params', fix_tuple_params, {'lambda'}),
+]
+ALL_FIXERS = (TOKEN_FIXERS + STATEMENT_FIXERS + CHAIN_FIXERS + GROUP_FIXERS +
+              LAMBDA_FIXERS)
+FIXERS = [name for name, _, _ in ALL_FIXERS]
+TRIGGERS = {name: triggers for name, _, triggers in ALL_FIXERS}
+
+# The names of the fixers in use, see `use_fixes`.
+fixes = list(FIXERS)
+
+
+def _dispatch(fixers):
+    """Map the tokens to the fixers in use which can change them."""
+    dispatch = {}
+    for name, fixer, triggers in fixers:
+        if name in fixes:
+            for trigger in triggers:
+                dispatch.setdefault(trigger, []).append(fixer)
+    return dispatch
+
+
+def _in_use(fixers):
+    return [fixer for name, fixer, _ in fixers if name in fixes]
+
+
+def _setup():
+    global _token_fixers, _statement_fixers, _chain_fixers, _chain_triggers
+    global _group_fixers, _lambda_fixers
+    _token_fixers = _dispatch(TOKEN_FIXERS)
+    _statement_fixers = _dispatch(STATEMENT_FIXERS)
+    _chain_fixers = _in_use(CHAIN_FIXERS)
+    _chain_triggers = set().union(
+        *(triggers for name, _, triggers in CHAIN_FIXERS if name in fixes))
+    _group_fixers = _in_use(GROUP_FIXERS)
+    _lambda_fixers = _in_use(LAMBDA_FIXERS)
+
+
+_setup()
+
+
+def available_fixes():
+    """Return the names of all fixers."""
+    return list(FIXERS)
+
+
+def default_fixes():
+    """Return the names of the fixers used by default."""
+    return list(FIXERS)
+
+
+def get_fixes():
+    """Return the names of the fixers in use."""
+    return fixes
+
+
+def use_fixes(names=None):
+    """Use the fixers in `names`, `None` restores the default ones."""
+    global fixes
+    fixes = default_fixes() if names is None else list(names)
+    _setup()
+
+
+def fix_triggers(name):
+    """Return the tokens one of which the fixer `name` needs to change an
+    expression."""
+    return TRIGGERS[name]
+
+
+def _statements(items):
+    """Yield the slices of `items` which are statements.
+
+    The header of a compound statement up to its colon counts as one.
+    """
+    start = 0
+    for index, item in enumerate(items):
+        if _is(item, ';'):
+            yield start, index
+            start = index + 1
+        elif index > start and '\n' in RE_CONTINUATION.sub('', item.prefix):
+            yield start, index
+            start = index
+        elif _is(item, ':') and _is(items[start], *COMPOUND_STATEMENTS):
+            yield start, index + 1
+            start = index + 1
+    yield start, len(items)
+
+
+def _fix_items(items, root, call=None):
+    """Apply the fixers to `items` of the `Root` `root` in place.
+
+    `call` is the result of `_call_name` for the brackets around `items`.
+    """
+    top = items is root.items
+    for index, item in enumerate(items):
+        if item.type == 'group':
+            _fix_items(item.items, root, _call_name(items, index))
+            if _group_fixers and item.value in '([' and (
+                    index == 0 or not _is_atom(items[index - 1])):
+                for fixer in _group_fixers:
+                    fixer(item)
+        elif item.value == 'lambda' and item.type == 'name':
+            for fixer in _lambda_fixers:
+                fixer(items, index, root)
+        key = item.type if item.type in ('number', 'string') else item.value
+        for fixer in _token_fixers.get(key, ()):
+            fixer(items, index)
+    index = 0
+    while index < len(items):
+        if not _is_atom(items[index]):
+            index += 1
+            continue
+        chain = Chain(items, index, _chain_end(items, index), call, root)
+        index = chain.end
+        if len(chain.parts) < 2 or _chain_triggers.isdisjoint(
+                part.value for part in chain.parts if part.type == 'name'):
+            continue
+        for fixer in _chain_fixers:
+            new = fixer(chain)
+            if new is not None:
+                items[chain.start:chain.end] = [new]
+                index = chain.start + 1
+                break
+    if top and any(
+            item.type == 'name' and item.value in _statement_fixers
+            for item in items):
+        for start, end in reversed(list(_statements(items))):
+            statement = items[start:end]
+            if statement:
+                for fixer in _statement_fixers.get(statement[0].value, ()):
+                    fixer(statement)
+            items[start:end] = statement
+
+
+def _imports(root):
+    """Return the import statements the fixers need.
+
+    They are added before the first statement. Raises `Unsupported` if
+    lib2to3 would add them elsewhere or the expression may already bind them.
+    """
+    if not root.imports:
+        return ''
+    start, end = next(_statements(root.items))
+    docstring = end - start == 1 and root.items[start].type == 'string'
+    lines = []
+    for fixer, package, name in root.imports:
+        if docstring or 'import' in root.names or (
+                package is None and name in root.names):
+            raise Unsupported(fixer)
+        if package is None:
+            lines.append('import {}\n'.format(name))
+        else:
+            lines.append('from {} import {}\n'.format(package, name))
+    return ''.join(lines)
+
+
+def fingerprint():
+    """Identify the fixers of this engine."""
+    data = '\n'.join(['tokenrewrite-2'] + FIXERS)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def rewrite_using_tokens(src, lineno, tag, filename):
+    """Rewrite a python expression using the fixers in use.
+
+    Raises `PTParseError` if the rewritten expression is not valid Python or
+    needs a fixer in `UNSUPPORTED`.
+    """
+    consolidated_src = src.lstrip()
+    root = tokenize(consolidated_src)
+    try:
+        _fix_items(root.items, root)
+        result = (
+            _imports(root) + _render(root.items) + root.close.prefix)
+    except Unsupported as e:
+        raise PTParseError(
+            'Cannot rewrite {!r}: the fixer {!r} is not supported by this'
+            ' engine'.format(consolidated_src, e.args[0]))
+    try:
+        # Some fixers move white space to the start like lib2to3 does.
+        ast.parse(result.lstrip())
+    except (SyntaxError, ValueError) as e:
+        raise PTParseError(
+            'Cannot parse {!r}: {}'.format(consolidated_src, e))
+    if result == consolidated_src:
+        return src  # include leading white space
+    return result